@@ -1,13 +1,95 @@
 import os
+import time
 
-from flask import Flask
+from flask import Flask, Response, g, request
 from flask_cors import CORS
+from prometheus_client import CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+from sqlalchemy import event, inspect, literal, text
 
 from apps.core.celery import celery_init_app
 from apps.core.routes import blue_print
+from apps.metrics.instrumentation import REQUEST_LATENCY
 from apps.metrics.models import db
 
 
+def get_engine_options(config) -> dict:
+    options = {
+        'pool_pre_ping': config['DATABASE_POOL_PRE_PING'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+    }
+    if not config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        options['pool_size'] = config['DATABASE_POOL_SIZE']
+        options['max_overflow'] = config['DATABASE_MAX_OVERFLOW']
+    return options
+
+
+def enable_sqlite_wal(engine, busy_timeout: int):
+    # Web and Celery workers share the file: with WAL readers no longer block the writer, and writers
+    # wait for the lock instead of failing right away
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout * 1000)}')
+        cursor.close()
+
+
+def upgrade_schema(engine):
+    # create_all only creates missing tables. Columns and indexes added to the models since a database was created
+    # are added to its tables here: NOT NULL columns with their default for the existing rows, unique columns
+    # through a unique index.
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}'
+                if column.default is not None and column.default.is_scalar:
+                    default = literal(column.default.arg, column.type).compile(
+                        dialect=engine.dialect, compile_kwargs={'literal_binds': True})
+                    ddl += f' DEFAULT {default}' + ('' if column.nullable else ' NOT NULL')
+                connection.execute(text(ddl))
+                if column.unique:
+                    connection.execute(text(
+                        f'CREATE UNIQUE INDEX uq_{table.name}_{column.name} ON {table.name} ({column.name})'))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+
+
+def init_monitoring(app: Flask):
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def observe_latency(response):
+        # Blueprint routes only, /health and /metrics would drown the API latencies
+        if request.blueprint is not None and 'request_start' in g:
+            REQUEST_LATENCY.labels(
+                method=request.method,
+                endpoint=request.endpoint,
+                status=response.status_code
+            ).observe(time.perf_counter() - g.request_start)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        # With PROMETHEUS_MULTIPROC_DIR set (gunicorn and Celery workers sharing it), the metrics of all
+        # processes are collected, otherwise only those of this one
+        registry = REGISTRY
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            registry = CollectorRegistry()
+            MultiProcessCollector(registry)
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
 def init_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
     CORS(app)
@@ -15,6 +97,8 @@ def init_app(test_config=None):
     if test_config is None:
         # load the instance config, if it exists, when not testing
         app.config.from_pyfile('config.py', silent=True)
+        # FLASK_ prefixed environment variables override it, e.g. FLASK_SQLALCHEMY_DATABASE_URI
+        app.config.from_prefixed_env()
     else:
         # load the test config if passed in
         app.config.from_mapping(test_config)
@@ -26,12 +110,49 @@ def init_app(test_config=None):
             task_ignore_result=True
         )
     )
-    app.config.update(
-        SQLALCHEMY_DATABASE_URI='sqlite:///mydatabase.db',
-    )
+    app.config.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite:///mydatabase.db')
+    app.config.setdefault('DATABASE_POOL_SIZE', 5)
+    app.config.setdefault('DATABASE_MAX_OVERFLOW', 10)
+    app.config.setdefault('DATABASE_POOL_RECYCLE', 1800)  # seconds
+    # test connections on checkout, a round trip per checkout in exchange for surviving dropped connections
+    app.config.setdefault('DATABASE_POOL_PRE_PING', True)
+    # seconds a writer waits for the SQLite lock before failing
+    app.config.setdefault('SQLITE_BUSY_TIMEOUT', 30)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', get_engine_options(app.config))
+    # columns with more distinct values are reported as "too many values" when profiling cohorts
+    app.config.setdefault('COHORT_MAX_VALUES', 100)
+    # cores used by the waiting time analysis of one cohort, more than one runs wta in parallel
+    app.config.setdefault('WAITING_TIME_WORKERS', 1)
+    # logs with at least this many events are analysed out-of-core in case-complete chunks, off when unset
+    app.config.setdefault('STREAMING_MIN_EVENTS', None)
+    # events per chunk of the out-of-core analysis
+    app.config.setdefault('STREAMING_CHUNK_ROWS', 500_000)
+    # bytes of loaded event logs each Celery worker process keeps for the next task on the same log, 0 turns it off
+    app.config.setdefault('EVENT_LOG_CACHE_BYTES', 512 * 2 ** 20)
+    # with n queues, the tasks of a log go to queue event_log_<id mod n> so that the worker consuming it has the
+    # log cached, start one worker per queue (celery worker -Q event_log_0 ...), off when 0
+    app.config.setdefault('EVENT_LOG_QUEUES', 0)
+    # seconds after which an append that has not finished is given up, its worker is taken for dead
+    app.config.setdefault('APPEND_TIMEOUT', 3600)
+    # seconds between job status reads of the long polling and event stream endpoints
+    app.config.setdefault('STATUS_POLL_INTERVAL', 0.5)
+    # upper bound of the wait argument of /status/<result_id>
+    app.config.setdefault('STATUS_MAX_WAIT', 30)
+    app.config.setdefault('STATUS_HEARTBEAT_INTERVAL', 15)
+    # directory the cProfile stats of every analysis job are dumped to, profiling is off when unset
+    app.config.setdefault('PROFILE_DIR', None)
+    # seconds a preview of /analyze may take by default (budget argument), and at most
+    app.config.setdefault('PREVIEW_TIME_BUDGET', 2)
+    app.config.setdefault('PREVIEW_MAX_TIME_BUDGET', 30)
+    # cases of the first sample of a value set, the sample is grown while the budget allows
+    app.config.setdefault('PREVIEW_SAMPLE_CASES', 200)
+    app.config.setdefault('PREVIEW_CONFIDENCE', 0.95)
     db.init_app(app)
     with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            enable_sqlite_wal(db.engine, app.config['SQLITE_BUSY_TIMEOUT'])
         db.create_all()
+        upgrade_schema(db.engine)
 
     # ensure the instance folder exists
     try:
@@ -43,6 +164,8 @@ def init_app(test_config=None):
     def health():
         return {'status': 'ok'}
 
+    init_monitoring(app)
+
     return app
 
 
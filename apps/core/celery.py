@@ -1,16 +1,32 @@
-import pandas as pd
+import json
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
-from apps.metrics import analysis_waiting_time, analysis_process_time
-from celery import Celery, Task, shared_task
-from flask import Flask
+from apps.metrics import get_waiting_time_transitions, get_process_time_stats, store_waiting_time_results, \
+    store_process_time_results, load_event_log, add_stored_enablement_times, get_cohorts, get_enablement_times, \
+    build_cohort_cube, store_cohort_cube, load_cohort_cube, get_cohort_cube_stats, COHORT_VALUE, \
+    get_event_log_delta, get_analysis_stats, fold_analysis_results, fold_stored_cohort_cube, delete_analysis_results, \
+    get_appended_content_hash, get_analysis_cache_key, get_cohort_cube_cache_key, get_enablement_configuration_key, \
+    get_event_log_content_hash, get_streamed_analysis_stats, get_event_log_size, get_event_log_version, FrameCache, \
+    get_resource_stats, store_resource_results, store_event_log_variants, update_case_variants, load_case_variants, \
+    store_case_variants, get_resource_windows, fold_resource_results, delete_time_results, get_process_time_columns, \
+    get_waiting_time_windows
+from apps.metrics.storage import store_enablement_times, has_enablement_times, store_concurrency_counts
+from celery import Celery, Task, shared_task, group
+from flask import Flask, current_app
+from sqlalchemy import update, func, select
 
 from logging import getLogger
 
-from apps.metrics.models import AnalyzeResult, db
+from apps.metrics.instrumentation import time_stage, profile_job, JOBS
+from apps.metrics.models import AnalyzeResult, AnalyzeJob, EventLog, CohortCube, db
 
 
 logger = getLogger(__name__)
 
+# Loaded event logs of this worker process, see get_event_log_cache
+event_log_cache = None
+
 
 def celery_init_app(app: Flask) -> Celery:
     class FlaskTask(Task):
@@ -28,28 +44,421 @@ def celery_init_app(app: Flask) -> Celery:
     return celery_app
 
 
+def get_event_log_cache() -> FrameCache:
+    global event_log_cache
+    if event_log_cache is None:
+        event_log_cache = FrameCache(current_app.config['EVENT_LOG_CACHE_BYTES'])
+    return event_log_cache
+
+
+def get_log_routing(event_log_id: int) -> dict:
+    # Options of the tasks of a log, the same queue for all of them when EVENT_LOG_QUEUES is set
+    queues = current_app.config['EVENT_LOG_QUEUES']
+    return {'queue': f'event_log_{event_log_id % queues}'} if queues else {}
+
+
+@shared_task(name='apps.core.celery.profile_cohorts')
+def do_profile_cohorts(event_log_id: int):
+    logger.info(f"Task do_profile_cohorts started for event_log_id: {event_log_id}")
+
+    event_log = EventLog.query.filter_by(id=event_log_id).first()
+    event_log.cohorts = json.dumps(get_cohorts(event_log, current_app.config['COHORT_MAX_VALUES']))
+    store_event_log_variants(event_log)
+
+    db.session.commit()
+
+
+def set_job_state(analyze_result_ids, status: str, stage: str = None, error: str = None):
+    # A single UPDATE, the analyses of one result run in concurrent tasks and must not overwrite each
+    # other's timings. A failed job stays failed until it is queued again.
+    now = datetime.utcnow()
+    values = {'status': status, 'stage': stage}
+    if status == AnalyzeJob.RUNNING:
+        values['started_at'] = func.coalesce(AnalyzeJob.started_at, now)
+    elif status in (AnalyzeJob.DONE, AnalyzeJob.FAILED):
+        values['finished_at'] = now
+    if error is not None:
+        values['error'] = error
+    updated = db.session.execute(
+        update(AnalyzeJob)
+        .where(AnalyzeJob.analyze_result_id.in_(analyze_result_ids), AnalyzeJob.status != AnalyzeJob.FAILED)
+        .values(**values)).rowcount
+    db.session.commit()
+    if status in (AnalyzeJob.DONE, AnalyzeJob.FAILED):
+        JOBS.labels(status=status).inc(updated)
+
+
+def release_stale_append(event_log: EventLog):
+    # An append whose worker died never releases its claim on the log, so that every later append and analysis
+    # would be refused. The claim is given up after APPEND_TIMEOUT: the part stays out of the log and the results
+    # it was folding into are served unchanged. A worker still running finds out before it commits, see
+    # holds_append_claim.
+    if event_log.pending_part is None:
+        return
+    timeout = timedelta(seconds=current_app.config['APPEND_TIMEOUT'])
+    if event_log.pending_since is not None and datetime.utcnow() - event_log.pending_since < timeout:
+        return
+    released = db.session.execute(
+        update(EventLog).where(EventLog.id == event_log.id, EventLog.pending_part == event_log.pending_part,
+                               EventLog.pending_since == event_log.pending_since)
+        .values(pending_part=None, pending_since=None)).rowcount
+    db.session.commit()
+    if released:
+        logger.warning(f"Append to event_log_id {event_log.id} timed out, its claim is released")
+        appending_ids = db.session.execute(
+            select(AnalyzeJob.analyze_result_id).join(AnalyzeResult, AnalyzeResult.id == AnalyzeJob.analyze_result_id)
+            .where(AnalyzeResult.event_log_id == event_log.id, AnalyzeJob.stage == 'append',
+                   AnalyzeJob.status.in_([AnalyzeJob.QUEUED, AnalyzeJob.RUNNING]))).scalars().all()
+        set_job_state(appending_ids, AnalyzeJob.DONE, 'append', 'Append timed out, results unchanged')
+
+
+def holds_append_claim(event_log_id: int, part: int, claimed_since: datetime) -> bool:
+    # Whether the append of part still holds its claim on the log. It then keeps the row locked until the end of
+    # the transaction, so that release_stale_append waits for the append to commit.
+    return db.session.execute(
+        update(EventLog).where(EventLog.id == event_log_id, EventLog.pending_part == part,
+                               EventLog.pending_since == claimed_since)
+        .values(pending_since=claimed_since)).rowcount > 0
+
+
+@contextmanager
+def job_stage(analyze_result_ids, stage: str):
+    set_job_state(analyze_result_ids, AnalyzeJob.RUNNING, stage)
+    try:
+        with time_stage(f'job_{stage}'):
+            yield
+    except Exception as e:
+        # Nothing of the failed stage is kept, it is computed again when the analysis is requested again
+        db.session.rollback()
+        set_job_state(analyze_result_ids, AnalyzeJob.FAILED, stage, f'{type(e).__name__}: {e}')
+        raise
+
+
+def commit_results():
+    with time_stage('db_commit'):
+        db.session.commit()
+
+
+def profile_analysis(analyze_result_id: int, name: str):
+    return profile_job(f'analyze_result_{analyze_result_id}_{name}', current_app.config['PROFILE_DIR'])
+
+
 @shared_task(name='apps.core.celery')
-def do_analyze(analyze_result_id1: int, analyze_result_id2: int):
-    do_one_analyze(analyze_result_id1)
-    do_one_analyze(analyze_result_id2)
+def do_analyze(*analyze_result_ids: int, workers: int = None):
+    # All cohorts need the enablement times of the whole log, compute (or load) them once before fanning out
+    with job_stage(analyze_result_ids, 'enablement_times'), \
+            profile_analysis(analyze_result_ids[0], 'enablement_times'):
+        analyze_result = AnalyzeResult.query.filter_by(id=analyze_result_ids[0]).first()
+        prepare_enablement_times(analyze_result.event_log)
 
+    # One task per cohort and analysis kind, so they run concurrently on separate worker processes
+    routing = get_log_routing(analyze_result.event_log_id)
+    group(
+        analysis_task.set(**routing)
+        for analyze_result_id in analyze_result_ids
+        for analysis_task in (do_waiting_time_analysis.si(analyze_result_id, workers),
+                              do_process_time_analysis.si(analyze_result_id))
+    ).apply_async()
 
-def do_one_analyze(analyze_result_id: int):
-    logger.info(f"Task do_analyze started for analyze_result_id: {analyze_result_id}")
 
-    analyze_result = AnalyzeResult.query.filter_by(id=analyze_result_id).first()
+def load_analyze_event_log(analyze_result: AnalyzeResult, with_enablement_times: bool, columns: list = None):
+    return load_cached_event_log(analyze_result.event_log, analyze_result.cohort, with_enablement_times, columns)
+
+
+def load_cached_event_log(event_log_meta: EventLog, cohort: str, with_enablement_times: bool, columns: list = None):
+    # Through the worker's event log cache, the returned frame is shared and must not be modified. columns: the
+    # log columns to read, all of them by default.
+    columns = columns or event_log_meta.get_columns()
+
+    def load():
+        event_log = load_event_log(event_log_meta, columns + [cohort], categorical_columns=[cohort])
+        if with_enablement_times:
+            add_stored_enablement_times(event_log, event_log_meta)
+        return event_log
+
+    return get_event_log_cache().get_or_load(
+        event_log_meta.id, (cohort, with_enablement_times, tuple(columns)), get_event_log_version(event_log_meta),
+        load)
+
+
+def is_streamed(event_log_meta: EventLog) -> bool:
+    # Logs of at least STREAMING_MIN_EVENTS events are never loaded whole, see get_streamed_analysis_stats
+    min_events = current_app.config['STREAMING_MIN_EVENTS']
+    return min_events is not None and get_event_log_size(event_log_meta) >= min_events
+
+
+def prepare_enablement_times(event_log_meta: EventLog):
+    # Computed and stored unless they are, chunk by chunk for streamed logs
+    if has_enablement_times(event_log_meta, get_enablement_configuration_key()):
+        return
+    if is_streamed(event_log_meta):
+        get_enablement_times(event_log_meta, chunk_rows=current_app.config['STREAMING_CHUNK_ROWS'])
+    else:
+        get_enablement_times(event_log_meta)
+
+
+def analyze_waiting_times(analyze_result: AnalyzeResult, workers: int, event_log=None):
+    # event_log: the log as load_analyze_event_log returns it, loaded here unless the analysis is streamed
     event_log_meta = analyze_result.event_log
+    if event_log is None and is_streamed(event_log_meta):
+        transitions, _, _ = get_streamed_analysis_stats(
+            event_log_meta, analyze_result.cohort, analyze_result.cohort_values,
+            current_app.config['STREAMING_CHUNK_ROWS'], workers, process_times=False)
+        return transitions
+    if event_log is None:
+        event_log = load_analyze_event_log(analyze_result, with_enablement_times=True)
+    return get_waiting_time_transitions(
+        event_log, event_log_meta, analyze_result.cohort, analyze_result.cohort_values, workers)
 
-    event_log = pd.read_csv(f'tmp/event_log_{event_log_meta.id}.csv')
-    event_log[event_log_meta.start_time] = pd.to_datetime(event_log[event_log_meta.start_time], utc=True)
-    event_log[event_log_meta.end_time] = pd.to_datetime(event_log[event_log_meta.end_time], utc=True)
-    event_log[event_log_meta.resource].fillna("NOT_SET", inplace=True)
-    event_log[event_log_meta.resource] = event_log[event_log_meta.resource].astype("string")
-    filter_cohort = analyze_result.cohort
-    filter_value = analyze_result.cohort_values
 
-    analyze_result.waiting_time_results = analysis_waiting_time(event_log, event_log_meta, filter_cohort, filter_value)
-    analyze_result.activity_results, analyze_result.trace_results = \
-        analysis_process_time(event_log, event_log_meta, filter_cohort, filter_value)
+def analyze_process_times(analyze_result: AnalyzeResult, event_log=None):
+    event_log_meta = analyze_result.event_log
+    if event_log is None and is_streamed(event_log_meta):
+        _, activity_stats, variant_stats = get_streamed_analysis_stats(
+            event_log_meta, analyze_result.cohort, analyze_result.cohort_values,
+            current_app.config['STREAMING_CHUNK_ROWS'], waiting_times=False)
+        return activity_stats, variant_stats
+    if event_log is None:
+        event_log = load_analyze_event_log(analyze_result, with_enablement_times=False,
+                                           columns=get_process_time_columns(event_log_meta))
+    return get_process_time_stats(event_log, event_log_meta, analyze_result.cohort, analyze_result.cohort_values)
+
 
+def analyze_resources(analyze_result: AnalyzeResult, event_log=None):
+    # None for streamed logs, busy times and load series need the events of all cases at once
+    event_log_meta = analyze_result.event_log
+    if event_log is None and is_streamed(event_log_meta):
+        return None
+    if event_log is None:
+        event_log = load_analyze_event_log(analyze_result, with_enablement_times=True)
+    return get_resource_stats(event_log, event_log_meta, analyze_result.cohort, analyze_result.cohort_values)
+
+
+@shared_task(name='apps.core.celery.waiting_time')
+def do_waiting_time_analysis(analyze_result_id: int, workers: int = None):
+    logger.info(f"Task do_waiting_time_analysis started for analyze_result_id: {analyze_result_id}")
+
+    analyze_result = AnalyzeResult.query.filter_by(id=analyze_result_id).first()
+    if not analyze_result.waiting_time_done:
+        with job_stage([analyze_result_id], 'waiting_time'), profile_analysis(analyze_result_id, 'waiting_time'):
+            # One load for both, even when the log does not fit the event log cache
+            event_log = None if is_streamed(analyze_result.event_log) else \
+                load_analyze_event_log(analyze_result, with_enablement_times=True)
+            store_waiting_time_results(analyze_result_id, analyze_waiting_times(
+                analyze_result, workers or current_app.config['WAITING_TIME_WORKERS'], event_log))
+            # Same transaction, a summary never sees waiting times without the resources
+            resource_stats = analyze_resources(analyze_result, event_log)
+            if resource_stats is not None:
+                store_resource_results(analyze_result_id, *resource_stats)
+            analyze_result.waiting_time_done = True
+            commit_results()
+
+    store_summary_if_done(analyze_result_id)
+
+
+@shared_task(name='apps.core.celery.process_time')
+def do_process_time_analysis(analyze_result_id: int):
+    logger.info(f"Task do_process_time_analysis started for analyze_result_id: {analyze_result_id}")
+
+    analyze_result = AnalyzeResult.query.filter_by(id=analyze_result_id).first()
+    if not analyze_result.process_time_done:
+        with job_stage([analyze_result_id], 'process_time'), profile_analysis(analyze_result_id, 'process_time'):
+            store_process_time_results(analyze_result_id, *analyze_process_times(analyze_result))
+            analyze_result.process_time_done = True
+            commit_results()
+
+    store_summary_if_done(analyze_result_id)
+
+
+def store_summary_if_done(analyze_result_id: int):
+    # Checked after each analysis commits, so whichever finishes last sees both done and stores the summary
+    analyze_result = AnalyzeResult.query.filter_by(id=analyze_result_id).first()
+    if analyze_result.waiting_time_done and analyze_result.process_time_done:
+        with job_stage([analyze_result_id], 'summary'):
+            analyze_result.summary = json.dumps(analyze_result.get_summary())
+            commit_results()
+        set_job_state([analyze_result_id], AnalyzeJob.DONE, 'summary')
+
+
+def do_one_analyze(analyze_result_id: int, workers: int = None):
+    # Sequential variant, loads the log once (unless it is streamed) and runs both analyses in the current process
+    logger.info(f"Task do_analyze started for analyze_result_id: {analyze_result_id}")
+
+    with profile_analysis(analyze_result_id, 'analyze'):
+        analyze_result = AnalyzeResult.query.filter_by(id=analyze_result_id).first()
+
+        with job_stage([analyze_result_id], 'enablement_times'):
+            if is_streamed(analyze_result.event_log):
+                event_log = None
+                prepare_enablement_times(analyze_result.event_log)
+            else:
+                event_log = load_analyze_event_log(analyze_result, with_enablement_times=True)
+
+        if not analyze_result.waiting_time_done:
+            with job_stage([analyze_result_id], 'waiting_time'):
+                store_waiting_time_results(analyze_result_id, analyze_waiting_times(
+                    analyze_result, workers or current_app.config['WAITING_TIME_WORKERS'], event_log))
+                resource_stats = analyze_resources(analyze_result, event_log)
+                if resource_stats is not None:
+                    store_resource_results(analyze_result_id, *resource_stats)
+                analyze_result.waiting_time_done = True
+                commit_results()
+        if not analyze_result.process_time_done:
+            with job_stage([analyze_result_id], 'process_time'):
+                store_process_time_results(analyze_result_id, *analyze_process_times(analyze_result, event_log))
+                analyze_result.process_time_done = True
+                commit_results()
+
+        store_summary_if_done(analyze_result_id)
+
+
+@shared_task(name='apps.core.celery.cohort_cube')
+def do_build_cohort_cube(cohort_cube_id: int, workers: int = None):
+    logger.info(f"Task do_build_cohort_cube started for cohort_cube_id: {cohort_cube_id}")
+
+    cohort_cube = CohortCube.query.filter_by(id=cohort_cube_id).first()
+    cohort_cube.status = AnalyzeJob.RUNNING
     db.session.commit()
+    try:
+        with time_stage('job_cohort_cube'), \
+                profile_job(f'cohort_cube_{cohort_cube_id}', current_app.config['PROFILE_DIR']):
+            event_log_meta = cohort_cube.event_log
+            event_log = load_cached_event_log(event_log_meta, cohort_cube.cohort, with_enablement_times=True)
+            cube = build_cohort_cube(event_log, event_log_meta, cohort_cube.cohort,
+                                     workers or current_app.config['WAITING_TIME_WORKERS'])
+            store_cohort_cube(cohort_cube_id, cube, event_log_meta.parts or 0)
+        cohort_cube.cohort_values = json.dumps([str(value) for value in cube['activities'][COHORT_VALUE].unique()])
+        cohort_cube.status = AnalyzeJob.DONE
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        cohort_cube.status = AnalyzeJob.FAILED
+        cohort_cube.error = f'{type(e).__name__}: {e}'
+        db.session.commit()
+        raise
+
+
+def analyze_from_cohort_cube(analyze_result_id: int, cohort_cube: CohortCube):
+    # Merges the stored per-value aggregates, cheap enough to run in the request
+    analyze_result = AnalyzeResult.query.filter_by(id=analyze_result_id).first()
+    with job_stage([analyze_result_id], 'cohort_cube'):
+        store_cohort_cube_results(analyze_result, load_cohort_cube(cohort_cube.id, cohort_cube.event_log.parts or 0))
+        analyze_result.waiting_time_done = True
+        analyze_result.process_time_done = True
+        commit_results()
+
+    store_summary_if_done(analyze_result_id)
+
+
+def store_cohort_cube_results(analyze_result: AnalyzeResult, cube: dict):
+    transitions, activity_stats, variant_stats = get_cohort_cube_stats(cube, analyze_result.cohort_values)
+    store_waiting_time_results(analyze_result.id, transitions)
+    store_process_time_results(analyze_result.id, activity_stats, variant_stats)
+
+
+@shared_task(name='apps.core.celery.append')
+def do_append_event_log(event_log_id: int, part_content_hash: str, workers: int = None):
+    # Folds the pending part into the log: only the cases it touches are analysed again, once as they were
+    # and once with the new events, and the difference is applied to every stored result and cohort cube
+    logger.info(f"Task do_append_event_log started for event_log_id: {event_log_id}")
+    workers = workers or current_app.config['WAITING_TIME_WORKERS']
+
+    event_log = EventLog.query.filter_by(id=event_log_id).first()
+    part, claimed_since = event_log.pending_part, event_log.pending_since
+    if part is None:
+        logger.warning(f"Append to event_log_id {event_log_id} was given up before it started")
+        return
+    analyze_results = AnalyzeResult.query.filter_by(event_log_id=event_log_id).all()
+    complete_results = [analyze_result for analyze_result in analyze_results
+                        if analyze_result.waiting_time_done and analyze_result.process_time_done]
+    complete_ids = [analyze_result.id for analyze_result in complete_results]
+    cohort_cubes = CohortCube.query.filter_by(event_log_id=event_log_id, status=AnalyzeJob.DONE).all()
+
+    set_job_state(complete_ids, AnalyzeJob.RUNNING, 'append')
+    try:
+        with time_stage('job_append'), \
+                profile_job(f'append_{event_log_id}_{part}', current_app.config['PROFILE_DIR']):
+            cohorts = sorted({analyze_result.cohort for analyze_result in complete_results} |
+                             {cohort_cube.cohort for cohort_cube in cohort_cubes})
+            columns = event_log.get_columns() + cohorts
+            streamed = is_streamed(event_log)
+            # Stored next to those of the log without the part, which readers use until the commit
+            before, after, enablement_times, counts = get_event_log_delta(
+                event_log, part, columns, current_app.config['STREAMING_CHUNK_ROWS'] if streamed else None)
+            store_enablement_times(event_log, get_enablement_configuration_key(), enablement_times, part)
+            store_concurrency_counts(event_log, counts, part)
+            case_variants = load_case_variants(event_log)
+            if case_variants is not None:
+                store_case_variants(event_log, update_case_variants(case_variants, after, event_log), part)
+
+            # Waiting times depend on other cases, they are folded over a window of the log around the part
+            windows = get_waiting_time_windows(event_log, part, before, after, columns)
+            cubes = {}
+            for cohort_cube in cohort_cubes:
+                cube = fold_stored_cohort_cube(cohort_cube.id, event_log, part, cohort_cube.cohort, before, after,
+                                               windows, workers)
+                cohort_cube.cohort_values = json.dumps(
+                    [str(value) for value in cube['activities'][COHORT_VALUE].unique()])
+                cubes[cohort_cube.cohort] = cube
+            analysed_results = []
+            for analyze_result in complete_results:
+                if analyze_result.from_cohort_cube and analyze_result.cohort in cubes:
+                    # Merged again from the folded cube, as they were made
+                    delete_time_results(analyze_result.id)
+                    store_cohort_cube_results(analyze_result, cubes[analyze_result.cohort])
+                else:
+                    fold_analysis_results(analyze_result.id, *[
+                        get_analysis_stats(event_log_df, event_log, analyze_result.cohort,
+                                           analyze_result.cohort_values, workers, window)
+                        for event_log_df, window in zip((before, after), windows)])
+                    if not analyze_result.from_cohort_cube:
+                        analysed_results.append(analyze_result)
+                analyze_result.revision += 1
+                analyze_result.summary = None
+            if analysed_results:
+                # Busy times and loads only change where the new events are, the rest of the log is not read
+                resource_windows = get_resource_windows(event_log, part, before, after, columns)
+                for analyze_result in analysed_results:
+                    fold_resource_results(analyze_result.id, event_log, resource_windows, before, after,
+                                          analyze_result.cohort, analyze_result.cohort_values, streamed)
+            for analyze_result in analyze_results:
+                if analyze_result.id not in complete_ids:
+                    # Partial results of failed analyses no longer match the log, they are computed again
+                    delete_analysis_results(analyze_result.id)
+                    analyze_result.waiting_time_done = False
+                    analyze_result.process_time_done = False
+
+            if not holds_append_claim(event_log_id, part, claimed_since):
+                # Given up meanwhile, see release_stale_append
+                db.session.rollback()
+                logger.warning(f"Append to event_log_id {event_log_id} was given up, results unchanged")
+                return
+            event_log.content_hash = get_appended_content_hash(
+                event_log.content_hash or get_event_log_content_hash(event_log_id), part_content_hash)
+            event_log.parts = part
+            event_log.pending_part = None
+            event_log.pending_since = None
+            for analyze_result in analyze_results:
+                analyze_result.cache_key = get_analysis_cache_key(
+                    event_log, analyze_result.cohort, analyze_result.cohort_values, analyze_result.from_cohort_cube)
+            for cohort_cube in CohortCube.query.filter_by(event_log_id=event_log_id).all():
+                cohort_cube.cache_key = get_cohort_cube_cache_key(event_log, cohort_cube.cohort)
+            commit_results()
+    except Exception as e:
+        # Stored results are untouched, the part stays out of the log. Unless the claim was given up meanwhile.
+        db.session.rollback()
+        released = db.session.execute(
+            update(EventLog).where(EventLog.id == event_log_id, EventLog.pending_part == part,
+                                   EventLog.pending_since == claimed_since)
+            .values(pending_part=None, pending_since=None)).rowcount
+        db.session.commit()
+        if released:
+            set_job_state(complete_ids, AnalyzeJob.DONE, 'append',
+                          f'Append failed, results unchanged: {type(e).__name__}: {e}')
+        raise
+
+    # Frames of the log before the append are not used again
+    get_event_log_cache().invalidate(event_log_id)
+    for analyze_result_id in complete_ids:
+        store_summary_if_done(analyze_result_id)
+    do_profile_cohorts.delay(event_log_id)
@@ -0,0 +1,21 @@
+import sys
+from contextvars import copy_context
+
+
+def is_cooperative() -> bool:
+    # True inside a gevent worker, gunicorn's gevent worker class monkey patches the standard library
+    # before the app is loaded
+    if 'gevent' not in sys.modules:
+        return False
+    from gevent import monkey
+    return monkey.is_module_patched('socket')
+
+
+def run_blocking(function, *args, **kwargs):
+    # Disk writes, parsing and SQLite reads do not yield to other greenlets. Under gevent they are run in the hub's
+    # thread pool while the calling greenlet waits, so the worker keeps serving its other connections. The Flask
+    # app and request contexts go along. Elsewhere the function is simply called.
+    if not is_cooperative():
+        return function(*args, **kwargs)
+    from gevent import get_hub
+    return get_hub().threadpool.apply(copy_context().run, (function, *args), kwargs)
@@ -1,43 +1,103 @@
 import json
+import time
+from collections import OrderedDict
+from datetime import datetime
 
 import pandas as pd
-from flask import Blueprint, request, jsonify
-from io import BytesIO
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context, url_for
+from sqlalchemy import update, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import defer, joinedload
 
-from werkzeug.datastructures import FileStorage
+from apps.core.celery import do_analyze, do_profile_cohorts, do_build_cohort_cube, analyze_from_cohort_cube, \
+    do_append_event_log, set_job_state, get_log_routing, release_stale_append
+from apps.metrics.models import db, EventLog, AnalyzeResult, AnalyzeJob, CohortCube, PRUNE_BY_KEYS
 
-from apps.core.celery import do_analyze
-from apps.metrics.models import db, EventLog, AnalyzeResult
-
-from apps.metrics import EventLogIDs, read_event_log, analysis_waiting_time, \
-    analysis_process_time, cluster_traces, store_event_log, get_cohorts, generate_transition_difference_table_rows
+from apps.core.offload import run_blocking
+from apps.metrics import EventLogIDs, store_event_log_stream, ingest_event_log, get_analysis_cache_key, \
+    get_cohort_cube_cache_key, get_event_log_columns, get_csv_columns, \
+    generate_transition_difference_table_rows, sort_transition_difference_table_rows, load_event_log, \
+    load_enablement_times, get_enablement_configuration_key, get_preview_stats, load_case_variants, \
+    TRANSITION_DIFFERENCE_SORT_KEYS
 
 blue_print = Blueprint('core', __name__, url_prefix='/api/v1/core')
 
+TRANSITION_DIFFERENCE_TABLE_CACHE_SIZE = 256
+# (result_id1, revision1, result_id2, revision2) -> rows, least recently used first
+transition_difference_table_cache = OrderedDict()
 
-@blue_print.route('/waiting-time', methods=['POST'])
-def calculate_waiting():
-    file = request.files['event_log']
-    filter_cohort = request.form['filter_cohort']
-    filter_value = request.form['filter_value']
-    default_log_ids = EventLogIDs()
 
-    event_log = read_event_log(file, 'event_log.csv.gz', default_log_ids)
+def parse_bool(value: str) -> bool:
+    return value.lower() in ('1', 'true', 'yes')
 
-    return analysis_waiting_time(event_log, default_log_ids, filter_cohort, filter_value)
 
+def get_transition_difference_table_rows(result_ids: tuple, analyze_result1: dict, analyze_result2: dict,
+                                         process_time: float, cycle_time: float) -> list:
+    rows = transition_difference_table_cache.get(result_ids)
+    if rows is None:
+        rows = generate_transition_difference_table_rows(
+            analyze_result1["waiting_time_results"],
+            analyze_result2["waiting_time_results"],
+            process_time, cycle_time)
+        # Only complete results are cached, their stored summaries only change with a new revision
+        if analyze_result1["complete"] and analyze_result2["complete"]:
+            transition_difference_table_cache[result_ids] = rows
+            if len(transition_difference_table_cache) > TRANSITION_DIFFERENCE_TABLE_CACHE_SIZE:
+                transition_difference_table_cache.popitem(last=False)
+    else:
+        transition_difference_table_cache.move_to_end(result_ids)
+    return rows
 
-@blue_print.route('/process-time', methods=['POST'])
-def calculate_process():
+
+def get_invalid_option_response(name: str, value: str, allowed) -> tuple:
+    return {'status': 'error', 'message': f'Unknown {name} {value!r}, expected one of: {", ".join(allowed)}'}, 400
+
+
+def get_result_options() -> dict:
+    # details: include activity and trace rows, max_edges/prune_by: keep only the top transitions in the process map
+    return {
+        'details': request.args.get('details', False, type=parse_bool),
+        'max_edges': request.args.get('max_edges', type=int),
+        'prune_by': request.args.get('prune_by', 'frequency'),
+    }
+
+
+def queue_uploaded_analysis():
+    # The uploaded log (default column names, csv or gzipped csv) is stored like /upload does and analysed by the
+    # Celery workers, the response only carries the job: follow /status/<analyze_result_id> and fetch the results
+    # from /results/<analyze_result_id>
     file = request.files['event_log']
     filter_cohort = request.form['filter_cohort']
     filter_value = request.form['filter_value']
     default_log_ids = EventLogIDs()
 
-    event_log = read_event_log(file, 'event_log.csv.gz', default_log_ids)
-    cluster_traces(event_log, default_log_ids)
+    event_log = EventLog(default_log_ids.case, default_log_ids.activity, default_log_ids.start_time,
+                         default_log_ids.end_time, default_log_ids.resource)
+    db.session.add(event_log)
+    db.session.commit()
+    event_log.content_hash = run_blocking(store_event_log_stream, file.stream, event_log.id)
+    db.session.commit()
+    run_blocking(ingest_event_log, event_log)
+
+    analyze_result, created = get_or_create_analyze_result(event_log, filter_cohort, filter_value)
+    if created:
+        do_analyze.apply_async([analyze_result.id], **get_log_routing(event_log.id))
+    return {
+        'log_id': event_log.id,
+        'status_url': url_for('core.get_status', result_id=analyze_result.id),
+        'results_url': url_for('core.get_results', result_id=analyze_result.id),
+        **get_analyze_status(analyze_result.id),
+    }, 202
+
+
+@blue_print.route('/waiting-time', methods=['POST'])
+def calculate_waiting():
+    return queue_uploaded_analysis()
 
-    return analysis_process_time(event_log, default_log_ids, filter_cohort, filter_value)
+
+@blue_print.route('/process-time', methods=['POST'])
+def calculate_process():
+    return queue_uploaded_analysis()
 
 
 @blue_print.route('/analyze', methods=['POST', 'GET'])
@@ -48,27 +108,145 @@ def analyze():
     filter_cohort = request.args['filter_cohort']
     filter_value1 = request.args['filter_value1']
     filter_value2 = request.args['filter_value2']
+    workers = request.args.get('workers', type=int)
 
-    analyze_result1 = AnalyzeResult(event_log_id, filter_cohort, filter_value1)
-    analyze_result2 = AnalyzeResult(event_log_id, filter_cohort, filter_value2)
-    db.session.add(analyze_result1)
-    db.session.add(analyze_result2)
-    db.session.commit()
+    event_log = EventLog.query.filter_by(id=event_log_id).first()
+    release_stale_append(event_log)
+    if event_log.pending_part is not None:
+        return get_appending_response(event_log)
+
+    # preview=true answers right away with estimates from samples of the cases, with exact=true the exact
+    # analysis is started as well and its results replace the preview once done
+    previews = {}
+    if request.args.get('preview', False, type=parse_bool):
+        previews = run_blocking(get_analyze_previews, event_log, filter_cohort, [filter_value1, filter_value2])
+        if not request.args.get('exact', False, type=parse_bool):
+            return previews
 
-    do_analyze.delay(analyze_result1.id, analyze_result2.id)
+    # With the cohort cube built, value sets are merged from it right away instead of analysing the log, unless
+    # cohort_cube=false asks for the analysis. Merged results are kept apart from analysed ones, see AnalyzeResult.
+    cohort_cube = None
+    if request.args.get('cohort_cube', True, type=parse_bool):
+        cohort_cube = CohortCube.query.filter_by(
+            cache_key=get_cohort_cube_cache_key(event_log, filter_cohort), status=AnalyzeJob.DONE).first()
+    from_cohort_cube = cohort_cube is not None
+    analyze_result1, created1 = get_or_create_analyze_result(event_log, filter_cohort, filter_value1, from_cohort_cube)
+    analyze_result2, created2 = get_or_create_analyze_result(event_log, filter_cohort, filter_value2, from_cohort_cube)
+
+    # Results that already exist, or are being computed for an identical request, are shared
+    created_ids = [analyze_result.id for analyze_result, created in
+                   [(analyze_result1, created1), (analyze_result2, created2)] if created]
+    # An append claimed the log after the check above, the jobs are queued again by the next request
+    db.session.refresh(event_log)
+    if event_log.pending_part is not None:
+        set_job_state(created_ids, AnalyzeJob.FAILED, 'queued', 'Events were appended to the log')
+        return get_appending_response(event_log)
+    if from_cohort_cube:
+        for analyze_result_id in created_ids:
+            run_blocking(analyze_from_cohort_cube, analyze_result_id, cohort_cube)
+    elif created_ids:
+        do_analyze.apply_async(created_ids, {'workers': workers}, **get_log_routing(event_log.id))
 
     return {
         "analyze_result1": analyze_result1.id,
-        "analyze_result2": analyze_result2.id
-
+        "analyze_result2": analyze_result2.id,
+        "cached": not created_ids,
+        "cohort_cube": from_cohort_cube,
+        **previews
     }
 
 
+def get_analyze_previews(event_log: EventLog, filter_cohort: str, filter_values: list) -> dict:
+    # Only the case and cohort of every event are loaded for all value sets, each gets an equal share of the time
+    # budget and loads the events of its sampled cases
+    started = time.monotonic()
+    config = current_app.config
+    budget = min(request.args.get('budget', config['PREVIEW_TIME_BUDGET'], type=float),
+                 config['PREVIEW_MAX_TIME_BUDGET'])
+    event_cases = load_event_log(event_log, [event_log.case_id, filter_cohort], categorical_columns=[filter_cohort])
+    # Stored enablement times are used when there are, otherwise they are computed on the samples
+    enablement_times = load_enablement_times(event_log, get_enablement_configuration_key())
+    case_variants = load_case_variants(event_log)
+
+    previews = {}
+    for index, filter_value in enumerate(filter_values, start=1):
+        previews[f"preview{index}"] = get_preview_stats(
+            event_cases, enablement_times, case_variants, event_log, filter_cohort, filter_value,
+            started + budget * index / len(filter_values), config['PREVIEW_SAMPLE_CASES'],
+            config['PREVIEW_CONFIDENCE'], request.args.get('seed', 0, type=int),
+            request.args.get('workers', 1, type=int))
+    previews["preview_seconds"] = time.monotonic() - started
+    return previews
+
+
+@blue_print.route('/analyze-cohort', methods=['POST', 'GET'])
+def analyze_cohort():
+    # Analyses every value of the cohort once, /analyze then answers any value set of it from the stored cube
+    event_log_id = request.args['log_id']
+    filter_cohort = request.args['filter_cohort']
+    workers = request.args.get('workers', type=int)
+
+    event_log = EventLog.query.filter_by(id=event_log_id).first()
+    release_stale_append(event_log)
+    if event_log.pending_part is not None:
+        return get_appending_response(event_log)
+    cache_key = get_cohort_cube_cache_key(event_log, filter_cohort)
+    cohort_cube = CohortCube.query.filter_by(cache_key=cache_key).first()
+    if cohort_cube is None:
+        cohort_cube = CohortCube(event_log.id, filter_cohort, cache_key)
+        db.session.add(cohort_cube)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # A concurrent identical request queued it first
+            db.session.rollback()
+            return CohortCube.query.filter_by(cache_key=cache_key).first().to_dict()
+        do_build_cohort_cube.apply_async([cohort_cube.id], {'workers': workers}, **get_log_routing(event_log.id))
+    elif cohort_cube.status == AnalyzeJob.FAILED:
+        cohort_cube.status = AnalyzeJob.QUEUED
+        cohort_cube.error = None
+        db.session.commit()
+        do_build_cohort_cube.apply_async([cohort_cube.id], {'workers': workers}, **get_log_routing(event_log.id))
+
+    return cohort_cube.to_dict()
+
+
+@blue_print.route('/cohort-cubes/<cohort_cube_id>', methods=['GET'])
+def get_cohort_cube(cohort_cube_id):
+    return CohortCube.query.filter_by(id=cohort_cube_id).first().to_dict()
+
+
+def get_appending_response(event_log: EventLog):
+    # New analyses would race the append task, which deletes and rewrites the stored results of the log
+    return {'status': 'busy', 'id': event_log.id, 'message': 'Events are being appended to the log'}, 409
+
+
+def get_or_create_analyze_result(event_log: EventLog, filter_cohort: str, filter_value: str,
+                                 from_cohort_cube: bool = False):
+    cache_key = get_analysis_cache_key(event_log, filter_cohort, filter_value, from_cohort_cube)
+    analyze_result = AnalyzeResult.query.filter_by(cache_key=cache_key).first()
+    if analyze_result is not None:
+        if analyze_result.job is not None and analyze_result.job.status == AnalyzeJob.FAILED:
+            # Queued again, the analysis that already finished is not repeated
+            analyze_result.job.queue()
+            db.session.commit()
+            return analyze_result, True
+        return analyze_result, False
+
+    analyze_result = AnalyzeResult(event_log.id, filter_cohort, filter_value, cache_key, from_cohort_cube)
+    analyze_result.job = AnalyzeJob()
+    db.session.add(analyze_result)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent identical request created it first, its computation is shared
+        db.session.rollback()
+        return AnalyzeResult.query.filter_by(cache_key=cache_key).first(), False
+    return analyze_result, True
+
+
 @blue_print.route('/upload', methods=['POST'])
 def upload():
-    file = request.get_data()
-    file_data = BytesIO(file)
-
     start_time = request.args['start_time']
     end_time = request.args['end_time']
     resource = request.args['resource']
@@ -79,31 +257,186 @@ def upload():
     db.session.add(event_log)
     db.session.commit()
 
+    # The body is read on the request's greenlet, only the writes are offloaded
+    event_log.content_hash = store_event_log_stream(request.stream, event_log.id, run=run_blocking)
+    db.session.commit()
+    run_blocking(ingest_event_log, event_log)
+    # Cohorts are profiled in the background, fetch them from /cohorts/<log_id>
+    do_profile_cohorts.delay(event_log.id)
+
+    return {
+        'status': 'ok',
+        'id': event_log.id,
+    }
+
+
+@blue_print.route('/append/<log_id>', methods=['POST'])
+def append(log_id):
+    # Appends the csv body (same columns as the uploaded log) to the log, stored results are updated in the
+    # background from the cases the new events belong to
+    workers = request.args.get('workers', type=int)
+    event_log = EventLog.query.filter_by(id=log_id).first()
+    release_stale_append(event_log)
+
+    analyses_in_progress = select(AnalyzeJob.id).join(
+        AnalyzeResult, AnalyzeResult.id == AnalyzeJob.analyze_result_id).where(
+        AnalyzeResult.event_log_id == event_log.id, AnalyzeJob.status.in_([AnalyzeJob.QUEUED, AnalyzeJob.RUNNING]))
+    cubes_in_progress = select(CohortCube.id).where(
+        CohortCube.event_log_id == event_log.id, CohortCube.status.in_([AnalyzeJob.QUEUED, AnalyzeJob.RUNNING]))
+    part = (event_log.parts or 0) + 1
+    # Claimed with one conditional update, of two concurrent appends only one gets the part and no analysis of
+    # the log can start or be running in between
+    claimed = db.session.execute(
+        update(EventLog).where(EventLog.id == event_log.id, EventLog.pending_part.is_(None),
+                               ~analyses_in_progress.exists(), ~cubes_in_progress.exists())
+        .values(pending_part=part, pending_since=datetime.utcnow())).rowcount
+    db.session.commit()
+    if not claimed:
+        return {'status': 'busy', 'id': event_log.id}, 409
+
+    try:
+        part_content_hash = store_event_log_stream(request.stream, event_log.id, part=part, run=run_blocking)
+        if set(get_csv_columns(event_log.id, part)) != set(get_event_log_columns(event_log)):
+            event_log.pending_part = None
+            event_log.pending_since = None
+            db.session.commit()
+            return {'status': 'error', 'id': event_log.id,
+                    'message': 'The appended events must have the columns of the uploaded log'}, 400
+        run_blocking(ingest_event_log, event_log, part=part)
+    except Exception:
+        db.session.rollback()
+        event_log.pending_part = None
+        event_log.pending_since = None
+        db.session.commit()
+        raise
+
+    # Results are served again once the append is folded into them
+    complete_ids = [analyze_result.id for analyze_result in AnalyzeResult.query.filter_by(
+        event_log_id=event_log.id, waiting_time_done=True, process_time_done=True)]
+    set_job_state(complete_ids, AnalyzeJob.QUEUED, 'append')
+    do_append_event_log.apply_async(
+        [event_log.id, part_content_hash], {'workers': workers}, **get_log_routing(event_log.id))
+
+    return {
+        'status': 'queued',
+        'id': event_log.id,
+        'part': part,
+    }
+
+
+@blue_print.route('/cohorts/<log_id>', methods=['GET'])
+def get_event_log_cohorts(log_id):
+    event_log = EventLog.query.filter_by(id=log_id).first()
+    if event_log.cohorts is None:
+        return {'status': 'pending', 'id': event_log.id}
     return {
-        'status': store_event_log(FileStorage(file_data), event_log.id),
+        'status': 'ok',
         'id': event_log.id,
-        'cohorts': get_cohorts(event_log)
+        'cohorts': json.loads(event_log.cohorts)
     }
 
 
+def get_analyze_status(result_id) -> dict:
+    analyze_result = AnalyzeResult.query.options(defer(AnalyzeResult.summary), joinedload(AnalyzeResult.job)) \
+        .filter_by(id=result_id).first()
+    status = analyze_result.get_status()
+    # End the transaction: the connection goes back to the pool and the next read sees the latest state
+    db.session.rollback()
+    return status
+
+
+def is_finished(status: dict) -> bool:
+    return status['status'] in (AnalyzeJob.DONE, AnalyzeJob.FAILED)
+
+
+def get_pending_statuses(*result_ids) -> list:
+    # Results are only serialized once they are done, unless partial results are asked for
+    if request.args.get('partial', False, type=parse_bool):
+        return []
+    statuses = [get_analyze_status(result_id) for result_id in result_ids]
+    return statuses if any(status['status'] != AnalyzeJob.DONE for status in statuses) else []
+
+
+@blue_print.route('/status/<result_id>', methods=['GET'])
+def get_status(result_id):
+    # Long polling: with wait=<seconds> the response is held until the job is done or failed
+    wait = min(request.args.get('wait', 0, type=float), current_app.config['STATUS_MAX_WAIT'])
+    deadline = time.monotonic() + wait
+    status = get_analyze_status(result_id)
+    while not is_finished(status) and time.monotonic() < deadline:
+        time.sleep(current_app.config['STATUS_POLL_INTERVAL'])
+        status = get_analyze_status(result_id)
+    return status
+
+
+@blue_print.route('/status/<result_id>/stream', methods=['GET'])
+def stream_status(result_id):
+    # Server-Sent Events: one event per state change, the stream ends once the job is done or failed
+    poll_interval = current_app.config['STATUS_POLL_INTERVAL']
+    heartbeat_interval = current_app.config['STATUS_HEARTBEAT_INTERVAL']
+
+    def generate():
+        last_state = None
+        last_sent = time.monotonic()
+        while True:
+            status = get_analyze_status(result_id)
+            state = (status['status'], status['stage'], status['waiting_time_done'], status['process_time_done'])
+            if state != last_state:
+                yield f'event: status\ndata: {json.dumps(status)}\n\n'
+                last_state = state
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= heartbeat_interval:
+                # Comment line, keeps proxies from closing an idle connection
+                yield ': heartbeat\n\n'
+                last_sent = time.monotonic()
+            if is_finished(status):
+                return
+            time.sleep(poll_interval)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def get_result_dicts(result_ids: list, options: dict) -> list:
+    # The ORM reads of serializing results, run off the serving greenlet
+    return [AnalyzeResult.query.filter_by(id=result_id).first().to_dict(**options) for result_id in result_ids]
+
+
 @blue_print.route('/results/<result_id>', methods=['GET'])
 def get_results(result_id):
-    analyze_result = AnalyzeResult.query.filter_by(id=result_id).first()
-    return analyze_result.to_dict()
+    options = get_result_options()
+    if options['prune_by'] not in PRUNE_BY_KEYS:
+        return get_invalid_option_response('prune_by', options['prune_by'], PRUNE_BY_KEYS)
+    pending = get_pending_statuses(result_id)
+    if pending:
+        return pending[0], 202
+    return run_blocking(get_result_dicts, [result_id], options)[0]
 
 
 @blue_print.route('/results', methods=['GET'])
 def get_two_results():
     result_id1 = request.args['result_id1']
     result_id2 = request.args['result_id2']
-    analyze_result1 = AnalyzeResult.query.filter_by(id=result_id1).first().to_dict()
-    analyze_result2 = AnalyzeResult.query.filter_by(id=result_id2).first().to_dict()
+    options = get_result_options()
+    if options['prune_by'] not in PRUNE_BY_KEYS:
+        return get_invalid_option_response('prune_by', options['prune_by'], PRUNE_BY_KEYS)
+    sort_by = request.args.get('sort_by')
+    if sort_by is not None and sort_by not in TRANSITION_DIFFERENCE_SORT_KEYS:
+        return get_invalid_option_response('sort_by', sort_by, TRANSITION_DIFFERENCE_SORT_KEYS)
+    pending = get_pending_statuses(result_id1, result_id2)
+    if pending:
+        return {"result1": pending[0], "result2": pending[1]}, 202
+    analyze_result1, analyze_result2 = run_blocking(get_result_dicts, [result_id1, result_id2], options)
     process_time = (analyze_result1["trace_results"]["process_time"] + analyze_result2["trace_results"]["process_time"]) / 2
     cycle_time = (analyze_result1["trace_results"]["cycle_time"] + analyze_result2["trace_results"]["cycle_time"]) / 2
-    transition_difference_table_rows = generate_transition_difference_table_rows(
-        analyze_result1["waiting_time_results"],
-        analyze_result2["waiting_time_results"],
-        process_time, cycle_time)
+    transition_difference_table_rows = get_transition_difference_table_rows(
+        (result_id1, analyze_result1.get("revision"), result_id2, analyze_result2.get("revision")),
+        analyze_result1, analyze_result2, process_time, cycle_time)
+    transition_difference_table_rows = sort_transition_difference_table_rows(
+        transition_difference_table_rows,
+        sort_by,
+        request.args.get('descending', True, type=parse_bool),
+        request.args.get('limit', type=int))
     return {
         "result1": analyze_result1,
         "result2": analyze_result2,
@@ -1,64 +1,110 @@
+import hashlib
 import json
-import os
 import string
+import time
 
+import numpy as np
 import pandas as pd
-import wta
+import pyarrow as pa
 from wta import EventLogIDs
-from werkzeug.datastructures import FileStorage
 from wta.main import run
-import logging
 
-from apps.metrics.models import EventLog, WaitingTimeResult, TraceResult, ActivityResult, Activity
-
-from estimate_start_times.concurrency_oracle import HeuristicsConcurrencyOracle
+from sqlalchemy import insert, select, delete
+
+from apps.metrics.models import db, EventLog, WaitingTimeResult, TraceResult, ActivityResult, Activity, \
+    ResourceResult, ResourceLoadResult, HandoffResult
+from apps.metrics.process_time_analysis import aggregate_process_times, get_trace_bounds, hash_sequences
+from apps.metrics.waiting_time_analysis import aggregate_waiting_times, limit_cpus, WAITING_TIME_COLUMNS
+from apps.metrics.resource_analysis import aggregate_resources, fold_resources, RESOURCE_LOAD_BUCKETS
+from apps.metrics.cohort_cube import label_partials, concat_partials, merge_cohort_cube, fold_aggregates, \
+    fold_cohort_cube, get_empty_aggregates, COHORT_VALUE, COHORT_CUBE_COLUMNS
+from apps.metrics.instrumentation import time_stage, count_items
+from apps.metrics.storage import read_event_log, store_event_log_stream, ingest_event_log, \
+    get_event_log_content_hash, load_event_log, get_event_log_columns, load_enablement_times, store_enablement_times, \
+    store_cohort_cube, load_cohort_cube, restore_categories, get_csv_columns, get_event_log_version, \
+    load_case_variants, store_case_variants, has_enablement_times, load_event_log_rows, load_enablement_time_rows, \
+    load_concurrency_counts, store_concurrency_counts
+from apps.metrics.cache import FrameCache
+from apps.metrics.preview import get_case_strata, get_sample_ranks, get_sample_sizes, estimate_totals, \
+    get_max_strata
+from apps.metrics.streaming import iter_event_log_tables, iter_case_chunks, get_event_log_size, CONTEXT, \
+    STREAMING_CHUNK_ROWS, ROW, case_chunk_files, read_case_chunk, iter_numbered_tables
+from apps.metrics.concurrency import count_concurrency_relations, sum_concurrency_relations, fold_counts, \
+    get_heuristics_concurrency
+
+from estimate_start_times.concurrency_oracle import HeuristicsConcurrencyOracle, ConcurrencyOracle
 from estimate_start_times.config import Configuration
 
+TOO_MANY_COHORT_VALUES = "too many values"
+BULK_INSERT_BATCH_SIZE = 5000
+# Bump whenever a change to the analyses changes their results, stored results of older versions are then recomputed
+ANALYSIS_VERSION = 1
+PREVIEW_SAMPLE_CASES = 200  # cases of the first sample of a preview
+# Columns of the transition difference table rows, any of them can sort the table
+TRANSITION_DIFFERENCE_SORT_KEYS = [
+    'cte_impact', 'number', 'source_activity', 'target_activity', 'present_in', 'average_duration_first',
+    'average_duration_second', 'average_duration_difference', 'relative_frequency_first',
+    'relative_frequency_second', 'relative_frequency_difference',
+]
 
-# function to read the csv file
-def read_event_log(file: FileStorage, log_path: str, log_ids: EventLogIDs) -> pd.DataFrame:
-    # Read the event log
-    # if tmp doesn't exist it will be created
-    if not os.path.exists('tmp'):
-        os.makedirs('tmp')
-
-    file.save(f'tmp/{log_path}')
-    event_log = pd.read_csv(f'tmp/{log_path}')
-    event_log[log_ids.start_time] = pd.to_datetime(event_log[log_ids.start_time], utc=True)
-    event_log[log_ids.end_time] = pd.to_datetime(event_log[log_ids.end_time], utc=True)
-    event_log[log_ids.resource].fillna("NOT_SET", inplace=True)
-    event_log[log_ids.resource] = event_log[log_ids.resource].astype("string")
-    return event_log
-
-
-def store_event_log(file: FileStorage, event_log_id: int) -> str:
-    if not os.path.exists('tmp'):
-        os.makedirs('tmp')
 
-    file.save(f'tmp/event_log_{event_log_id}.csv')
-    return "ok"
-
-
-def get_cohorts(event_log: EventLog) -> dict:
-    event_log_df = pd.read_csv(f'tmp/event_log_{event_log.id}.csv')
+def get_cohorts(event_log: EventLog, max_values: int = 100) -> dict:
     columns = event_log.get_columns()
 
     cohorts = {}
 
-    for column in event_log_df.columns:
-        if column not in columns:
-            cohorts[column] = {
-                str(value): len(event_log_df[event_log_df[column] == value]) for value in event_log_df[column].unique()
-            }
+    for column in [column for column in get_event_log_columns(event_log) if column not in columns]:
+        # One column in memory at a time, one counting pass over it.
+        # Columns with more than max_values distinct values are not listed
+        value_counts = load_event_log(event_log, [column])[column].value_counts(dropna=False, sort=False)
+        if len(value_counts) > max_values:
+            cohorts[column] = TOO_MANY_COHORT_VALUES
+        else:
+            cohorts[column] = {str(value): int(count) for value, count in value_counts.items()}
     return cohorts
 
 
+def get_analysis_cache_key(event_log: EventLog, filter_cohort: str, filter_value: str,
+                           from_cohort_cube: bool = False) -> str:
+    # Identical log contents, column mapping, cohort and value set give identical results. Results are not shared
+    # between logs: appending to a log folds the new events into its results in place. Results merged from a
+    # cohort cube differ from analysed ones and have keys of their own.
+    if event_log.content_hash is None:
+        event_log.content_hash = get_event_log_content_hash(event_log.id)
+    filter_values = sorted(set(filter_value.split(',')))
+    inputs = [ANALYSIS_VERSION, event_log.id, event_log.content_hash, event_log.get_columns(), filter_cohort,
+              filter_values]
+    if from_cohort_cube:
+        inputs.append('cohort_cube')
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+
+def get_cohort_cube_cache_key(event_log: EventLog, filter_cohort: str) -> str:
+    # Same inputs as get_analysis_cache_key, without the value set: a cube covers every value
+    if event_log.content_hash is None:
+        event_log.content_hash = get_event_log_content_hash(event_log.id)
+    return hashlib.sha256(json.dumps(
+        [ANALYSIS_VERSION, event_log.id, event_log.content_hash, event_log.get_columns(), filter_cohort]
+    ).encode()).hexdigest()
+
+
+def get_log_ids(event_log: EventLog) -> EventLogIDs:
+    return EventLogIDs(
+        start_time=event_log.start_time,
+        end_time=event_log.end_time,
+        case=event_log.case_id,
+        activity=event_log.activity,
+        resource=event_log.resource,
+    )
+
+
 # enablement times function
-def add_enablement_times(event_log: pd.DataFrame, log_ids: EventLogIDs):
+@time_stage('enablement_times')
+def add_enablement_times(event_log: pd.DataFrame, log_ids: EventLogIDs, consider_start_times: bool = True):
     # Set up default configuration
     configuration = Configuration(
         log_ids=log_ids,  # Custom the column IDs with this parameter
-        consider_start_times=True  # Consider real parallelism if the start times are available
+        consider_start_times=consider_start_times  # Consider real parallelism if the start times are available
     )
     # Instantiate desired concurrency oracle
     concurrency_oracle = HeuristicsConcurrencyOracle(event_log, configuration)
@@ -66,6 +112,79 @@ def add_enablement_times(event_log: pd.DataFrame, log_ids: EventLogIDs):
     concurrency_oracle.add_enabled_times(event_log)
 
 
+def get_enablement_configuration_key(consider_start_times: bool = True) -> str:
+    return f"heuristics_{'start' if consider_start_times else 'end'}_times"
+
+
+def get_enablement_times(event_log: EventLog, consider_start_times: bool = True, chunk_rows: int = None) -> pd.Series:
+    # The oracle needs the whole log, so its output is computed once per log and configuration and
+    # stored next to the log, row aligned with it. With chunk_rows the log is never loaded whole, see
+    # get_streamed_enablement_times.
+    log_ids = get_log_ids(event_log)
+    configuration_key = get_enablement_configuration_key(consider_start_times)
+    enablement_times = load_enablement_times(event_log, configuration_key)
+    if enablement_times is None:
+        if chunk_rows is not None:
+            enablement_times = get_streamed_enablement_times(event_log, consider_start_times, chunk_rows)
+        else:
+            configuration = Configuration(log_ids=log_ids, consider_start_times=consider_start_times)
+            event_log_df = load_event_log(event_log, event_log.get_columns())
+            counts = sum_concurrency_relations([event_log_df], log_ids)
+            get_concurrency_oracle(counts, configuration).add_enabled_times(event_log_df)
+            store_concurrency_counts(event_log, counts)
+            enablement_times = event_log_df[log_ids.enabled_time]
+        store_enablement_times(event_log, configuration_key, enablement_times)
+    return enablement_times
+
+
+def get_concurrency_oracle(counts: tuple, configuration: Configuration) -> ConcurrencyOracle:
+    # The heuristics oracle of the log from its counts, see sum_concurrency_relations
+    activities, df_counts, l2l_counts = counts
+    return ConcurrencyOracle(get_heuristics_concurrency(
+        activities, df_counts, l2l_counts, configuration.concurrency_thresholds), configuration)
+
+
+@time_stage('enablement_times')
+def get_streamed_enablement_times(event_log: EventLog, consider_start_times: bool = True,
+                                  chunk_rows: int = STREAMING_CHUNK_ROWS) -> pd.Series:
+    # Out-of-core add_enablement_times. The oracle's concurrency relations come from counts over the cases, which
+    # are summed over case-complete chunks (and stored, see get_concurrency_counts), and the enablement time of an
+    # event only depends on the relations and the events of its case, so the chunks are then enriched one at a
+    # time. Only the result is held in memory.
+    log_ids = get_log_ids(event_log)
+    configuration = Configuration(log_ids=log_ids, consider_start_times=consider_start_times)
+    enablement_times = np.full(get_event_log_size(event_log), np.datetime64('NaT'), dtype='datetime64[ns]')
+    with case_chunk_files(lambda: iter_numbered_tables(iter_event_log_tables(event_log, event_log.get_columns())),
+                          event_log, log_ids, chunk_rows) as paths:
+        counts = sum_concurrency_relations((read_case_chunk(path, event_log) for path in paths), log_ids)
+        store_concurrency_counts(event_log, counts)
+        concurrency_oracle = get_concurrency_oracle(counts, configuration)
+        for path in paths:
+            chunk = read_case_chunk(path, event_log)
+            concurrency_oracle.add_enabled_times(chunk)
+            enablement_times[chunk[ROW].to_numpy()] = chunk[log_ids.enabled_time].dt.tz_convert(None).to_numpy()
+    return pd.Series(pd.to_datetime(enablement_times, utc=True), name=log_ids.enabled_time)
+
+
+def get_concurrency_counts(event_log: EventLog, chunk_rows: int = STREAMING_CHUNK_ROWS) -> tuple:
+    # Counts of the oracle's relations over the stored log, see sum_concurrency_relations. Logs enriched before
+    # they were stored along with the enablement times are counted once, a case-complete chunk at a time.
+    counts = load_concurrency_counts(event_log)
+    if counts is None:
+        log_ids = get_log_ids(event_log)
+        with case_chunk_files(lambda: iter_event_log_tables(event_log, event_log.get_columns()), event_log, log_ids,
+                              chunk_rows) as paths:
+            counts = sum_concurrency_relations((read_case_chunk(path, event_log) for path in paths), log_ids)
+        store_concurrency_counts(event_log, counts)
+    return counts
+
+
+def add_stored_enablement_times(event_log_df: pd.DataFrame, event_log: EventLog, consider_start_times: bool = True):
+    # event_log_df has to keep the row order of the stored log (as returned by load_event_log)
+    # By position, .array keeps the datetimes packed where to_numpy would box every one of them
+    event_log_df[get_log_ids(event_log).enabled_time] = get_enablement_times(event_log, consider_start_times).array
+
+
 def get_activity_mapping(event_log: pd.DataFrame, log_ids: EventLog):
     characters = string.printable
     activities = set(event_log[log_ids.activity].unique())
@@ -81,7 +200,71 @@ def get_activity_mapping(event_log: pd.DataFrame, log_ids: EventLog):
     return {activity: characters[index] for index, activity in enumerate(activities)}
 
 
-def cluster_traces(event_log: pd.DataFrame, log_ids: EventLog, filter_cohort: str):
+@time_stage('cluster_traces')
+def cluster_traces(event_log: pd.DataFrame, log_ids: EventLog, filter_cohort: str = None, method: str = 'hash'):
+    if method == 'hash':
+        cluster_traces_by_hash(event_log, log_ids)
+    elif method == 'printable':
+        cluster_traces_by_characters(event_log, log_ids)
+    else:
+        raise ValueError(f"Unknown trace clustering method: {method}")
+
+
+def cluster_traces_by_hash(event_log: pd.DataFrame, log_ids: EventLog):
+    # Same clusters and numbering as cluster_traces_by_characters, without the alphabet limit
+    case_codes, _ = pd.factorize(event_log[log_ids.case_id], sort=True)
+    activity_codes, _ = pd.factorize(event_log[log_ids.activity], use_na_sentinel=False)
+    # Sort the whole log once: by case, then by end and start time inside each case
+    order = np.lexsort((
+        event_log[log_ids.start_time].values,
+        event_log[log_ids.end_time].values,
+        case_codes
+    ))
+    order = order[case_codes[order] >= 0]
+    cluster_ids = np.full(len(event_log), np.nan)
+    if len(order) > 0:
+        sorted_case_codes = case_codes[order]
+        first_rows, _ = get_trace_bounds(sorted_case_codes)
+        # Cases are visited in sorted order, so numbering by first appearance matches the character-based method
+        case_cluster_ids = hash_sequences(activity_codes[order], first_rows) \
+            .groupby(['hash1', 'hash2', 'length'], sort=False).ngroup().to_numpy()
+        case_clusters = np.empty(case_codes.max() + 1)
+        case_clusters[sorted_case_codes[first_rows]] = case_cluster_ids
+        cluster_ids[order] = case_clusters[sorted_case_codes]
+    event_log['cluster_id'] = cluster_ids
+
+
+def get_case_variants(event_log: pd.DataFrame, log_ids: EventLog) -> pd.DataFrame:
+    # Variant of every case as a hash of its activity sequence (case, hash1, hash2, length). Activities are hashed
+    # by name instead of numbered, so variants of different loads of a log compare equal.
+    events = event_log.dropna(subset=[log_ids.case_id])
+    case_codes, case_names = pd.factorize(events[log_ids.case_id], sort=True)
+    activities = events[log_ids.activity].astype('category')
+    activity_hashes = pd.util.hash_array(np.asarray(activities.cat.categories.astype(str), dtype=object))
+    activity_codes = np.append(activity_hashes, np.uint64(0))[activities.cat.codes.to_numpy()] & np.uint64(0xFFFFFFFF)
+    order = np.lexsort((events[log_ids.start_time].values, events[log_ids.end_time].values, case_codes))
+    first_rows, _ = get_trace_bounds(case_codes[order])
+    variants = hash_sequences(activity_codes[order], first_rows)
+    variants.insert(0, 'case', np.asarray(case_names))
+    return variants
+
+
+@time_stage('case_variants')
+def store_event_log_variants(event_log: EventLog):
+    # Stored for the strata of previews, which then do not need to load the whole log
+    event_log_df = load_event_log(
+        event_log, [event_log.case_id, event_log.activity, event_log.start_time, event_log.end_time])
+    store_case_variants(event_log, get_case_variants(event_log_df, event_log))
+
+
+def update_case_variants(case_variants: pd.DataFrame, changed: pd.DataFrame, log_ids: EventLog) -> pd.DataFrame:
+    # Variants with those of the cases in changed (all their events) replaced or added
+    changed_variants = get_case_variants(changed, log_ids)
+    return pd.concat([case_variants[~case_variants['case'].isin(changed_variants['case'])], changed_variants],
+                     ignore_index=True)
+
+
+def cluster_traces_by_characters(event_log: pd.DataFrame, log_ids: EventLog):
     # Get the mapping from activity to character
     mapping = get_activity_mapping(event_log, log_ids)
     # Define mapping from sequence to case IDs
@@ -104,165 +287,661 @@ def cluster_traces(event_log: pd.DataFrame, log_ids: EventLog, filter_cohort: st
         cluster_id += 1
 
 
-def find_in_traces(traces: list, trace: list):
-    for i, t in enumerate(traces):
-        if t == trace:
-            return i
-    return -1
+def analysis_process_time(event_log: pd.DataFrame, default_log_ids: EventLog, filter_cohort: str, filter_value: str):
+    return get_process_time_results(*get_process_time_stats(event_log, default_log_ids, filter_cohort, filter_value))
 
 
-def get_activities_from_trace(unique_activities: dict, trace: list):
-    activities = []
-    for activity in trace:
-        activities.append(unique_activities[activity].activity)
-    return activities
+def get_process_time_stats(event_log: pd.DataFrame, default_log_ids: EventLog, filter_cohort: str, filter_value: str):
+    filtered_event_log = get_filtered_event_log(
+        event_log, filter_cohort, filter_value, get_process_time_columns(default_log_ids) + [filter_cohort],
+        shared=True)
+    return analyze_process_times(filtered_event_log, default_log_ids, filter_cohort)
 
 
-def analysis_process_time(event_log: pd.DataFrame, default_log_ids: EventLog, filter_cohort: str, filter_value: str):
-    filtered_event_log = get_filtered_event_log(event_log, filter_cohort, filter_value)
+def analyze_process_times(filtered_event_log: pd.DataFrame, default_log_ids: EventLog, filter_cohort: str):
     cluster_traces(filtered_event_log, default_log_ids, filter_cohort)
 
-    unique_traces = []
-    unique_activities = {}
-
-    all_traces = []
-    activity_count = 0
-    trace_count = 0
-
-    for cluster_id, cluster_events in filtered_event_log.groupby('cluster_id'):
-        for source_id, events in cluster_events.groupby(filter_cohort):
-            for case_id, activities in events.groupby(default_log_ids.case_id):
-                trace_count += 1
-                current_trace = []
-                is_first = True
-                total_process_time = 0
-                cycle_time_start = None
-                cycle_time_end = None
-                for index, row in activities.iterrows():
-                    activity_count += 1
-                    if is_first:
-                        is_first = False
-                        cycle_time_start = row[default_log_ids.start_time]
-                    cycle_time_end = row[default_log_ids.end_time]
-                    #
-                    # if row[default_log_ids.activity] not in activity_map.keys():
-                    #     activity_map[row[default_log_ids.activity]] = unique_activity_counter
-                    #     activity_index_map[unique_activity_counter] = row[default_log_ids.activity]
-                    #     current_trace.append(unique_activity_counter)
-                    #
-                    #     unique_activity_counter += 1
-                    # else:
-                    #     current_trace.append(activity_map[row[default_log_ids.activity]])
-
-                    process_time = row[default_log_ids.end_time] - row[default_log_ids.start_time]
-                    total_process_time = process_time if total_process_time == 0 else process_time + total_process_time
-
-                    if row[default_log_ids.activity] not in unique_activities.keys():
-                        unique_activities[row[default_log_ids.activity]] = \
-                            ActivityResult(activity=Activity(row[default_log_ids.activity]), count=1,
-                                           pt_total=process_time.total_seconds())
-                    else:
-                        unique_activities[row[default_log_ids.activity]].pt_total += process_time.total_seconds()
-                        unique_activities[row[default_log_ids.activity]].count += 1
-
-                    current_trace.append(row[default_log_ids.activity])
-
-                current_trace_id = find_in_traces(all_traces, current_trace)
-
-                if current_trace_id == -1:
-                    unique_traces.append(
-                        TraceResult(
-                            ct_total=(cycle_time_end - cycle_time_start).total_seconds(),
-                            pt_total=total_process_time.total_seconds(),
-                            count=1,
-                            activities=get_activities_from_trace(unique_activities, current_trace)))
-
-                    all_traces.append(current_trace)
-                else:
-                    unique_traces[current_trace_id].count += 1
-                    unique_traces[current_trace_id].ct_total += (cycle_time_end - cycle_time_start).total_seconds()
-                    unique_traces[current_trace_id].pt_total += total_process_time.total_seconds()
-
-    return list(unique_activities.values()), unique_traces
-
-
-def get_filtered_event_log(event_log, filter_cohort, filter_value):
-    if pd.api.types.is_integer_dtype(event_log[filter_cohort]):
-        filter_value_list = [int(value) for value in filter_value.split(',')]
-    elif pd.api.types.is_float_dtype(event_log[filter_cohort]):
-        filter_value_list = [float(value) for value in filter_value.split(',')]
+    with time_stage('aggregate_process_times'):
+        activity_stats, variant_stats = aggregate_process_times(
+            filtered_event_log, default_log_ids, ['cluster_id', filter_cohort, default_log_ids.case_id])
+    count_items('process_time_events', len(filtered_event_log))
+    count_items('activities', len(activity_stats))
+    count_items('variants', len(variant_stats))
+    return activity_stats, variant_stats
+
+
+def get_process_time_results(activity_stats: pd.DataFrame, variant_stats: pd.DataFrame):
+    activity_results = {
+        activity: ActivityResult(activity=Activity(activity), count=int(count), pt_total=float(pt_total))
+        for activity, count, pt_total in zip(activity_stats.index, activity_stats['count'], activity_stats['pt_total'])
+    }
+    trace_results = [
+        TraceResult(
+            ct_total=float(ct_total),
+            pt_total=float(pt_total),
+            count=int(count),
+            activities=[activity_results[activity].activity for activity in activities])
+        for activities, count, ct_total, pt_total in zip(
+            variant_stats['activities'], variant_stats['count'], variant_stats['ct_total'], variant_stats['pt_total'])
+    ]
+    return list(activity_results.values()), trace_results
+
+
+def get_process_time_columns(event_log: EventLog) -> list:
+    # Process times read neither resources nor enablement times
+    return [event_log.case_id, event_log.activity, event_log.start_time, event_log.end_time]
+
+
+def get_resource_stats(event_log: pd.DataFrame, event_log_meta: EventLog, filter_cohort: str, filter_value: str):
+    filtered_event_log = get_filtered_event_log(
+        event_log, filter_cohort, filter_value, event_log_meta.get_columns(), shared=True)
+    return analyze_resources(filtered_event_log, get_log_ids(event_log_meta))
+
+
+def analyze_resources(filtered_event_log: pd.DataFrame, logs_ids: EventLogIDs,
+                      buckets: int = RESOURCE_LOAD_BUCKETS):
+    # resource_stats, resource_load and handoffs, see aggregate_resources
+    with time_stage('aggregate_resources'):
+        resource_stats, resource_load, handoffs = aggregate_resources(filtered_event_log, logs_ids, buckets)
+    count_items('resources', len(resource_stats))
+    count_items('handoffs', len(handoffs))
+    return resource_stats, resource_load, handoffs
+
+
+def get_filter_values(cohort_values: pd.Series, filter_value: str) -> list:
+    if isinstance(cohort_values.dtype, pd.CategoricalDtype):
+        cohort_values = cohort_values.cat.categories
+    if pd.api.types.is_integer_dtype(cohort_values):
+        return [int(value) for value in filter_value.split(',')]
+    elif pd.api.types.is_float_dtype(cohort_values):
+        return [float(value) for value in filter_value.split(',')]
     else:
-        filter_value_list = [value for value in filter_value.split(',')]
-    return event_log[event_log[filter_cohort].isin(filter_value_list)]
-
-
-def analysis_waiting_time(event_log: pd.DataFrame, event_log_id: EventLog, filter_cohort: str, filter_value: str):
-    logs_ids = EventLogIDs(
-        start_time=event_log_id.start_time,
-        end_time=event_log_id.end_time,
-        case=event_log_id.case_id,
-        activity=event_log_id.activity,
-        resource=event_log_id.resource,
-    )
-
-    add_enablement_times(event_log, logs_ids)
+        return [value for value in filter_value.split(',')]
+
+
+def get_selected_rows(event_log: pd.DataFrame, filter_cohort: str, filter_value: str):
+    # Positions of the value set's events in the log, None when it has all of them
+    selected = event_log[filter_cohort].isin(get_filter_values(event_log[filter_cohort], filter_value)).to_numpy()
+    return None if selected.all() else np.flatnonzero(selected)
+
+
+def get_filtered_event_log(event_log, filter_cohort, filter_value, columns: list = None, shared: bool = False):
+    # Events of the value set, with only the given columns of the log (all by default). The log may be shared
+    # through the worker's event log cache: the kept rows are copied once, so that wta is free to modify what it
+    # is given. With shared, a value set of every event gets a frame sharing the log's columns instead, for our
+    # own analyses that only read them and add columns of their own.
+    rows = get_selected_rows(event_log, filter_cohort, filter_value)
+    if columns is not None:
+        event_log = pd.concat([event_log[column] for column in dict.fromkeys(columns)], axis=1, copy=False)
+    if rows is not None:
+        event_log = event_log.take(rows)
+    elif not shared:
+        event_log = event_log.copy()
+    return remove_unused_categories(event_log)
+
+
+def remove_unused_categories(event_log: pd.DataFrame) -> pd.DataFrame:
+    # Drop the categories of filtered out events so that groupbys downstream do not visit empty groups.
+    # Only the codes of the categorical columns are rebuilt, the other columns are shared.
+    event_log = event_log.copy(deep=False)
+    for column in event_log.select_dtypes('category').columns:
+        event_log[column] = event_log[column].cat.remove_unused_categories()
+    return event_log
 
-    filtered_event_log = get_filtered_event_log(event_log, filter_cohort, filter_value)
-    # cluster_traces(filtered_event_log, event_log_id, filter_cohort)
 
-    wt_analysis = run(log_path=None, log=filtered_event_log, log_ids=logs_ids, group_results=False, parallel_run=False)
+def analysis_waiting_time(event_log: pd.DataFrame, event_log_id: EventLog, filter_cohort: str, filter_value: str,
+                          workers: int = 1):
+    return get_waiting_time_results(
+        get_waiting_time_transitions(event_log, event_log_id, filter_cohort, filter_value, workers))
 
-    waiting_time_results = []
 
-    for source_activity, activities in wt_analysis.groupby('source_activity'):
-        for destination_activity, sub_activities in activities.groupby('destination_activity'):
-            waiting_time_results.append(WaitingTimeResult(
-                source_activity=source_activity,
-                target_activity=destination_activity,
-                count=len(sub_activities),
-                wt_total=sub_activities['wt_total'].sum().total_seconds(),
-                wt_contention=sub_activities['wt_contention'].sum().total_seconds(),
-                wt_batching=sub_activities['wt_batching'].sum().total_seconds(),
-                wt_prioritization=sub_activities['wt_prioritization'].sum().total_seconds(),
-                wt_unavailability=sub_activities['wt_unavailability'].sum().total_seconds(),
-                wt_extraneous=sub_activities['wt_extraneous'].sum().total_seconds(),
-            ))
+def get_waiting_time_transitions(event_log: pd.DataFrame, event_log_id: EventLog, filter_cohort: str,
+                                 filter_value: str, workers: int = 1) -> pd.DataFrame:
+    logs_ids = get_log_ids(event_log_id)
 
-    return waiting_time_results
+    # Logs loaded through add_stored_enablement_times are already enriched
+    if logs_ids.enabled_time not in event_log.columns:
+        add_enablement_times(event_log, logs_ids)
 
+    filtered_event_log = get_filtered_event_log(event_log, filter_cohort, filter_value)
+    # cluster_traces(filtered_event_log, event_log_id, filter_cohort)
 
-def get_waiting_time_result_by_activity(waiting_time_results: list, source_activity: str, target_activity: str):
-    for waiting_time_result in waiting_time_results:
-        if waiting_time_result["source_activity"] == source_activity and \
-                waiting_time_result["target_activity"] == target_activity:
-            return waiting_time_result
-    return None
+    return analyze_waiting_times(filtered_event_log, logs_ids, workers)
+
+
+def run_waiting_time_analysis(filtered_event_log: pd.DataFrame, logs_ids: EventLogIDs,
+                              workers: int = 1) -> pd.DataFrame:
+    # One row per transition of each case. More than one worker turns on the parallel transition analysis of wta,
+    # on at most that many cores.
+    with limit_cpus(workers), time_stage('wta_run'):
+        return run(log_path=None, log=filtered_event_log, log_ids=logs_ids, group_results=False,
+                   parallel_run=workers > 1)
+
+
+def analyze_waiting_times(filtered_event_log: pd.DataFrame, logs_ids: EventLogIDs, workers: int = 1,
+                          case_ids=None) -> pd.DataFrame:
+    # With case_ids, only the transitions of those cases are aggregated, the other events are context
+    wt_analysis = run_waiting_time_analysis(filtered_event_log, logs_ids, workers)
+    if case_ids is not None:
+        wt_analysis = wt_analysis[wt_analysis[logs_ids.case].isin(case_ids)]
+
+    with time_stage('aggregate_waiting_times'):
+        transitions = aggregate_waiting_times(wt_analysis)
+    count_items('waiting_time_events', len(filtered_event_log))
+    count_items('transitions', len(transitions))
+    return transitions
+
+
+def get_case_metrics(event_log_df: pd.DataFrame, log_ids: EventLogIDs, workers: int = 1) -> pd.DataFrame:
+    # Per case the totals that make up a result summary: transitions and their waiting times, process and cycle time
+    # in seconds. Cycle times run from the first to the last event in stored order, like aggregate_process_times.
+    if log_ids.enabled_time not in event_log_df.columns:
+        add_enablement_times(event_log_df, log_ids)
+    wt_analysis = run_waiting_time_analysis(event_log_df, log_ids, workers)
+    waiting_times = wt_analysis.groupby(log_ids.case, observed=True).agg(
+        transitions=('wt_total', 'size'),
+        **{'waiting_time' if column == 'wt_total' else column: (column, 'sum') for column in WAITING_TIME_COLUMNS})
+    for column in waiting_times.columns[1:]:
+        waiting_times[column] = waiting_times[column] / np.timedelta64(1, 's')
+
+    events = pd.DataFrame({
+        'case': event_log_df[log_ids.case],
+        'start': event_log_df[log_ids.start_time],
+        'end': event_log_df[log_ids.end_time],
+        'process_time': (event_log_df[log_ids.end_time] - event_log_df[log_ids.start_time]) / np.timedelta64(1, 's'),
+    })
+    cases = events.groupby('case', sort=False, observed=True).agg(
+        process_time=('process_time', 'sum'), start=('start', 'first'), end=('end', 'last'))
+    cases['cycle_time'] = (cases['end'] - cases['start']) / np.timedelta64(1, 's')
+    return waiting_times.reindex(cases.index, fill_value=0) \
+        .join(cases[['process_time', 'cycle_time']]).astype(float)
+
+
+def get_preview_stats(event_cases: pd.DataFrame, enablement_times: pd.Series, case_variants: pd.DataFrame,
+                      event_log: EventLog, filter_cohort: str, filter_value: str, deadline: float,
+                      sample_cases: int = PREVIEW_SAMPLE_CASES, confidence: float = 0.95, seed: int = 0,
+                      workers: int = 1) -> dict:
+    # Estimates of the summary totals of a value set from a stratified random sample of its cases, strata are
+    # the cohort values and variants (see get_case_variants, cohort values only without them). event_cases has the
+    # case and cohort of every event, enablement_times (optional) are row aligned with it. Only the events of the
+    # sampled cases are loaded. The first sample has at most sample_cases cases, it is doubled while the next round
+    # is expected to end before deadline (time.monotonic()), the last round is returned.
+    # Waiting time components that depend on other cases (contention, prioritization) only see the sampled ones.
+    log_ids = get_log_ids(event_log)
+    filter_values = get_filter_values(event_cases[filter_cohort], filter_value)
+    selected = event_cases[filter_cohort].isin(filter_values).to_numpy()
+    case_cohorts = event_cases[selected].groupby(log_ids.case, sort=False, observed=True)[filter_cohort].first()
+    preview = {'cohort_values': filter_value, 'cases': len(case_cohorts), 'sampled_cases': 0, 'metrics': {}}
+    if len(case_cohorts) == 0:
+        return preview
+
+    if case_variants is None:
+        case_clusters = np.zeros(len(case_cohorts))
+    else:
+        case_clusters = case_variants.groupby(['hash1', 'hash2', 'length'], sort=False).ngroup() \
+            .set_axis(case_variants['case']).reindex(np.asarray(case_cohorts.index)).fillna(-1).to_numpy()
+    strata = get_case_strata(case_cohorts, case_clusters, get_max_strata(sample_cases))
+    stratum_sizes = np.bincount(strata)
+    ranks = get_sample_ranks(strata, seed)
+    cases = min(sample_cases, len(case_cohorts))
+    while True:
+        started = time.monotonic()
+        sampled = ranks < get_sample_sizes(stratum_sizes, cases)[strata]
+        sampled_cases = case_cohorts.index[sampled]
+        sample = load_event_log(event_log, event_log.get_columns() + [filter_cohort],
+                                categorical_columns=[filter_cohort],
+                                filters=[(log_ids.case, 'in', np.asarray(sampled_cases).tolist())])
+        # Cases may have events of other cohort values, only the selected ones are analysed, as in the full
+        # analysis, and they are the rows the enablement times are taken from
+        sample = remove_unused_categories(
+            sample.take(np.flatnonzero(sample[filter_cohort].isin(filter_values).to_numpy())))
+        if enablement_times is not None:
+            rows = np.flatnonzero(selected & event_cases[log_ids.case].isin(sampled_cases).to_numpy())
+            sample[log_ids.enabled_time] = enablement_times.array[rows]
+        case_metrics = get_case_metrics(sample, log_ids, workers).reindex(sampled_cases)
+        preview.update(sampled_cases=int(sampled.sum()), fraction=sampled.sum() / len(case_cohorts),
+                       metrics=estimate_totals(case_metrics, strata[sampled], stratum_sizes, confidence))
+        elapsed = time.monotonic() - started
+        if sampled.all() or time.monotonic() + 2 * elapsed > deadline:
+            return preview
+        cases *= 2
+
+
+def iter_selected_tables(event_log: EventLog, filter_cohort: str, filter_value: str, configuration_key: str = None):
+    # Events of the value set as Arrow tables, see iter_event_log_tables
+    filter_values = None
+    for table in iter_event_log_tables(event_log, event_log.get_columns() + [filter_cohort],
+                                       configuration_key=configuration_key):
+        cohort_values = table.column(filter_cohort).to_pandas()
+        if filter_values is None:
+            filter_values = get_filter_values(cohort_values, filter_value)
+        yield table.filter(pa.array(cohort_values.isin(filter_values).to_numpy()))
+
+
+def get_streamed_analysis_stats(event_log: EventLog, filter_cohort: str, filter_value: str,
+                                chunk_rows: int = STREAMING_CHUNK_ROWS, workers: int = 1,
+                                waiting_times: bool = True, process_times: bool = True):
+    # Out-of-core get_analysis_stats: the value set is analysed one case-complete chunk at a time and the
+    # partial aggregates, which are counts and totals, are summed. Values match the in-memory analysis, rows
+    # may come in another order. Analyses that are not asked for come back empty.
+    log_ids = get_log_ids(event_log)
+    configuration_key = None
+    if waiting_times:
+        # Stored once per log, read along with the events
+        get_enablement_times(event_log, chunk_rows=chunk_rows)
+        configuration_key = get_enablement_configuration_key()
+
+    transitions, activity_stats, variant_stats = [], [], []
+    for chunk in iter_case_chunks(
+            lambda: iter_selected_tables(event_log, filter_cohort, filter_value, configuration_key),
+            event_log, log_ids, [filter_cohort], chunk_rows, with_context=waiting_times):
+        context = chunk[CONTEXT].to_numpy()
+        if waiting_times:
+            # Other chunks' events that overlap this one in time are kept for contention, batching and
+            # prioritization, only the transitions of this chunk's cases are counted
+            transitions.append(analyze_waiting_times(
+                remove_unused_categories(chunk.drop(columns=CONTEXT)), log_ids, workers,
+                chunk[log_ids.case][~context].unique()))
+        if process_times:
+            chunk_activity_stats, chunk_variant_stats = analyze_process_times(
+                remove_unused_categories(chunk.take(np.flatnonzero(~context)).drop(columns=CONTEXT)),
+                event_log, filter_cohort)
+            activity_stats.append(chunk_activity_stats.reset_index())
+            variant_stats.append(chunk_variant_stats)
+        del chunk
+    return merge_chunk_stats(transitions, activity_stats, variant_stats)
+
+
+def merge_chunk_stats(transitions: list, activity_stats: list, variant_stats: list):
+    # Sums of the chunks' aggregates, shaped like analyze_waiting_times and analyze_process_times return them
+    def merge(partials: list, kind: str, keys: list, sort: bool) -> pd.DataFrame:
+        partials = [partial.astype({key: object for key in keys}) for partial in partials if len(partial)]
+        if not partials:
+            return get_empty_aggregates(kind)
+        columns = [column for column in COHORT_CUBE_COLUMNS[kind] if column not in keys + [COHORT_VALUE]]
+        return pd.concat(partials, ignore_index=True).groupby(keys, sort=sort)[columns].sum().reset_index()
+
+    return merge(transitions, 'transitions', ['source_activity', 'destination_activity'], True), \
+        merge(activity_stats, 'activities', ['activity'], False).set_index('activity'), \
+        merge(variant_stats, 'variants', ['activities'], False)
+
+
+def build_cohort_cube(event_log: pd.DataFrame, event_log_meta: EventLog, filter_cohort: str,
+                      workers: int = 1, context: pd.DataFrame = None) -> dict:
+    # Group the log once by the cohort and aggregate every value on its own. Values are analysed as if each
+    # was requested alone, a value set is then answered by merge_cohort_cube without the log. With context, see
+    # get_analysis_stats, the waiting times of every value come from its events in the context.
+    logs_ids = get_log_ids(event_log_meta)
+    if logs_ids.enabled_time not in event_log.columns:
+        add_enablement_times(event_log, logs_ids)
+
+    cohort_event_logs = event_log.groupby(filter_cohort, sort=True, observed=True)
+    context_event_logs = cohort_event_logs if context is None else \
+        context.groupby(filter_cohort, sort=True, observed=True)
+    partials = []
+    for cohort_value, context_event_log in context_event_logs:
+        context_event_log = remove_unused_categories(context_event_log)
+        transitions = analyze_waiting_times(context_event_log, logs_ids, workers)
+        if context is None:
+            activity_stats, variant_stats = analyze_process_times(context_event_log, event_log_meta, filter_cohort)
+        elif cohort_value in cohort_event_logs.groups:
+            activity_stats, variant_stats = analyze_process_times(
+                remove_unused_categories(cohort_event_logs.get_group(cohort_value)), event_log_meta, filter_cohort)
+        else:
+            activity_stats, variant_stats = get_empty_aggregates('activities').set_index('activity'), \
+                get_empty_aggregates('variants')
+        partials.append(label_partials(cohort_value, activity_stats, variant_stats, transitions))
+    return concat_partials(partials)
+
+
+def get_cohort_cube_stats(cube: dict, filter_value: str):
+    # transitions, activity_stats and variant_stats of a value set, see merge_cohort_cube
+    cohort_values = cube['activities'][COHORT_VALUE]
+    return merge_cohort_cube(cube, get_filter_values(cohort_values, filter_value))
+
+
+def get_waiting_time_results(transitions: pd.DataFrame):
+    return [
+        WaitingTimeResult(
+            source_activity=transition.source_activity,
+            target_activity=transition.destination_activity,
+            count=int(transition.count),
+            wt_total=transition.wt_total,
+            wt_contention=transition.wt_contention,
+            wt_batching=transition.wt_batching,
+            wt_prioritization=transition.wt_prioritization,
+            wt_unavailability=transition.wt_unavailability,
+            wt_extraneous=transition.wt_extraneous,
+        )
+        for transition in transitions.itertuples(index=False)
+    ]
+
+
+@time_stage('store_waiting_time_results')
+def store_waiting_time_results(analyze_result_id: int, transitions: pd.DataFrame):
+    # Plain executemany inserts, the ORM unit of work is too slow for logs with many transitions
+    bulk_insert(WaitingTimeResult, transitions
+                .rename(columns={'destination_activity': 'target_activity'})
+                .assign(analyze_result_id=analyze_result_id)
+                [['analyze_result_id', 'source_activity', 'target_activity', 'count'] + WAITING_TIME_COLUMNS]
+                .to_dict('records'))
+
+
+@time_stage('store_process_time_results')
+def store_process_time_results(analyze_result_id: int, activity_stats: pd.DataFrame, variant_stats: pd.DataFrame):
+    bulk_insert(ActivityResult, [
+        {'analyze_result_id': analyze_result_id, 'count': int(count), 'pt_total': float(pt_total)}
+        for count, pt_total in zip(activity_stats['count'], activity_stats['pt_total'])
+    ])
+    # One Activity per distinct activity of the analysis, linked to its result row. Ids of one analysis are
+    # increasing in insertion order, so they line up with the activity_stats rows.
+    activity_result_ids = db.session.execute(
+        select(ActivityResult.id).filter_by(analyze_result_id=analyze_result_id).order_by(ActivityResult.id)
+    ).scalars().all()
+    bulk_insert(Activity, [
+        {'name': activity, 'activity_result_id': activity_result_id}
+        for activity, activity_result_id in zip(activity_stats.index, activity_result_ids)
+    ])
+    bulk_insert(TraceResult, [
+        {'analyze_result_id': analyze_result_id, 'count': int(count), 'ct_total': float(ct_total),
+         'pt_total': float(pt_total), 'activities': ','.join(map(str, activities))}
+        for activities, count, ct_total, pt_total in zip(
+            variant_stats['activities'], variant_stats['count'], variant_stats['ct_total'], variant_stats['pt_total'])
+    ])
+
+
+@time_stage('store_resource_results')
+def store_resource_results(analyze_result_id: int, resource_stats: pd.DataFrame, resource_load: pd.DataFrame,
+                           handoffs: pd.DataFrame):
+    bulk_insert(ResourceResult, resource_stats
+                .astype({'resource': str, 'count': int, 'max_load': int})
+                .assign(analyze_result_id=analyze_result_id)
+                .to_dict('records'))
+    # DateTime columns are naive, times are stored in UTC
+    bulk_insert(ResourceLoadResult, resource_load
+                .astype({'resource': str})
+                .assign(analyze_result_id=analyze_result_id,
+                        start=[start.to_pydatetime()
+                               for start in pd.to_datetime(resource_load['start'], utc=True).dt.tz_convert(None)])
+                .to_dict('records'))
+    bulk_insert(HandoffResult, handoffs
+                .astype({'source_resource': str, 'target_resource': str, 'count': int})
+                .assign(analyze_result_id=analyze_result_id)
+                .to_dict('records'))
+
+
+def delete_resource_results(analyze_result_id: int):
+    for model in [ResourceResult, ResourceLoadResult, HandoffResult]:
+        db.session.execute(delete(model).where(model.analyze_result_id == analyze_result_id))
+
+
+def load_resource_results(analyze_result_id: int):
+    # Stored rows of a result, shaped like aggregate_resources returns them
+    resource_stats = pd.DataFrame(db.session.execute(
+        select(ResourceResult.resource, ResourceResult.count, ResourceResult.work_time, ResourceResult.busy_time,
+               ResourceResult.max_load, ResourceResult.utilization)
+        .filter_by(analyze_result_id=analyze_result_id).order_by(ResourceResult.id)
+    ).all(), columns=['resource', 'count', 'work_time', 'busy_time', 'max_load', 'utilization'])
+    resource_load = pd.DataFrame(db.session.execute(
+        select(ResourceLoadResult.resource, ResourceLoadResult.start, ResourceLoadResult.duration,
+               ResourceLoadResult.busy_time, ResourceLoadResult.mean_load)
+        .filter_by(analyze_result_id=analyze_result_id).order_by(ResourceLoadResult.id)
+    ).all(), columns=['resource', 'start', 'duration', 'busy_time', 'mean_load'])
+    resource_load['start'] = pd.to_datetime(resource_load['start'], utc=True)
+    handoffs = pd.DataFrame(db.session.execute(
+        select(HandoffResult.source_resource, HandoffResult.target_resource, HandoffResult.count,
+               HandoffResult.delay_total)
+        .filter_by(analyze_result_id=analyze_result_id).order_by(HandoffResult.id)
+    ).all(), columns=['source_resource', 'target_resource', 'count', 'delay_total'])
+    return resource_stats, resource_load, handoffs
+
+
+def get_resource_windows(event_log: EventLog, part: int, before: pd.DataFrame, after: pd.DataFrame, columns: list):
+    # Events overlapping the time span of the cases an append touches, before and after it: the earlier events
+    # of the other cases, read with a filter on the stored parts, along with before and after respectively
+    log_ids = get_log_ids(event_log)
+    cohorts = [column for column in columns if column not in event_log.get_columns()]
+    start_times = after[log_ids.start_time].dropna()
+    if len(start_times) == 0:
+        return before[columns], after[columns]
+    window_start = start_times.min()
+    window_end = max(after[log_ids.end_time].max(), start_times.max())
+    # Events ending before they start last from their start, see aggregate_resources
+    unchanged = load_event_log(event_log, columns, range(part), categorical_columns=cohorts, filters=[
+        [(log_ids.end_time, '>=', window_start), (log_ids.start_time, '<=', window_end)],
+        [(log_ids.start_time, '>=', window_start), (log_ids.start_time, '<=', window_end)],
+    ])
+    unchanged = unchanged[~unchanged[log_ids.case].isin(after[log_ids.case].unique())]
+    count_items('resource_window_events', len(unchanged))
+    return [restore_categories(pd.concat([unchanged, changed[columns]], ignore_index=True), event_log, cohorts)
+            for changed in (before, after)]
+
+
+def fold_resource_results(analyze_result_id: int, event_log: EventLog, windows: list, before: pd.DataFrame,
+                          after: pd.DataFrame, filter_cohort: str, filter_value: str, streamed: bool = False):
+    # Replace the stored resource rows of a result by their fold with the changed cases, see fold_resources.
+    # Results of streamed logs have none to start from and stay without them.
+    stored = load_resource_results(analyze_result_id)
+    if len(stored[0]) == 0 and streamed:
+        return
+    log_ids = get_log_ids(event_log)
+    with time_stage('fold_resources'):
+        folded = fold_resources(stored, *[
+            aggregate_resources(get_filtered_event_log(
+                event_log_df, filter_cohort, filter_value, event_log.get_columns(), shared=True), log_ids)
+            for event_log_df in (before, after)
+        ], *[get_filtered_event_log(window, filter_cohort, filter_value, event_log.get_columns(), shared=True)
+             for window in windows], log_ids)
+    delete_resource_results(analyze_result_id)
+    store_resource_results(analyze_result_id, *folded)
+
+
+def bulk_insert(model, rows: list, batch_size: int = BULK_INSERT_BATCH_SIZE):
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(insert(model), rows[start:start + batch_size])
+
+
+def get_appended_content_hash(content_hash: str, part_content_hash: str) -> str:
+    # Hash of the log with the part appended, without reading the earlier parts again
+    return hashlib.sha256(f'{content_hash}{part_content_hash}'.encode()).hexdigest()
+
+
+def get_event_log_delta(event_log: EventLog, part: int, columns: list, chunk_rows: int = None):
+    # Events of the cases that the appended part touches, as they were before the append and as they are with it,
+    # both with enablement times. Only those cases are read from the earlier parts, and their events keep their
+    # stored enablement times. The appended events get theirs from the oracle of the whole log with the part: its
+    # counts are folded like the results, see fold_counts. Also returns the enablement times of the part and the
+    # folded counts, both stored by the caller along with it. chunk_rows: see get_enablement_times.
+    log_ids = get_log_ids(event_log)
+    configuration_key = get_enablement_configuration_key()
+    if not has_enablement_times(event_log, configuration_key):
+        get_enablement_times(event_log, chunk_rows=chunk_rows)
+    counts = get_concurrency_counts(event_log, chunk_rows or STREAMING_CHUNK_ROWS)
+    cohorts = [column for column in columns if column not in event_log.get_columns()]
+    appended = load_event_log(event_log, columns, range(part, part + 1), categorical_columns=cohorts)
+    touched = np.asarray(appended[log_ids.case].dropna().unique()).tolist()
+    before, rows = load_event_log_rows(event_log, columns, range(part) if touched else range(0),
+                                       categorical_columns=cohorts, filters=[(log_ids.case, 'in', touched)])
+    before[log_ids.enabled_time] = load_enablement_time_rows(event_log, configuration_key, rows).array
+    count_items('append_case_events', len(before))
+
+    after = restore_categories(pd.concat([before[columns], appended], ignore_index=True), event_log, cohorts)
+    counts = fold_counts(counts, *[
+        sum_concurrency_relations([event_log_df], log_ids) for event_log_df in (before, after)])
+    get_concurrency_oracle(counts, Configuration(log_ids=log_ids, consider_start_times=True)).add_enabled_times(after)
+    enablement_times = after[log_ids.enabled_time].iloc[len(before):].reset_index(drop=True)
+    after[log_ids.enabled_time] = pd.concat([before[log_ids.enabled_time], enablement_times], ignore_index=True).array
+    return before, after, enablement_times, counts
+
+
+def get_waiting_time_windows(event_log: EventLog, part: int, before: pd.DataFrame, after: pd.DataFrame,
+                             columns: list):
+    # The window of the log whose waiting times an append may change, before and after it: before and after
+    # along with the events of the other cases from the earliest enablement of any event starting after the first
+    # appended one. A waiting time only changes when an appended event runs or is enabled while it waits, which
+    # is before its event starts, and the events it depends on overlap its wait. Waiting times of the window that
+    # do not change come out the same from both windows, even without all events they depend on.
+    log_ids = get_log_ids(event_log)
+    configuration_key = get_enablement_configuration_key()
+    cohorts = [column for column in columns if column not in event_log.get_columns()]
+    columns = columns + [log_ids.enabled_time]
+    first_start = after[log_ids.start_time].iloc[len(before):].min()
+    if pd.isna(first_start):
+        return before[columns], after[columns]
+    later, rows = load_event_log_rows(event_log, [log_ids.start_time], range(part),
+                                      filters=[(log_ids.start_time, '>=', first_start)])
+    later[log_ids.enabled_time] = load_enablement_time_rows(event_log, configuration_key, rows).array
+    enablement_times = pd.concat([event_log_df[log_ids.enabled_time][event_log_df[log_ids.start_time] >= first_start]
+                                  for event_log_df in (later, after)]).dropna()
+    window_start = min(first_start, enablement_times.min()) if len(enablement_times) else first_start
+
+    # Events ending before they start last from their start, see aggregate_resources
+    unchanged, rows = load_event_log_rows(event_log, columns[:-1], range(part), categorical_columns=cohorts, filters=[
+        [(log_ids.end_time, '>=', window_start)], [(log_ids.start_time, '>=', window_start)],
+    ])
+    kept = ~unchanged[log_ids.case].isin(after[log_ids.case].unique()).to_numpy()
+    unchanged = unchanged[kept]
+    unchanged[log_ids.enabled_time] = load_enablement_time_rows(event_log, configuration_key, rows[kept]).array
+    count_items('waiting_time_window_events', len(unchanged))
+    return [restore_categories(pd.concat([unchanged, changed[columns]], ignore_index=True), event_log, cohorts)
+            for changed in (before, after)]
+
+
+def get_analysis_stats(event_log_df: pd.DataFrame, event_log: EventLog, filter_cohort: str, filter_value: str,
+                       workers: int = 1, context: pd.DataFrame = None):
+    # transitions, activity_stats and variant_stats of one value set, event_log_df has the enablement times. With
+    # context, a window of the log holding event_log_df (see get_waiting_time_windows), the transitions are those
+    # of every case in it.
+    filtered_event_log = get_filtered_event_log(event_log_df, filter_cohort, filter_value)
+    filtered_context = filtered_event_log if context is None else \
+        get_filtered_event_log(context, filter_cohort, filter_value)
+    transitions = analyze_waiting_times(filtered_context, get_log_ids(event_log), workers) \
+        if len(filtered_context) else get_empty_aggregates('transitions')
+    if len(filtered_event_log) == 0:
+        activity_stats, variant_stats = get_empty_aggregates('activities').set_index('activity'), \
+            get_empty_aggregates('variants')
+    else:
+        activity_stats, variant_stats = analyze_process_times(filtered_event_log, event_log, filter_cohort)
+    # Stored results keep names as text
+    return transitions.astype({'source_activity': str, 'destination_activity': str}), \
+        activity_stats.set_axis(activity_stats.index.astype(str)), \
+        variant_stats.assign(activities=variant_stats['activities'].map(lambda activities: tuple(map(str, activities))))
+
+
+def load_analysis_stats(analyze_result_id: int):
+    # Stored rows of a result, shaped like get_analysis_stats returns them
+    transitions = pd.DataFrame(db.session.execute(
+        select(WaitingTimeResult.source_activity, WaitingTimeResult.target_activity, WaitingTimeResult.count,
+               *[getattr(WaitingTimeResult, column) for column in WAITING_TIME_COLUMNS])
+        .filter_by(analyze_result_id=analyze_result_id).order_by(WaitingTimeResult.id)
+    ).all(), columns=['source_activity', 'destination_activity', 'count'] + WAITING_TIME_COLUMNS)
+    activity_stats = pd.DataFrame(db.session.execute(
+        select(Activity.name, ActivityResult.count, ActivityResult.pt_total)
+        .join(Activity, Activity.activity_result_id == ActivityResult.id)
+        .filter(ActivityResult.analyze_result_id == analyze_result_id).order_by(ActivityResult.id)
+    ).all(), columns=['activity', 'count', 'pt_total']).set_index('activity')
+    variant_stats = pd.DataFrame(db.session.execute(
+        select(TraceResult.activities, TraceResult.count, TraceResult.ct_total, TraceResult.pt_total)
+        .filter_by(analyze_result_id=analyze_result_id).order_by(TraceResult.id)
+    ).all(), columns=['activities', 'count', 'ct_total', 'pt_total'])
+    variant_stats['activities'] = variant_stats['activities'].map(lambda activities: tuple(activities.split(',')))
+    return transitions, activity_stats, variant_stats
+
+
+def delete_analysis_results(analyze_result_id: int):
+    delete_time_results(analyze_result_id)
+    delete_resource_results(analyze_result_id)
+
+
+def delete_time_results(analyze_result_id: int):
+    db.session.execute(delete(Activity).where(Activity.activity_result_id.in_(
+        select(ActivityResult.id).filter_by(analyze_result_id=analyze_result_id))))
+    for model in [ActivityResult, TraceResult, WaitingTimeResult]:
+        db.session.execute(delete(model).where(model.analyze_result_id == analyze_result_id))
+
+
+def fold_analysis_results(analyze_result_id: int, removed: tuple, added: tuple):
+    # Replace the stored rows of a result by stored - removed + added, removed and added are
+    # get_analysis_stats of the changed cases before and after an append
+    (stored_transitions, stored_activities, stored_variants), \
+        (removed_transitions, removed_activities, removed_variants), \
+        (added_transitions, added_activities, added_variants) = \
+        load_analysis_stats(analyze_result_id), removed, added
+
+    transition_keys = ['source_activity', 'destination_activity']
+    transitions = fold_aggregates(
+        stored_transitions, removed_transitions, added_transitions, transition_keys,
+        ['count'] + WAITING_TIME_COLUMNS).sort_values(transition_keys, ignore_index=True)
+    activity_stats = fold_aggregates(
+        stored_activities.reset_index(), removed_activities.reset_index(), added_activities.reset_index(),
+        ['activity'], ['count', 'pt_total']).set_index('activity')
+    variant_stats = fold_aggregates(
+        stored_variants, removed_variants, added_variants, ['activities'], ['count', 'ct_total', 'pt_total'])
+
+    delete_time_results(analyze_result_id)
+    store_waiting_time_results(analyze_result_id, transitions)
+    store_process_time_results(analyze_result_id, activity_stats, variant_stats)
+
+
+def fold_stored_cohort_cube(cohort_cube_id: int, event_log: EventLog, part: int, filter_cohort: str,
+                            before: pd.DataFrame, after: pd.DataFrame, windows: list, workers: int = 1) -> dict:
+    # The cube of the log with the part appended, stored next to the one of the log without it, see
+    # get_waiting_time_windows for windows
+    cube = fold_cohort_cube(
+        load_cohort_cube(cohort_cube_id, event_log.parts or 0),
+        build_cohort_cube(before, event_log, filter_cohort, workers, windows[0]),
+        build_cohort_cube(after, event_log, filter_cohort, workers, windows[1]))
+    store_cohort_cube(cohort_cube_id, cube, part)
+    return cube
+
+
+def get_average_duration(waiting_time):
+    return waiting_time["wt_total"] / waiting_time["count"] if waiting_time["count"] else 0
 
 
 def generate_transition_difference_table_rows(waiting_time_results1, waiting_time_results2, process_time, cycle_time):
+    # Keyed join on (source, target): transitions of either cohort get a row, a missing side counts as zero
+    waiting_times1 = {(wt["source_activity"], wt["target_activity"]): wt
+                      for wt in waiting_time_results1["waiting_times"]}
+    waiting_times2 = {(wt["source_activity"], wt["target_activity"]): wt
+                      for wt in waiting_time_results2["waiting_times"]}
+    missing = {"wt_total": 0, "count": 0}
+
     rows = []
-    count = 1
-    for waiting_time1 in waiting_time_results1["waiting_times"]:
-        source_activity = waiting_time1["source_activity"]
-        target_activity = waiting_time1["target_activity"]
-        waiting_time2 = get_waiting_time_result_by_activity(waiting_time_results2["waiting_times"], source_activity,
-                                                            target_activity)
-
-        if waiting_time2 is not None:
-            waiting_time = (waiting_time1["wt_total"] + waiting_time2["wt_total"]) / 2
-            rows.append({
-                "cte_impact": round((cycle_time / process_time - (cycle_time - waiting_time) / process_time), 2),
-                "number": count,
-                "source_activity": source_activity,
-                "target_activity": target_activity,
-                "average_duration_first": waiting_time1["wt_total"] / waiting_time1["count"],
-                "average_duration_second": waiting_time2["wt_total"] / waiting_time2["count"],
-                "average_duration_difference": (waiting_time1["wt_total"] / waiting_time1["count"]) -
-                                               (waiting_time2["wt_total"] / waiting_time2["count"]),
-                "relative_frequency_first": waiting_time1["count"] / waiting_time_results1["total_count"],
-                "relative_frequency_second": waiting_time2["count"] / waiting_time_results2["total_count"],
-                "relative_frequency_difference": (waiting_time1["count"] / waiting_time_results1["total_count"]) -
-                                                 (waiting_time2["count"] / waiting_time_results2["total_count"]),
-            })
-            count += 1
+    for count, (source_activity, target_activity) in enumerate({**waiting_times1, **waiting_times2}, start=1):
+        waiting_time1 = waiting_times1.get((source_activity, target_activity), missing)
+        waiting_time2 = waiting_times2.get((source_activity, target_activity), missing)
+        waiting_time = (waiting_time1["wt_total"] + waiting_time2["wt_total"]) / 2
+        relative_frequency_first = waiting_time1["count"] / waiting_time_results1["total_count"] \
+            if waiting_time_results1["total_count"] else 0
+        relative_frequency_second = waiting_time2["count"] / waiting_time_results2["total_count"] \
+            if waiting_time_results2["total_count"] else 0
+        rows.append({
+            "cte_impact": round((cycle_time / process_time - (cycle_time - waiting_time) / process_time), 2)
+            if process_time else None,
+            "number": count,
+            "source_activity": source_activity,
+            "target_activity": target_activity,
+            "present_in": "both" if waiting_time1 is not missing and waiting_time2 is not missing else
+            "first" if waiting_time1 is not missing else "second",
+            "average_duration_first": get_average_duration(waiting_time1),
+            "average_duration_second": get_average_duration(waiting_time2),
+            "average_duration_difference": get_average_duration(waiting_time1) - get_average_duration(waiting_time2),
+            "relative_frequency_first": relative_frequency_first,
+            "relative_frequency_second": relative_frequency_second,
+            "relative_frequency_difference": relative_frequency_first - relative_frequency_second,
+        })
     return rows
+
+
+def sort_transition_difference_table_rows(rows: list, sort_by: str = None, descending: bool = True,
+                                          limit: int = None) -> list:
+    # A limit without an explicit sort keeps the rows with the highest cte_impact
+    if sort_by is None and limit is not None:
+        sort_by = "cte_impact"
+    if sort_by is not None:
+        # Rows without a value (e.g. cte_impact of a log without process time) always go last
+        with_value = sorted((row for row in rows if row[sort_by] is not None),
+                            key=lambda row: row[sort_by], reverse=descending)
+        rows = with_value + [row for row in rows if row[sort_by] is None]
+    return rows[:limit] if limit is not None else rows
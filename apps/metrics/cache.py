@@ -0,0 +1,68 @@
+from collections import OrderedDict
+
+import pandas as pd
+
+from apps.metrics.instrumentation import EVENT_LOG_CACHE_LOOKUPS, EVENT_LOG_CACHE_EVICTIONS, EVENT_LOG_CACHE_BYTES
+
+
+class FrameCache:
+    # Least recently used frames of this process, up to max_bytes in total. Entries are keyed by event log id and
+    # a key of the caller, and tagged with the version of the log they were loaded from: a lookup with another
+    # version drops every entry of the log. Cached frames are shared, callers must not modify them.
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (event log id, key) -> (version, frame, bytes), least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, event_log_id: int, key, version):
+        self.invalidate(event_log_id, version)
+        entry = self.entries.get((event_log_id, key))
+        if entry is None:
+            self.misses += 1
+            EVENT_LOG_CACHE_LOOKUPS.labels(result='miss').inc()
+            return None
+        self.entries.move_to_end((event_log_id, key))
+        self.hits += 1
+        EVENT_LOG_CACHE_LOOKUPS.labels(result='hit').inc()
+        return entry[1]
+
+    def put(self, event_log_id: int, key, version, frame: pd.DataFrame):
+        size = int(frame.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            # Would evict everything else and still not fit
+            return
+        self.remove((event_log_id, key), 'replaced')
+        self.entries[(event_log_id, key)] = (version, frame, size)
+        self.size += size
+        EVENT_LOG_CACHE_BYTES.inc(size)
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)), 'size')
+
+    def get_or_load(self, event_log_id: int, key, version, load) -> pd.DataFrame:
+        frame = self.get(event_log_id, key, version)
+        if frame is None:
+            frame = load()
+            self.put(event_log_id, key, version, frame)
+        return frame
+
+    def invalidate(self, event_log_id: int, version=None):
+        # Entries of the log loaded from another version than the given one, all of them without a version
+        for entry_key in [entry_key for entry_key, (entry_version, _, _) in self.entries.items()
+                          if entry_key[0] == event_log_id and (version is None or entry_version != version)]:
+            self.remove(entry_key, 'invalidated')
+
+    def remove(self, entry_key: tuple, reason: str):
+        entry = self.entries.pop(entry_key, None)
+        if entry is None:
+            return
+        self.size -= entry[2]
+        self.evictions += 1
+        EVENT_LOG_CACHE_BYTES.dec(entry[2])
+        EVENT_LOG_CACHE_EVICTIONS.labels(reason=reason).inc()
+
+    def get_stats(self) -> dict:
+        return {'entries': len(self.entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
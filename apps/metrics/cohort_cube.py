@@ -0,0 +1,73 @@
+import pandas as pd
+
+from apps.metrics.waiting_time_analysis import WAITING_TIME_COLUMNS
+
+COHORT_VALUE = 'cohort_value'
+COHORT_CUBE_COLUMNS = {
+    'activities': ['activity', 'count', 'pt_total', COHORT_VALUE],
+    'variants': ['activities', 'count', 'ct_total', 'pt_total', COHORT_VALUE],
+    'transitions': ['source_activity', 'destination_activity', 'count'] + WAITING_TIME_COLUMNS + [COHORT_VALUE],
+}
+COHORT_CUBE_KINDS = list(COHORT_CUBE_COLUMNS)
+AGGREGATE_KEYS = {
+    'activities': ['activity'],
+    'variants': ['activities'],
+    'transitions': ['source_activity', 'destination_activity'],
+}
+
+
+def label_partials(cohort_value, activity_stats: pd.DataFrame, variant_stats: pd.DataFrame,
+                   transitions: pd.DataFrame) -> dict:
+    # Aggregates of one cohort value as flat frames, tagged with the value they belong to
+    return {
+        'activities': activity_stats.reset_index().assign(**{COHORT_VALUE: cohort_value}),
+        'variants': variant_stats.assign(**{COHORT_VALUE: cohort_value}),
+        'transitions': transitions.assign(**{COHORT_VALUE: cohort_value}),
+    }
+
+
+def concat_partials(partials: list) -> dict:
+    return {
+        kind: pd.concat([partial[kind][columns] for partial in partials], ignore_index=True) if partials
+        else pd.DataFrame(columns=columns)
+        for kind, columns in COHORT_CUBE_COLUMNS.items()
+    }
+
+
+def merge_cohort_cube(cube: dict, cohort_values: list) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame):
+    # Counts and totals are additive, the aggregates of a value set are the sums of its values' aggregates.
+    # Returns transitions, activity_stats and variant_stats shaped like aggregate_waiting_times and
+    # aggregate_process_times return them.
+    selected = {kind: frame[frame[COHORT_VALUE].isin(cohort_values)] for kind, frame in cube.items()}
+    activity_stats = selected['activities'].groupby('activity', sort=False)[['count', 'pt_total']].sum()
+    variant_stats = selected['variants'].groupby('activities', sort=False)[['count', 'ct_total', 'pt_total']] \
+        .sum().reset_index()
+    transitions = selected['transitions'].groupby(['source_activity', 'destination_activity'])[
+        ['count'] + WAITING_TIME_COLUMNS].sum().reset_index()
+    return transitions, activity_stats, variant_stats
+
+
+def get_empty_aggregates(kind: str) -> pd.DataFrame:
+    return pd.DataFrame(columns=[column for column in COHORT_CUBE_COLUMNS[kind] if column != COHORT_VALUE])
+
+
+def fold_aggregates(stored: pd.DataFrame, removed: pd.DataFrame, added: pd.DataFrame, keys: list,
+                    columns: list) -> pd.DataFrame:
+    # stored - removed + added per key. Keys keep the order of their first appearance, stored ones first,
+    # and keys whose count drops to zero are dropped.
+    removed = removed.assign(**{column: -removed[column] for column in columns})
+    # Empty frames are left out, their object columns would turn the sums into objects
+    frames = [frame[keys + columns] for frame in [stored, added, removed] if len(frame)]
+    if not frames:
+        return stored[keys + columns]
+    folded = pd.concat(frames, ignore_index=True).groupby(keys, sort=False, dropna=False)[columns].sum().reset_index()
+    return folded[folded['count'] > 0].reset_index(drop=True)
+
+
+def fold_cohort_cube(cube: dict, removed: dict, added: dict) -> dict:
+    folded = {}
+    for kind, columns in COHORT_CUBE_COLUMNS.items():
+        keys = AGGREGATE_KEYS[kind] + [COHORT_VALUE]
+        folded[kind] = fold_aggregates(
+            cube[kind], removed[kind], added[kind], keys, [column for column in columns if column not in keys])
+    return folded
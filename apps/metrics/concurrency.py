@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+
+def count_concurrency_relations(event_log: pd.DataFrame, log_ids) -> (pd.Series, pd.Series):
+    # Directly-follows counts (A, B: B right after A in a case) and length 2 loop counts (A, B: A-B-A) of the
+    # heuristics concurrency oracle, events of a case in stored order. Counts of disjoint sets of whole cases add up.
+    case_codes, _ = pd.factorize(event_log[log_ids.case])
+    order = np.argsort(case_codes, kind='stable')
+    order = order[case_codes[order] >= 0]
+    cases = case_codes[order]
+    activities = np.asarray(event_log[log_ids.activity], dtype=object)[order]
+    follows = cases[1:] == cases[:-1]
+    df_counts = pd.Series(1, index=pd.MultiIndex.from_arrays(
+        [activities[:-1][follows], activities[1:][follows]])).groupby(level=[0, 1]).sum()
+    loops = follows[1:] & follows[:-1] & (activities[2:] == activities[:-2])
+    l2l_counts = pd.Series(1, index=pd.MultiIndex.from_arrays(
+        [activities[:-2][loops], activities[1:-1][loops]])).groupby(level=[0, 1]).sum()
+    return df_counts, l2l_counts
+
+
+def add_counts(total: pd.Series, counts: pd.Series) -> pd.Series:
+    return counts if total is None else total.add(counts, fill_value=0)
+
+
+def sum_concurrency_relations(event_logs, log_ids) -> (set, pd.Series, pd.Series):
+    # Activities, directly-follows and length 2 loop counts of event logs holding disjoint sets of whole cases
+    activities, df_counts, l2l_counts = set(), None, None
+    for event_log in event_logs:
+        activities.update(event_log[log_ids.activity].dropna().unique())
+        event_log_df_counts, event_log_l2l_counts = count_concurrency_relations(event_log, log_ids)
+        df_counts = add_counts(df_counts, event_log_df_counts)
+        l2l_counts = add_counts(l2l_counts, event_log_l2l_counts)
+    return activities, df_counts, l2l_counts
+
+
+def fold_counts(counts: tuple, removed: tuple, added: tuple) -> tuple:
+    # counts - removed + added of sum_concurrency_relations, removed and added counted on the same cases before and
+    # after they changed. Activities are never removed, pairs whose count drops to zero are.
+    activities, df_counts, l2l_counts = counts
+    folded = [activities | added[0]]
+    for total, removed_counts, added_counts in [(df_counts, removed[1], added[1]), (l2l_counts, removed[2], added[2])]:
+        total = total.add(added_counts, fill_value=0).sub(removed_counts, fill_value=0)
+        folded.append(total[total != 0].astype(np.int64))
+    return tuple(folded)
+
+
+def get_heuristics_concurrency(activities, df_counts: pd.Series, l2l_counts: pd.Series, thresholds) -> dict:
+    # Concurrent activities of every activity, the relations of HeuristicsConcurrencyOracle computed from summed
+    # counts. A and B are concurrent when each directly follows the other, neither dependency is strong and they
+    # do not form a length 2 loop (length 2 loops only count between activities without a strong length 1 loop).
+    df_count = {activity: {} for activity in activities}
+    for (act_a, act_b), count in df_counts.items():
+        df_count[act_a][act_b] = count
+    l2l_count = {activity: {} for activity in activities}
+    for (act_a, act_b), count in l2l_counts.items():
+        l2l_count[act_a][act_b] = count
+    l1l_dependency = {activity: df_count[activity].get(activity, 0) / (df_count[activity].get(activity, 0) + 1)
+                      for activity in activities}
+
+    concurrency = {}
+    for act_a in activities:
+        concurrency[act_a] = set()
+        for act_b in activities:
+            ab, ba = df_count[act_a].get(act_b, 0), df_count[act_b].get(act_a, 0)
+            if act_a == act_b or ab == 0 or ba == 0 or abs(ab - ba) / (ab + ba + 1) >= thresholds.df:
+                continue
+            if l1l_dependency[act_a] < thresholds.l1l and l1l_dependency[act_b] < thresholds.l1l:
+                aba, bab = l2l_count[act_a].get(act_b, 0), l2l_count[act_b].get(act_a, 0)
+                if (aba + bab) / (aba + bab + 1) >= thresholds.l2l:
+                    continue
+            concurrency[act_a].add(act_b)
+    return concurrency
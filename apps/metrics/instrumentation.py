@@ -0,0 +1,62 @@
+import cProfile
+import os
+import time
+from contextlib import contextmanager
+from logging import getLogger
+
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = getLogger(__name__)
+
+# Stages range from milliseconds (aggregations) to many minutes (wta on large logs)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, float('inf'))
+
+STAGE_DURATION = Histogram(
+    'ava_stage_duration_seconds', 'Time spent in one stage of the analysis pipeline', ['stage'],
+    buckets=STAGE_BUCKETS)
+ANALYZED_ITEMS = Counter(
+    'ava_analyzed_items_total', 'Events, activities, variants and transitions handled by the analyses', ['kind'])
+JOBS = Counter('ava_jobs_total', 'Analysis jobs that finished, by final status', ['status'])
+REQUEST_LATENCY = Histogram(
+    'ava_request_duration_seconds', 'Latency of the API routes', ['method', 'endpoint', 'status'])
+EVENT_LOG_CACHE_LOOKUPS = Counter(
+    'ava_event_log_cache_lookups_total', 'Lookups of the worker-local event log caches, by hit or miss', ['result'])
+EVENT_LOG_CACHE_EVICTIONS = Counter(
+    'ava_event_log_cache_evictions_total', 'Frames dropped from the worker-local event log caches', ['reason'])
+EVENT_LOG_CACHE_BYTES = Gauge(
+    'ava_event_log_cache_bytes', 'Bytes held by the worker-local event log caches', multiprocess_mode='livesum')
+
+
+@contextmanager
+def time_stage(stage: str):
+    # Usable as a decorator as well, every call is one observation
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.labels(stage=stage).observe(elapsed)
+        logger.info(f"Stage {stage} took {elapsed:.3f}s")
+
+
+def count_items(kind: str, amount: int):
+    ANALYZED_ITEMS.labels(kind=kind).inc(amount)
+
+
+@contextmanager
+def profile_job(name: str, directory: str = None):
+    # Opt-in: with a directory, the job runs under cProfile and the stats are dumped there,
+    # open them with pstats or snakeviz
+    if not directory:
+        yield
+        return
+    os.makedirs(directory, exist_ok=True)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        path = os.path.join(directory, f'{name}_{time.strftime("%Y%m%d-%H%M%S")}_{os.getpid()}.prof')
+        profiler.dump_stats(path)
+        logger.info(f"Profile of {name} written to {path}")
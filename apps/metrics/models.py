@@ -1,13 +1,20 @@
+import heapq
+import json
+from datetime import datetime
+
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, Float
+from sqlalchemy.orm import relationship, joinedload
 
 db = SQLAlchemy()
 
+# prune_by of a process map -> the transition value it keeps the top ones by
+PRUNE_BY_KEYS = {'frequency': 'total_frequency', 'duration': 'total_duration'}
+
 
 class WaitingTimeResult(db.Model):
     id = Column(Integer, primary_key=True)
-    analyze_result_id = Column(Integer, ForeignKey('analyze_result.id'))
+    analyze_result_id = Column(Integer, ForeignKey('analyze_result.id'), index=True)
     source_activity = Column(String)
     target_activity = Column(String)
     count = Column(Integer)
@@ -54,7 +61,7 @@ class ActivityResult(db.Model):
     id = Column(Integer, primary_key=True)
     count = Column(Integer, nullable=False)
     pt_total = Column(Integer, nullable=False)
-    analyze_result_id = Column(Integer, ForeignKey('analyze_result.id'))
+    analyze_result_id = Column(Integer, ForeignKey('analyze_result.id'), index=True)
 
     activity = relationship("Activity", back_populates="activity_result", uselist=False)
     analyze_result = relationship("AnalyzeResult", back_populates="activity_results")
@@ -79,7 +86,7 @@ class ActivityResult(db.Model):
 class Activity(db.Model):
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
-    activity_result_id = Column(Integer, ForeignKey('activity_result.id'))
+    activity_result_id = Column(Integer, ForeignKey('activity_result.id'), index=True)
 
     # trace_result_activities = relationship("TraceResultActivity", back_populates="activity")
     activity_result = relationship("ActivityResult", back_populates="activity", uselist=False)
@@ -107,7 +114,7 @@ class TraceResult(db.Model):
     count = Column(Integer, nullable=False)
     ct_total = Column(Integer, nullable=False)
     pt_total = Column(Integer, nullable=False)
-    analyze_result_id = Column(Integer, ForeignKey('analyze_result.id'))
+    analyze_result_id = Column(Integer, ForeignKey('analyze_result.id'), index=True)
     activities = Column(String)  # list of strings
 
     # activities = relationship(
@@ -140,124 +147,403 @@ class TraceResult(db.Model):
         return f'<TraceResult {self.id}>'
 
 
-def get_process_map(waiting_time_results, wt_total_count, activity_results, pt_total_count):
-    process_map = [{'name': 'start', 'transitions': []}, {'name': 'end', 'transitions': []}]
-    source_activities = []
-    target_activities = []
+class ResourceResult(db.Model):
+    id = Column(Integer, primary_key=True)
+    analyze_result_id = Column(Integer, ForeignKey('analyze_result.id'), index=True)
+    resource = Column(String)
+    count = Column(Integer, nullable=False)
+    work_time = Column(Float, nullable=False)  # sum of the durations of the resource's events
+    busy_time = Column(Float, nullable=False)  # time with at least one of them in progress
+    max_load = Column(Integer, nullable=False)  # most events in progress at once
+    utilization = Column(Float, nullable=False)  # busy_time over the time span of the analysed events
+
+    analyze_result = relationship("AnalyzeResult", back_populates="resource_results")
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'resource': self.resource,
+            'count': self.count,
+            'work_time': self.work_time,
+            'busy_time': self.busy_time,
+            'max_load': self.max_load,
+            'utilization': self.utilization,
+        }
+
+    def __init__(self, resource, count, work_time, busy_time, max_load, utilization):
+        self.resource = resource
+        self.count = count
+        self.work_time = work_time
+        self.busy_time = busy_time
+        self.max_load = max_load
+        self.utilization = utilization
+
+    def __repr__(self):
+        return f'<ResourceResult {self.id}>'
+
+
+class ResourceLoadResult(db.Model):
+    # One time bucket of a resource's load series
+    id = Column(Integer, primary_key=True)
+    analyze_result_id = Column(Integer, ForeignKey('analyze_result.id'), index=True)
+    resource = Column(String)
+    start = Column(DateTime, nullable=False)  # naive UTC
+    duration = Column(Float, nullable=False)
+    busy_time = Column(Float, nullable=False)
+    mean_load = Column(Float, nullable=False)  # events in progress on average over the bucket
+
+    analyze_result = relationship("AnalyzeResult", back_populates="resource_load_results")
 
-    activity_indices = [activity_result.activity.name for activity_result in activity_results]
+    def to_dict(self):
+        return {
+            'resource': self.resource,
+            'start': self.start.isoformat(),
+            'duration': self.duration,
+            'busy_time': self.busy_time,
+            'mean_load': self.mean_load,
+        }
+
+    def __init__(self, resource, start, duration, busy_time, mean_load):
+        self.resource = resource
+        self.start = start
+        self.duration = duration
+        self.busy_time = busy_time
+        self.mean_load = mean_load
+
+    def __repr__(self):
+        return f'<ResourceLoadResult {self.id}>'
+
+
+class HandoffResult(db.Model):
+    id = Column(Integer, primary_key=True)
+    analyze_result_id = Column(Integer, ForeignKey('analyze_result.id'), index=True)
+    source_resource = Column(String)
+    target_resource = Column(String)
+    count = Column(Integer, nullable=False)
+    delay_total = Column(Float, nullable=False)
+
+    analyze_result = relationship("AnalyzeResult", back_populates="handoff_results")
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'source_resource': self.source_resource,
+            'target_resource': self.target_resource,
+            'count': self.count,
+            'delay_total': self.delay_total,
+        }
+
+    def __init__(self, source_resource, target_resource, count, delay_total):
+        self.source_resource = source_resource
+        self.target_resource = target_resource
+        self.count = count
+        self.delay_total = delay_total
+
+    def __repr__(self):
+        return f'<HandoffResult {self.id}>'
+
+
+def get_transition_value(wt, wt_total_count):
+    return {
+        'average_duration': wt.wt_total / wt.count,
+        'total_duration': wt.wt_total,
+        'total_frequency': wt.count,
+        'relative_frequency': wt.count / wt_total_count
+    }
+
+
+def get_activity_value(activity_result, pt_total_count):
+    return {
+        'average_duration': activity_result.pt_total / activity_result.count,
+        'total_duration': activity_result.pt_total,
+        'total_frequency': activity_result.count,
+        'relative_frequency': activity_result.count / pt_total_count
+    }
+
+
+def get_process_map(waiting_time_results, wt_total_count, activity_results, pt_total_count):
+    # One pass over the transitions, nodes are indexed by activity name.
+    # Activities have no value yet while only the waiting time analysis is done.
+    activity_results = {activity_result.activity.name: activity_result for activity_result in activity_results}
+    nodes = {}
+    targets = {}  # ordered set
 
     for wt in waiting_time_results:
-        source_activities.append(wt.source_activity)
-        target_activities.append(wt.target_activity)
-        if wt.source_activity not in [activity['name'] for activity in process_map]:
-            activity_result = activity_results[activity_indices.index(wt.source_activity)]
-            process_map.append({
+        node = nodes.get(wt.source_activity)
+        if node is None:
+            node = nodes[wt.source_activity] = {
                 'name': wt.source_activity,
-                'transitions': [{
-                    'target': wt.target_activity, 'value': {
-                        'average_duration': wt.wt_total / wt.count,
-                        'total_duration': wt.wt_total,
-                        'total_frequency': wt.count,
-                        'relative_frequency': wt.count / wt_total_count
-                    }
-                }],
-                'value': {
-                    'average_duration': activity_result.pt_total / activity_result.count,
-                    'total_duration': activity_result.pt_total,
-                    'total_frequency': activity_result.count,
-                    'relative_frequency': activity_result.count / pt_total_count
-                }
-            })
-        else:
-            process_map[[activity['name'] for activity in process_map].index(wt.source_activity)]['transitions'].\
-                append({'target': wt.target_activity, 'value': {
-                    'average_duration': wt.wt_total / wt.count,
-                    'total_duration': wt.wt_total,
-                    'total_frequency': wt.count,
-                    'relative_frequency': wt.count / wt_total_count
-            }})
-
-    for activity in source_activities:
-        if activity not in target_activities:
-            process_map[0]['transitions'].append({'target': activity, 'value': ''})
-
-    for activity in target_activities:
-        if activity not in source_activities:
-            activity_result = activity_results[activity_indices.index(activity)]
-            process_map.append({
-                'name': activity,
-                'transitions': [{'target': 'end', 'value': ''}],
-                'value': {
-                    'average_duration': activity_result.pt_total / activity_result.count,
-                    'total_duration': activity_result.pt_total,
-                    'total_frequency': activity_result.count,
-                    'relative_frequency': activity_result.count / pt_total_count
-                }
-            })
-
-    return process_map
+                'transitions': [],
+                'value': get_activity_value(activity_results[wt.source_activity], pt_total_count)
+                if wt.source_activity in activity_results else ''
+            }
+        node['transitions'].append({'target': wt.target_activity, 'value': get_transition_value(wt, wt_total_count)})
+        targets[wt.target_activity] = None
+
+    start = {'name': 'start', 'transitions': [
+        {'target': activity, 'value': ''} for activity in nodes if activity not in targets
+    ]}
+    end = {'name': 'end', 'transitions': []}
+    end_nodes = [{
+        'name': activity,
+        'transitions': [{'target': 'end', 'value': ''}],
+        'value': get_activity_value(activity_results[activity], pt_total_count)
+        if activity in activity_results else ''
+    } for activity in targets if activity not in nodes]
+
+    return [start, end] + list(nodes.values()) + end_nodes
+
+
+def prune_process_map(process_map, max_edges, prune_by='frequency'):
+    # Keep the max_edges transitions with the highest total frequency (or total duration), the activities they
+    # connect, and the start/end edges of those activities
+    key = PRUNE_BY_KEYS[prune_by]
+    edges = [(node, transition) for node in process_map[2:] for transition in node['transitions']
+             if transition['target'] != 'end']
+    kept = sorted(heapq.nlargest(max_edges, range(len(edges)), key=lambda index: edges[index][1]['value'][key]))
+
+    transitions = {}
+    targets = set()
+    for index in kept:
+        node, transition = edges[index]
+        transitions.setdefault(node['name'], []).append(transition)
+        targets.add(transition['target'])
+
+    nodes = [
+        {**node, 'transitions': transitions.get(node['name']) or [{'target': 'end', 'value': ''}]}
+        for node in process_map[2:] if node['name'] in transitions or node['name'] in targets
+    ]
+    start = {'name': 'start', 'transitions': [
+        {'target': node['name'], 'value': ''} for node in nodes if node['name'] not in targets
+    ]}
+    return [start, {'name': 'end', 'transitions': []}] + nodes
 
 
 class AnalyzeResult(db.Model):
     id = Column(Integer, primary_key=True)
-    event_log_id = Column(Integer, ForeignKey('event_log.id'))
+    event_log_id = Column(Integer, ForeignKey('event_log.id'), index=True)
     cohort = Column(String)
     cohort_values = Column(String)  # list of strings
+    cache_key = Column(String(64), unique=True)  # see apps.metrics.get_analysis_cache_key
+    waiting_time_done = Column(Boolean, nullable=False, default=False)
+    process_time_done = Column(Boolean, nullable=False, default=False)
+    summary = Column(String)  # json of get_summary, stored when both analyses are done
+    revision = Column(Integer, nullable=False, default=0)  # incremented whenever appended events are folded in
+    # Merged from a cohort cube: waiting times are summed over the values' separate analyses and there are no
+    # resource results, so these never stand in for an analysis of the value set (see get_analysis_cache_key)
+    from_cohort_cube = Column(Boolean, nullable=False, default=False)
 
     event_log = relationship("EventLog", back_populates="analyze_result")
+    job = relationship("AnalyzeJob", uselist=False, back_populates="analyze_result")
     waiting_time_results = relationship("WaitingTimeResult")
     activity_results = relationship("ActivityResult")
     trace_results = relationship("TraceResult")
+    resource_results = relationship("ResourceResult", back_populates="analyze_result")
+    resource_load_results = relationship("ResourceLoadResult", back_populates="analyze_result")
+    handoff_results = relationship("HandoffResult", back_populates="analyze_result")
+
+    def get_summary(self):
+        # Totals and process map of the result, one pass over each kind of result row
+        waiting_time_results = self.waiting_time_results
+        activity_results = ActivityResult.query.options(joinedload(ActivityResult.activity)) \
+            .filter_by(analyze_result_id=self.id).all()
+        trace_results = self.trace_results
+
+        waiting_time_totals = dict.fromkeys(
+            ['count', 'wt_total', 'wt_contention', 'wt_batching', 'wt_prioritization', 'wt_unavailability',
+             'wt_extraneous'], 0)
+        for wt in waiting_time_results:
+            for column in waiting_time_totals:
+                waiting_time_totals[column] += getattr(wt, column)
+        activity_totals = dict.fromkeys(['count', 'pt_total'], 0)
+        for ar in activity_results:
+            activity_totals['count'] += ar.count
+            activity_totals['pt_total'] += ar.pt_total
+        trace_totals = dict.fromkeys(['count', 'ct_total', 'pt_total'], 0)
+        for tr in trace_results:
+            trace_totals['count'] += tr.count
+            trace_totals['ct_total'] += tr.ct_total
+            trace_totals['pt_total'] += tr.pt_total
+        resource_results = self.resource_results
+        handoff_results = self.handoff_results
 
-    def to_dict(self):
-        total_waiting_time_count =sum([wt.count for wt in self.waiting_time_results])
-        total_process_time_count = sum([ar.count for ar in self.activity_results])
         return {
             'id': self.id,
             'event_log_id': self.event_log_id,
             'cohort': self.cohort,
             'cohort_values': self.cohort_values,
+            'revision': self.revision,
             'waiting_time_results': {
-                'waiting_time': sum([wt.wt_total for wt in self.waiting_time_results]),
-                'wt_contention': sum([wt.wt_contention for wt in self.waiting_time_results]),
-                'wt_batching': sum([wt.wt_batching for wt in self.waiting_time_results]),
-                'wt_prioritization': sum([wt.wt_prioritization for wt in self.waiting_time_results]),
-                'wt_unavailability': sum([wt.wt_unavailability for wt in self.waiting_time_results]),
-                'wt_extraneous': sum([wt.wt_extraneous for wt in self.waiting_time_results]),
-                'total_count': total_waiting_time_count,
-                'waiting_times': [wt.to_dict() for wt in self.waiting_time_results],
+                'waiting_time': waiting_time_totals['wt_total'],
+                'wt_contention': waiting_time_totals['wt_contention'],
+                'wt_batching': waiting_time_totals['wt_batching'],
+                'wt_prioritization': waiting_time_totals['wt_prioritization'],
+                'wt_unavailability': waiting_time_totals['wt_unavailability'],
+                'wt_extraneous': waiting_time_totals['wt_extraneous'],
+                'total_count': waiting_time_totals['count'],
+                'waiting_times': [wt.to_dict() for wt in waiting_time_results],
             },
             'activity_results': {
-                'process_time': sum([ar.pt_total for ar in self.activity_results]),
-                'total_count': sum([ar.count for ar in self.activity_results]),
-                'activities': [ar.to_dict() for ar in self.activity_results]
+                'process_time': activity_totals['pt_total'],
+                'total_count': activity_totals['count'],
             },
             'trace_results': {
-                'process_time': sum([tr.pt_total for tr in self.trace_results]),
-                'cycle_time': sum([tr.ct_total for tr in self.trace_results]),
-                'ct_efficiency': sum([tr.ct_total for tr in self.trace_results]) / sum(
-                    [tr.pt_total for tr in self.trace_results]),
-                'total_count': sum([tr.count for tr in self.trace_results]),
+                'process_time': trace_totals['pt_total'],
+                'cycle_time': trace_totals['ct_total'],
+                'ct_efficiency': trace_totals['ct_total'] / trace_totals['pt_total']
+                if trace_totals['pt_total'] else None,
+                'total_count': trace_totals['count'],
                 'process_map': get_process_map(
-                    self.waiting_time_results,
-                    total_waiting_time_count,
-                    self.activity_results,
-                    total_process_time_count
+                    waiting_time_results,
+                    waiting_time_totals['count'],
+                    activity_results,
+                    activity_totals['count']
                 ),
-                'traces': [tr.to_dict() for tr in self.trace_results]
+            },
+            # Computed along with the waiting times, empty for results merged from a cohort cube or streamed
+            'resource_results': {
+                'work_time': sum(rr.work_time for rr in resource_results),
+                'busy_time': sum(rr.busy_time for rr in resource_results),
+                'resources': [rr.to_dict() for rr in resource_results],
+                'total_handoffs': sum(hr.count for hr in handoff_results),
+                'handoffs': [hr.to_dict() for hr in handoff_results],
             },
         }
 
-    def __init__(self, event_log_id, cohort, cohort_value):
+    def to_dict(self, details=False, max_edges=None, prune_by='frequency'):
+        # The summary is stored once both analyses are done, otherwise built on the fly
+        result = json.loads(self.summary) if self.summary is not None else self.get_summary()
+        result['complete'] = self.summary is not None
+        result['from_cohort_cube'] = self.from_cohort_cube
+        if max_edges is not None:
+            result['trace_results']['process_map'] = prune_process_map(
+                result['trace_results']['process_map'], max_edges, prune_by)
+        if details:
+            activity_results = ActivityResult.query.options(joinedload(ActivityResult.activity)) \
+                .filter_by(analyze_result_id=self.id).all()
+            result['activity_results']['activities'] = [ar.to_dict() for ar in activity_results]
+            result['trace_results']['traces'] = [tr.to_dict() for tr in self.trace_results]
+            # Summaries stored before resources were analysed have no resource results
+            result.setdefault('resource_results', {})['load'] = [
+                lr.to_dict() for lr in ResourceLoadResult.query.filter_by(analyze_result_id=self.id)
+                .order_by(ResourceLoadResult.id)]
+        return result
+
+    def __init__(self, event_log_id, cohort, cohort_value, cache_key=None, from_cohort_cube=False):
         self.event_log_id = event_log_id
         self.cohort = cohort
         self.cohort_values = cohort_value
+        self.cache_key = cache_key
+        self.revision = 0
+        self.from_cohort_cube = from_cohort_cube
+
+    def get_status(self):
+        waiting_time_done, process_time_done = self.waiting_time_done, self.process_time_done
+        if self.job is not None:
+            status = self.job.to_dict()
+        else:
+            # Results computed before jobs were tracked were stored by the request that created them, whatever
+            # they have is all they will get
+            waiting_time_done = waiting_time_done or \
+                WaitingTimeResult.query.filter_by(analyze_result_id=self.id).first() is not None
+            process_time_done = process_time_done or \
+                ActivityResult.query.filter_by(analyze_result_id=self.id).first() is not None
+            done = self.summary is not None or waiting_time_done or process_time_done
+            status = {
+                'analyze_result_id': self.id,
+                'status': AnalyzeJob.DONE if done else AnalyzeJob.QUEUED,
+                'stage': None,
+            }
+        status['waiting_time_done'] = waiting_time_done
+        status['process_time_done'] = process_time_done
+        return status
 
     def __repr__(self):
         return f'<AnalyzeResults {self.event_log_id}>'
 
 
+class AnalyzeJob(db.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = Column(Integer, primary_key=True)
+    analyze_result_id = Column(Integer, ForeignKey('analyze_result.id'), unique=True, index=True)
+    status = Column(String(16), nullable=False, default=QUEUED)
+    stage = Column(String(32))  # step being computed while running, last step when done or failed
+    error = Column(String)
+    queued_at = Column(DateTime)  # UTC
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    analyze_result = relationship("AnalyzeResult", back_populates="job")
+
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    def to_dict(self):
+        end = self.finished_at or datetime.utcnow()
+        return {
+            'analyze_result_id': self.analyze_result_id,
+            'status': self.status,
+            'stage': self.stage,
+            'error': self.error,
+            'queued_at': self.queued_at.isoformat() if self.queued_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'queued_seconds': ((self.started_at or end) - self.queued_at).total_seconds()
+            if self.queued_at else None,
+            'running_seconds': (end - self.started_at).total_seconds() if self.started_at else None,
+        }
+
+    def queue(self):
+        self.status = self.QUEUED
+        self.stage = None
+        self.error = None
+        self.queued_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+
+    def __init__(self):
+        self.queue()
+
+    def __repr__(self):
+        return f'<AnalyzeJob {self.analyze_result_id} {self.status}>'
+
+
+class CohortCube(db.Model):
+    # Per-value aggregates of every value of a cohort, stored next to the log (see apps.metrics.cohort_cube)
+    id = Column(Integer, primary_key=True)
+    event_log_id = Column(Integer, ForeignKey('event_log.id'), index=True)
+    cohort = Column(String)
+    cache_key = Column(String(64), unique=True)  # see apps.metrics.get_cohort_cube_cache_key
+    status = Column(String(16), nullable=False, default=AnalyzeJob.QUEUED)
+    error = Column(String)
+    cohort_values = Column(String)  # json list of the values found, filled in when done
+
+    event_log = relationship("EventLog")
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'event_log_id': self.event_log_id,
+            'cohort': self.cohort,
+            'status': self.status,
+            'error': self.error,
+            'cohort_values': json.loads(self.cohort_values) if self.cohort_values is not None else None,
+        }
+
+    def __init__(self, event_log_id, cohort, cache_key=None):
+        self.event_log_id = event_log_id
+        self.cohort = cohort
+        self.cache_key = cache_key
+        self.status = AnalyzeJob.QUEUED
+
+    def __repr__(self):
+        return f'<CohortCube {self.event_log_id} {self.cohort}>'
+
+
 class EventLog(db.Model):
     id = Column(Integer, primary_key=True)
     case_id = Column(String(255))
@@ -265,6 +551,11 @@ class EventLog(db.Model):
     start_time = Column(String(255))
     end_time = Column(String(255))
     resource = Column(String(255))
+    content_hash = Column(String(64))  # sha256 of the uploaded csv
+    cohorts = Column(String)  # json, filled in by the cohort profiling task
+    parts = Column(Integer, nullable=False, default=0)  # appended parts, see apps.metrics.storage
+    pending_part = Column(Integer)  # part being appended, no other append starts meanwhile
+    pending_since = Column(DateTime)  # when pending_part was claimed (UTC), see release_stale_append
     analyze_result = relationship("AnalyzeResult")
 
     def to_dict(self):
@@ -283,6 +574,7 @@ class EventLog(db.Model):
         self.start_time = start_time
         self.end_time = end_time
         self.resource = resource
+        self.parts = 0
 
     def get_columns(self):
         return [self.case_id, self.activity, self.start_time, self.end_time, self.resource]
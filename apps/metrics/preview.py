@@ -0,0 +1,77 @@
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+MIN_STRATUM_CASES = 2  # a stratum needs two sampled cases for a variance, smaller strata are pooled
+STRATA_SHARE = 0.25  # at most this share of a first sample goes to the minimum cases of its strata
+
+
+def get_case_strata(case_cohorts, case_clusters, max_strata: int) -> np.ndarray:
+    # One stratum per cohort value and variant cluster, at most max_strata in all. The largest clusters are kept
+    # apart, the others (and clusters with fewer than MIN_STRATUM_CASES cases) are pooled into one stratum per
+    # cohort value. With more cohort values than max_strata, all cases are one stratum.
+    strata = pd.DataFrame({'cohort': np.asarray(case_cohorts), 'cluster': np.asarray(case_clusters)})
+    cohorts = strata['cohort'].nunique(dropna=False)
+    if cohorts >= max_strata:
+        return np.zeros(len(strata), dtype=np.int64)
+    sizes = strata.groupby(['cohort', 'cluster'], dropna=False, sort=False)['cluster'] \
+        .transform('size').to_numpy()
+    # Rank of the cluster among all by size (ties by first case), only the first max_strata - cohorts are kept
+    stratum_ids = strata.groupby(['cohort', 'cluster'], dropna=False, sort=False).ngroup().to_numpy()
+    first_cases = np.unique(stratum_ids, return_index=True)[1]
+    by_size = first_cases[np.lexsort((first_cases, -sizes[first_cases]))]
+    kept = np.zeros(stratum_ids.max() + 1, dtype=bool)
+    kept[stratum_ids[by_size[:max_strata - cohorts]]] = True
+    strata.loc[~kept[stratum_ids] | (sizes < MIN_STRATUM_CASES), 'cluster'] = -1
+    return strata.groupby(['cohort', 'cluster'], dropna=False, sort=False).ngroup().to_numpy()
+
+
+def get_max_strata(sample_cases: int) -> int:
+    # The rest of the first sample is allocated in proportion to the stratum sizes
+    return max(1, int(sample_cases * STRATA_SHARE) // MIN_STRATUM_CASES)
+
+
+def get_sample_ranks(strata: np.ndarray, seed: int) -> np.ndarray:
+    # Random position of every case inside its stratum. The first n cases of a stratum are its sample of size n,
+    # so a larger sample contains the smaller ones.
+    order = np.lexsort((np.random.default_rng(seed).random(len(strata)), strata))
+    sorted_strata = strata[order]
+    first_rows = np.flatnonzero(np.diff(sorted_strata, prepend=-1))
+    ranks = np.empty(len(strata), dtype=np.int64)
+    ranks[order] = np.arange(len(strata)) - np.repeat(first_rows, np.diff(np.append(first_rows, len(strata))))
+    return ranks
+
+
+def get_sample_sizes(stratum_sizes: np.ndarray, cases: int) -> np.ndarray:
+    # MIN_STRATUM_CASES cases of every stratum (all of a smaller one), the rest in proportion to the stratum sizes.
+    # Never more than cases in total as long as there are at most cases // MIN_STRATUM_CASES strata, all cases
+    # once cases reaches their number.
+    minimum = np.minimum(stratum_sizes, MIN_STRATUM_CASES)
+    rest = stratum_sizes - minimum
+    extra = max(0, cases - int(minimum.sum()))
+    return (minimum + np.minimum(rest, extra * rest // max(int(rest.sum()), 1))).astype(int)
+
+
+def estimate_totals(case_values: pd.DataFrame, strata: np.ndarray, stratum_sizes: np.ndarray,
+                    confidence: float) -> dict:
+    # Stratified estimates of the totals of every column over all cases, case_values has one row per sampled
+    # case and strata their strata. Normal confidence intervals with the finite population correction, a
+    # stratum sampled whole adds no variance.
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    grouped = case_values.groupby(strata)
+    sampled = grouped.size()
+    sizes = stratum_sizes[sampled.index]
+    totals = grouped.mean().mul(sizes, axis=0).sum()
+    variances = grouped.var(ddof=1).fillna(0).mul(sizes ** 2 * (1 - sampled / sizes) / sampled, axis=0).sum()
+    cases = stratum_sizes.sum()
+    estimates = {}
+    for column in case_values.columns:
+        total, margin = float(totals[column]), z * float(np.sqrt(variances[column]))
+        estimates[column] = {
+            'total': total,
+            'total_ci': [total - margin, total + margin],
+            'per_case': total / cases,
+            'per_case_ci': [(total - margin) / cases, (total + margin) / cases],
+        }
+    return estimates
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+
+def to_seconds(durations) -> np.ndarray:
+    # Same arithmetic as Timedelta.total_seconds(), NaT becomes NaN
+    return np.asarray(durations) / np.timedelta64(1, 's')
+
+
+def get_trace_bounds(trace_ids: np.ndarray) -> (np.ndarray, np.ndarray):
+    # Rows are sorted by trace, so every trace is one contiguous block [first, last]
+    first_rows = np.flatnonzero(np.diff(trace_ids, prepend=-1))
+    last_rows = np.append(first_rows[1:], len(trace_ids)) - 1
+    return first_rows, last_rows
+
+
+def mix_hash(values: np.ndarray, seed: int) -> np.ndarray:
+    # splitmix64 finalizer, uint64 arithmetic wraps around on purpose
+    with np.errstate(over='ignore'):
+        z = values + np.uint64((0x9E3779B97F4A7C15 * (seed + 1)) % 2 ** 64)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def hash_sequences(codes: np.ndarray, first_rows: np.ndarray) -> pd.DataFrame:
+    # Hash the code sequence of every contiguous block starting at first_rows.
+    # Each (code, position) pair is mixed independently and summed per block, two seeds and the
+    # block length together make collisions between different sequences practically impossible.
+    lengths = np.diff(np.append(first_rows, len(codes)))
+    positions = np.arange(len(codes)) - np.repeat(first_rows, lengths)
+    values = (codes.astype(np.uint64) << np.uint64(32)) | positions.astype(np.uint64)
+    return pd.DataFrame({
+        'hash1': np.add.reduceat(mix_hash(values, 0), first_rows),
+        'hash2': np.add.reduceat(mix_hash(values, 1), first_rows),
+        'length': lengths,
+    })
+
+
+def aggregate_process_times(event_log: pd.DataFrame, log_ids, trace_keys: list) -> (pd.DataFrame, pd.DataFrame):
+    # Returns per-activity (count, pt_total) and per-variant (activities, count, ct_total, pt_total) aggregates.
+    # Activities and variants are ordered by first appearance when visiting the traces sorted by trace_keys,
+    # which is the order the former groupby/iterrows loop produced.
+    if len(event_log) == 0:
+        return pd.DataFrame({'count': [], 'pt_total': []}, index=pd.Index([], name='activity')), \
+            pd.DataFrame({'activities': [], 'count': [], 'ct_total': [], 'pt_total': []})
+
+    events = event_log.dropna(subset=trace_keys).sort_values(trace_keys, kind='mergesort')
+
+    activity_codes, activity_names = pd.factorize(events[log_ids.activity], use_na_sentinel=False)
+    activity_names = np.asarray(activity_names, dtype=object)
+    start_times = events[log_ids.start_time].values
+    end_times = events[log_ids.end_time].values
+    process_times = end_times - start_times
+
+    activity_stats = pd.DataFrame({
+        'count': np.bincount(activity_codes, minlength=len(activity_names)),
+        'pt_total': np.bincount(activity_codes, weights=to_seconds(process_times), minlength=len(activity_names)),
+    }, index=pd.Index(activity_names, name='activity'))
+
+    trace_ids = events.groupby(trace_keys, sort=False, observed=True).ngroup().to_numpy()
+    first_rows, last_rows = get_trace_bounds(trace_ids)
+    cycle_times = to_seconds(end_times[last_rows] - start_times[first_rows])
+    trace_process_times = to_seconds(np.add.reduceat(process_times, first_rows))
+
+    # Hash lookup of each trace's activity code sequence to its variant
+    sequences = [codes.tobytes() for codes in np.split(activity_codes, first_rows[1:])]
+    variant_ids, _ = pd.factorize(np.array(sequences, dtype=object))
+    _, first_traces = np.unique(variant_ids, return_index=True)
+
+    variant_stats = pd.DataFrame({
+        'activities': [
+            tuple(activity_names[activity_codes[first_rows[trace]:last_rows[trace] + 1]]) for trace in first_traces
+        ],
+        'count': np.bincount(variant_ids),
+        'ct_total': np.bincount(variant_ids, weights=cycle_times),
+        'pt_total': np.bincount(variant_ids, weights=trace_process_times),
+    })
+    return activity_stats, variant_stats
@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+
+from apps.metrics.cohort_cube import fold_aggregates
+from apps.metrics.process_time_analysis import to_seconds
+
+RESOURCE_LOAD_BUCKETS = 50  # equal-width time buckets of the load series of each resource
+
+
+def sweep_resource_load(resource_codes: np.ndarray, start_times: np.ndarray, end_times: np.ndarray):
+    # Load (events in progress) of every resource as a step function: one breakpoint per start (+1) and end (-1),
+    # sorted by resource and time, with the load from each breakpoint until the next one of the same resource.
+    # Every start has its end, so the running sum is back at zero at the end of each resource.
+    resources = np.concatenate([resource_codes, resource_codes])
+    times = np.concatenate([start_times, end_times])
+    deltas = np.concatenate([np.ones(len(start_times), dtype=np.int64), -np.ones(len(end_times), dtype=np.int64)])
+    # Ends before starts at the same instant, back to back events do not overlap
+    order = np.lexsort((deltas, times, resources))
+    resources, times, loads = resources[order], times[order], np.cumsum(deltas[order])
+    same_resource = np.append(resources[1:] == resources[:-1], False)
+    durations = np.where(same_resource, np.append(times[1:], times[-1:]) - times, np.timedelta64(0, 'ns'))
+    return resources, times, loads, to_seconds(durations)
+
+
+def integrate_at(resources: np.ndarray, times: np.ndarray, rates: np.ndarray, durations: np.ndarray,
+                 query_resources: np.ndarray, query_times: np.ndarray) -> np.ndarray:
+    # Integral of a step function (rate from each breakpoint on) of every query's resource from its first
+    # breakpoint up to the query time. Breakpoints and queries are ranked on one time axis, so the last breakpoint
+    # of a query's resource before it is found with a single searchsorted.
+    axis = np.unique(np.concatenate([times, query_times]))
+    keys = resources * (len(axis) + 1) + np.searchsorted(axis, times)
+    query_keys = query_resources * (len(axis) + 1) + np.searchsorted(axis, query_times)
+    areas = rates * durations
+    # Integral up to each breakpoint, restarting at every resource
+    cumulative = np.cumsum(areas) - areas
+    first_rows = np.flatnonzero(np.diff(resources, prepend=-1))
+    cumulative -= np.repeat(cumulative[first_rows], np.diff(np.append(first_rows, len(resources))))
+
+    rows = np.searchsorted(keys, query_keys, side='right') - 1
+    found = (rows >= 0) & (resources[np.maximum(rows, 0)] == query_resources)
+    rows = np.maximum(rows, 0)
+    integrals = cumulative[rows] + rates[rows] * to_seconds(query_times - times[rows])
+    return np.where(found, integrals, 0.0)
+
+
+def aggregate_resources(event_log: pd.DataFrame, log_ids, buckets: int = RESOURCE_LOAD_BUCKETS,
+                        edges: np.ndarray = None):
+    # Returns per-resource totals (count, work_time, busy_time, max_load, utilization), the load series of
+    # each resource over equal-width buckets of the log's time span (busy_time and mean_load per bucket) and the
+    # handoffs between resources of consecutive events of a case (count, delay_total). Times in seconds.
+    # edges (datetime64[ns]) replace the buckets of the time span, see fold_resources.
+    # Events without a resource are not attributed to anyone
+    events = event_log.dropna(subset=[log_ids.start_time, log_ids.end_time, log_ids.resource])
+    resource_codes, resource_names = pd.factorize(events[log_ids.resource], sort=True)
+    resource_names = np.asarray(resource_names, dtype=object)
+    start_times = events[log_ids.start_time].values
+    # Events ending before they start are taken as instantaneous
+    end_times = np.maximum(events[log_ids.end_time].values, start_times)
+    if len(events) == 0:
+        return pd.DataFrame(columns=['resource', 'count', 'work_time', 'busy_time', 'max_load', 'utilization']), \
+            pd.DataFrame(columns=['resource', 'start', 'duration', 'busy_time', 'mean_load']), \
+            pd.DataFrame(columns=['source_resource', 'target_resource', 'count', 'delay_total'])
+
+    resources, times, loads, durations = sweep_resource_load(resource_codes, start_times, end_times)
+    busy = (loads > 0).astype(np.float64)
+    first_rows = np.flatnonzero(np.diff(resources, prepend=-1))
+    busy_times = np.bincount(resources, weights=busy * durations, minlength=len(resource_names))
+    span = to_seconds(end_times.max() - start_times.min())
+    resource_stats = pd.DataFrame({
+        'resource': resource_names,
+        'count': np.bincount(resource_codes, minlength=len(resource_names)),
+        'work_time': np.bincount(resource_codes, weights=to_seconds(end_times - start_times),
+                                 minlength=len(resource_names)),
+        'busy_time': busy_times,
+        'max_load': np.maximum.reduceat(loads, first_rows),
+        'utilization': busy_times / span if span > 0 else np.zeros(len(resource_names)),
+    })
+
+    # Integrals of the load and of being busy at every bucket edge, differences are the bucket's share
+    if edges is None:
+        edges = start_times.min() + (end_times.max() - start_times.min()) * np.arange(buckets + 1) // buckets
+    buckets = len(edges) - 1
+    query_resources = np.repeat(np.arange(len(resource_names)), buckets + 1)
+    query_times = np.tile(edges, len(resource_names))
+    load_integrals = integrate_at(resources, times, loads.astype(np.float64), durations, query_resources,
+                                  query_times).reshape(len(resource_names), buckets + 1)
+    busy_integrals = integrate_at(resources, times, busy, durations, query_resources,
+                                  query_times).reshape(len(resource_names), buckets + 1)
+    bucket_durations = to_seconds(np.diff(edges))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_loads = np.diff(load_integrals, axis=1) / bucket_durations
+    resource_load = pd.DataFrame({
+        'resource': np.repeat(resource_names, buckets),
+        'start': pd.to_datetime(np.tile(edges[:-1], len(resource_names)), utc=True),
+        'duration': np.tile(bucket_durations, len(resource_names)),
+        'busy_time': np.diff(busy_integrals, axis=1).ravel(),
+        'mean_load': np.nan_to_num(mean_loads.ravel()),
+    })
+
+    # Consecutive events of a case in the order of cluster_traces, a change of resource is a handoff and the
+    # delay runs from the end of the one event to the start of the next
+    case_codes, _ = pd.factorize(events[log_ids.case])
+    order = np.lexsort((start_times, end_times, case_codes))
+    case_codes, ordered_resources = case_codes[order], resource_codes[order]
+    handoff = (case_codes[1:] == case_codes[:-1]) & (ordered_resources[1:] != ordered_resources[:-1])
+    delays = to_seconds(np.maximum(start_times[order][1:] - end_times[order][:-1], np.timedelta64(0, 'ns')))
+    handoffs = pd.DataFrame({
+        'source_resource': resource_names[ordered_resources[:-1][handoff]],
+        'target_resource': resource_names[ordered_resources[1:][handoff]],
+        'delay_total': delays[handoff],
+    }).groupby(['source_resource', 'target_resource']).agg(
+        count=('delay_total', 'size'), delay_total=('delay_total', 'sum')).reset_index()
+    return resource_stats, resource_load, handoffs
+
+
+def get_load_edges(resource_load: pd.DataFrame, start_times: np.ndarray, end_times: np.ndarray) -> np.ndarray:
+    # Bucket edges of a stored load series (first start and last end of the log at either end), extended by
+    # buckets of the same width to the given events, with a shorter bucket at either end as in aggregate_resources
+    starts = np.unique(resource_load['start'].dt.tz_convert(None).to_numpy())
+    last = resource_load['start'].dt.tz_convert(None).to_numpy() == starts[-1]
+    first_edge = starts[0]
+    last_edge = starts[-1] + np.timedelta64(round(resource_load['duration'][last].max() * 1e9), 'ns')
+    edges = [starts, [last_edge]]
+    width = np.diff(starts).max() if len(starts) > 1 else last_edge - first_edge
+    if len(start_times) and start_times.min() < first_edge:
+        if width > np.timedelta64(0, 'ns'):
+            edges.append(first_edge - width * np.arange(1, int(np.ceil((first_edge - start_times.min()) / width))))
+        edges.append([start_times.min()])
+    if len(end_times) and end_times.max() > last_edge:
+        if width > np.timedelta64(0, 'ns'):
+            edges.append(last_edge + width * np.arange(1, int(np.ceil((end_times.max() - last_edge) / width))))
+        edges.append([end_times.max()])
+    return np.unique(np.concatenate(edges).astype('datetime64[ns]'))
+
+
+def fold_resources(stored: tuple, removed: tuple, added: tuple, window_before: pd.DataFrame,
+                   window_after: pd.DataFrame, log_ids) -> tuple:
+    # Resource aggregates after an append, which only adds events. stored are the aggregates before it, removed
+    # and added aggregate_resources of the changed cases before and after it. window_before and window_after hold
+    # every event (of the value set) overlapping the changed cases' time span, before and after the append: busy
+    # times, loads and peaks only change inside it, so their change is that between the two windows.
+    stored_stats, stored_load, stored_handoffs = stored
+    handoffs = fold_aggregates(stored_handoffs, removed[2], added[2], ['source_resource', 'target_resource'],
+                               ['count', 'delay_total'])
+    if len(stored_load) == 0:
+        # Nothing stored, the window after the append holds every event
+        return aggregate_resources(window_after, log_ids)[:2] + (handoffs,)
+
+    window = window_after.dropna(subset=[log_ids.start_time, log_ids.end_time, log_ids.resource])
+    start_times = window[log_ids.start_time].values
+    edges = get_load_edges(stored_load, start_times, np.maximum(window[log_ids.end_time].values, start_times))
+    (stats_before, load_before, _), (stats_after, load_after, _) = [
+        aggregate_resources(window, log_ids, edges=edges) for window in (window_before, window_after)]
+
+    stats = fold_aggregates(stored_stats, stats_before, stats_after, ['resource'], ['count', 'work_time', 'busy_time'])
+    stats['max_load'] = pd.concat([stored_stats, stats_after]).groupby('resource', sort=False)['max_load'].max() \
+        .reindex(stats['resource']).to_numpy()
+    span = to_seconds(edges[-1] - edges[0])
+    stats['utilization'] = stats['busy_time'] / span if span > 0 else 0.0
+
+    # Load series on the extended edges: stored + after - before of the busy time and the load integral
+    def with_work(load: pd.DataFrame, sign: int) -> pd.DataFrame:
+        return pd.DataFrame({
+            'resource': load['resource'],
+            'start': pd.to_datetime(load['start'], utc=True).dt.tz_convert(None).to_numpy(),
+            'busy_time': sign * load['busy_time'],
+            'work': sign * load['mean_load'] * load['duration'],
+        })
+
+    folded = pd.concat([with_work(stored_load, 1), with_work(load_after, 1), with_work(load_before, -1)]) \
+        .groupby(['resource', 'start'])[['busy_time', 'work']].sum()
+    grid = pd.MultiIndex.from_product([stats['resource'], edges[:-1]], names=['resource', 'start'])
+    folded = folded.reindex(grid, fill_value=0.0)
+    durations = np.tile(to_seconds(np.diff(edges)), len(stats))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_loads = folded['work'].to_numpy() / durations
+    resource_load = pd.DataFrame({
+        'resource': grid.get_level_values('resource'),
+        'start': pd.to_datetime(grid.get_level_values('start'), utc=True),
+        'duration': durations,
+        'busy_time': folded['busy_time'].to_numpy(),
+        'mean_load': np.nan_to_num(mean_loads),
+    })
+    return stats, resource_load, handoffs
@@ -0,0 +1,448 @@
+import hashlib
+import itertools
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from werkzeug.datastructures import FileStorage
+
+from apps.metrics.cohort_cube import COHORT_CUBE_KINDS
+from apps.metrics.instrumentation import time_stage
+from apps.metrics.models import EventLog
+
+STORAGE_DIR = 'tmp'
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # bytes read from the request body at a time
+INGEST_CHUNK_ROWS = 250_000  # events parsed at a time when building the columnar copy
+GZIP_MAGIC = b'\x1f\x8b'
+PARQUET_VERSION = '2.6'  # first format version with nanosecond timestamps, older ones truncate (or refuse) them
+ROW_COLUMN = '__row__'  # position of an event in the stored log while it is read, see load_event_log_rows
+ENABLEMENT_ROW_GROUP_ROWS = 100_000  # stored enablement times are read back by row group, see load_enablement_time_rows
+
+
+def get_event_log_path(event_log_id: int, extension: str = 'parquet', part: int = 0) -> str:
+    # Part 0 is the uploaded log, parts 1, 2, ... the events appended to it later
+    suffix = f'_part_{part}' if part else ''
+    return os.path.join(STORAGE_DIR, f'event_log_{event_log_id}{suffix}.{extension}')
+
+
+def get_enablement_times_path(event_log_id: int, configuration_key: str, part: int = 0) -> str:
+    # One file per part, row aligned with it. An append only adds the file of its part.
+    suffix = f'_part_{part}' if part else ''
+    return os.path.join(STORAGE_DIR, f'event_log_{event_log_id}_enabled_{configuration_key}{suffix}.parquet')
+
+
+def get_concurrency_counts_path(event_log_id: int, parts: int = 0) -> str:
+    suffix = f'_parts_{parts}' if parts else ''
+    return os.path.join(STORAGE_DIR, f'event_log_{event_log_id}_concurrency{suffix}.parquet')
+
+
+def get_case_variants_path(event_log_id: int, parts: int = 0) -> str:
+    suffix = f'_parts_{parts}' if parts else ''
+    return os.path.join(STORAGE_DIR, f'event_log_{event_log_id}_variants{suffix}.parquet')
+
+
+def get_cohort_cube_path(cohort_cube_id: int, kind: str, parts: int = 0) -> str:
+    # One file per number of appended parts, an append writes the folded cube next to the one being read
+    suffix = f'_parts_{parts}' if parts else ''
+    return os.path.join(STORAGE_DIR, f'cohort_cube_{cohort_cube_id}_{kind}{suffix}.parquet')
+
+
+def save_parquet(df: pd.DataFrame, path: str, row_group_size: int = None):
+    # Write to a temporary file first, concurrent readers never see a partially written file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    df.to_parquet(tmp_path, index=False, version=PARQUET_VERSION, row_group_size=row_group_size)
+    os.replace(tmp_path, path)
+
+
+def parse_event_log(file_path: str, log_ids, categorical_columns: list = (), columns: list = None) -> pd.DataFrame:
+    # Categorical columns are parsed straight into categories, except the resource whose missing values
+    # are filled in first
+    return set_event_log_types(pd.read_csv(file_path, usecols=columns, dtype={
+        column: 'category' for column in categorical_columns if column != log_ids.resource
+    }), log_ids, categorical_columns)
+
+
+def set_event_log_types(event_log: pd.DataFrame, log_ids, categorical_columns: list = ()) -> pd.DataFrame:
+    event_log[log_ids.start_time] = pd.to_datetime(event_log[log_ids.start_time], utc=True)
+    event_log[log_ids.end_time] = pd.to_datetime(event_log[log_ids.end_time], utc=True)
+    event_log[log_ids.resource] = event_log[log_ids.resource].fillna("NOT_SET").astype("string")
+    for column in categorical_columns:
+        event_log[column] = event_log[column].astype("category")
+    return event_log
+
+
+# function to read the csv file
+@time_stage('read_event_log')
+def read_event_log(file: FileStorage, log_path: str, log_ids, columns: list = None) -> pd.DataFrame:
+    # Read the event log, only the given columns when there are
+    # if tmp doesn't exist it will be created
+    if not os.path.exists(STORAGE_DIR):
+        os.makedirs(STORAGE_DIR)
+
+    file.save(os.path.join(STORAGE_DIR, log_path))
+    categorical_columns = [log_ids.case, log_ids.activity, log_ids.resource]
+    return parse_event_log(os.path.join(STORAGE_DIR, log_path), log_ids, categorical_columns, columns)
+
+
+def store_event_log_stream(stream, event_log_id: int, chunk_size: int = UPLOAD_CHUNK_SIZE, part: int = 0,
+                           run=None) -> str:
+    # Copy the request body to disk chunk by chunk, gzip compressed bodies are decompressed on the way.
+    # Returns the sha256 of the stored (decompressed) csv. The body is read by the caller, decompressing, hashing
+    # and writing each chunk go through run (run_blocking in the web process, called directly by default).
+    if run is None:
+        run = call
+    if not os.path.exists(STORAGE_DIR):
+        os.makedirs(STORAGE_DIR)
+
+    content_hash = hashlib.sha256()
+    head = stream.read(len(GZIP_MAGIC))
+    decompressor = GzipMembersDecompressor() if head == GZIP_MAGIC else None
+    file = run(open, get_event_log_path(event_log_id, 'csv', part), 'wb')
+    try:
+        for chunk in itertools.chain([head], iter(lambda: stream.read(chunk_size), b'')):
+            run(write_chunk, file, content_hash, chunk, decompressor)
+        if decompressor is not None:
+            decompressor.check_eof()
+    finally:
+        run(file.close)
+    return content_hash.hexdigest()
+
+
+def call(function, *args, **kwargs):
+    return function(*args, **kwargs)
+
+
+def write_chunk(file, content_hash, chunk: bytes, decompressor=None):
+    data = chunk if decompressor is None else decompressor.decompress(chunk)
+    content_hash.update(data)
+    file.write(data)
+
+
+class GzipMembersDecompressor:
+    # A gzip file may hold several members one after the other (cat a.gz b.gz, bgzip, pigz), a decompressor
+    # stops at the end of the first one, so every member gets its own
+
+    def __init__(self):
+        self.decompressor = None
+
+    def decompress(self, chunk: bytes) -> bytes:
+        data = []
+        while chunk:
+            if self.decompressor is None:
+                if not GZIP_MAGIC.startswith(chunk[:len(GZIP_MAGIC)]):
+                    raise ValueError('Unexpected data after the last gzip member of the event log')
+                self.decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            data.append(self.decompressor.decompress(chunk))
+            chunk = b''
+            if self.decompressor.eof:
+                chunk, self.decompressor = self.decompressor.unused_data, None
+        return b''.join(data)
+
+    def check_eof(self):
+        if self.decompressor is not None:
+            raise ValueError('The gzip compressed event log is truncated')
+
+
+def get_event_log_content_hash(event_log_id: int, chunk_size: int = UPLOAD_CHUNK_SIZE) -> str:
+    content_hash = hashlib.sha256()
+    with open(get_event_log_path(event_log_id, 'csv'), 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def get_csv_columns(event_log_id: int, part: int = 0) -> list:
+    return pd.read_csv(get_event_log_path(event_log_id, 'csv', part), nrows=0).columns.tolist()
+
+
+def get_part_dtypes(event_log: EventLog) -> dict:
+    # Appended parts are parsed with the types of the uploaded log, so that all parts concatenate cleanly
+    dtypes = {}
+    for field in pq.read_schema(get_event_log_path(event_log.id)):
+        if field.name in (event_log.start_time, event_log.end_time):
+            continue
+        value_type = field.type.value_type if pa.types.is_dictionary(field.type) else field.type
+        if pa.types.is_string(value_type) or pa.types.is_large_string(value_type) or pa.types.is_null(value_type):
+            dtypes[field.name] = np.dtype('object')
+        else:
+            dtypes[field.name] = np.dtype(value_type.to_pandas_dtype())
+    return dtypes
+
+
+def get_csv_dtypes(file_path: str, skip_columns: list, chunk_rows: int) -> dict:
+    # Chunks are parsed independently, so settle one dtype per column up front, the same one a single
+    # read_csv over the whole file would infer: numbers stay numeric, anything mixed is kept as text
+    chunk_dtypes = {}
+    for chunk in pd.read_csv(file_path, chunksize=chunk_rows, usecols=lambda column: column not in skip_columns):
+        for column, dtype in chunk.dtypes.items():
+            chunk_dtypes.setdefault(column, set()).add(dtype)
+    dtypes = {}
+    for column, column_dtypes in chunk_dtypes.items():
+        if len(column_dtypes) == 1:
+            dtypes[column] = column_dtypes.pop()
+        elif all(dtype.kind in 'iuf' for dtype in column_dtypes):
+            dtypes[column] = np.dtype('float64')
+        else:
+            dtypes[column] = np.dtype('object')
+    return dtypes
+
+
+def get_ingest_schema(schema: pa.Schema, categorical_columns: list) -> pa.Schema:
+    # Chunks get as many categories as they happen to see, widen the dictionary indices so every chunk fits
+    for column in categorical_columns:
+        index = schema.get_field_index(column)
+        schema = schema.set(index, pa.field(column, pa.dictionary(pa.int32(), schema.field(index).type.value_type)))
+    return schema
+
+
+@time_stage('ingest_event_log')
+def ingest_event_log(event_log: EventLog, chunk_rows: int = INGEST_CHUNK_ROWS, part: int = 0):
+    # Parse the uploaded csv once, chunk_rows events at a time, into a typed columnar copy that later
+    # readers load instead, peak memory is bounded by the chunk size and not by the size of the log
+    csv_path = get_event_log_path(event_log.id, 'csv', part)
+    path = get_event_log_path(event_log.id, part=part)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    categorical_columns = [event_log.case_id, event_log.activity, event_log.resource]
+
+    if part:
+        dtypes = get_part_dtypes(event_log)
+    else:
+        dtypes = get_csv_dtypes(csv_path, [event_log.start_time, event_log.end_time], chunk_rows)
+    dtypes[event_log.resource] = np.dtype('object')
+
+    writer = None
+    try:
+        for chunk in pd.read_csv(csv_path, dtype=dtypes, chunksize=chunk_rows):
+            table = pa.Table.from_pandas(
+                set_event_log_types(chunk, event_log, categorical_columns), preserve_index=False)
+            if writer is None:
+                schema = get_ingest_schema(table.schema, categorical_columns)
+                writer = pq.ParquetWriter(tmp_path, schema, version=PARQUET_VERSION)
+            writer.write_table(table.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        # Header only, there was no chunk to take the schema from
+        save_parquet(set_event_log_types(pd.read_csv(csv_path, dtype=dtypes), event_log, categorical_columns), path)
+    else:
+        os.replace(tmp_path, path)
+
+
+def get_event_log_version(event_log: EventLog) -> tuple:
+    # Changes whenever the stored log does: appended parts chain the content hash, and a log ingested again gets
+    # a new modification time
+    path = get_event_log_path(event_log.id, part=event_log.parts or 0)
+    return event_log.content_hash, event_log.parts or 0, os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+
+def get_event_log_columns(event_log: EventLog) -> list:
+    if not os.path.exists(get_event_log_path(event_log.id)):
+        ingest_event_log(event_log)
+    return pq.read_schema(get_event_log_path(event_log.id)).names
+
+
+@time_stage('load_event_log')
+def load_event_log(event_log: EventLog, columns: list = None, parts: range = None,
+                   categorical_columns: list = (), filters: list = None) -> pd.DataFrame:
+    # All parts of the log by default, the uploaded one followed by the appended ones. Filters (pyarrow's DNF
+    # form) select events, kept ones stay in stored order.
+    # Ids and the given categorical_columns (cohorts) are loaded as categories, text ones straight from the
+    # Parquet dictionaries without materializing a Python string per event.
+    # Logs uploaded before the columnar store existed are ingested on first access
+    if not os.path.exists(get_event_log_path(event_log.id)):
+        ingest_event_log(event_log)
+    if columns is not None:
+        columns = list(dict.fromkeys(columns))
+    if parts is None:
+        parts = range((event_log.parts or 0) + 1)
+    event_log_df = pd.concat([
+        pd.read_parquet(get_event_log_path(event_log.id, part=part), columns=columns,
+                        read_dictionary=list(categorical_columns), filters=filters)
+        for part in parts
+    ], ignore_index=True)
+    return restore_categories(event_log_df, event_log, categorical_columns)
+
+
+def restore_categories(event_log_df: pd.DataFrame, event_log: EventLog,
+                       categorical_columns: list = ()) -> pd.DataFrame:
+    for column in [event_log.case_id, event_log.activity, event_log.resource, *categorical_columns]:
+        if column not in event_log_df.columns:
+            continue
+        if not isinstance(event_log_df[column].dtype, pd.CategoricalDtype):
+            # Parquet only keeps the dictionary encoding of text columns, restore it for numeric ids.
+            # Parts with different categories concatenate to plain values as well.
+            event_log_df[column] = event_log_df[column].astype("category")
+        elif not event_log_df[column].cat.categories.is_monotonic_increasing:
+            # Chunk dictionaries are merged in order of appearance, keep categories sorted like astype does
+            event_log_df[column] = event_log_df[column].cat.reorder_categories(
+                event_log_df[column].cat.categories.sort_values())
+    return event_log_df
+
+
+def get_part_sizes(event_log: EventLog) -> list:
+    # Number of events of every part, from the Parquet footers
+    if not os.path.exists(get_event_log_path(event_log.id)):
+        ingest_event_log(event_log)
+    return [pq.ParquetFile(get_event_log_path(event_log.id, part=part)).metadata.num_rows
+            for part in range((event_log.parts or 0) + 1)]
+
+
+def get_filter_columns(filters: list) -> list:
+    # Columns of filters in pyarrow's DNF form: conditions, or lists of conditions of which any may hold
+    return [column for conditions in filters for column, _, _ in (conditions if isinstance(conditions, list)
+                                                                  else [conditions])]
+
+
+@time_stage('load_event_log')
+def load_event_log_rows(event_log: EventLog, columns: list, parts: range, categorical_columns: list = (),
+                        filters: list = None) -> (pd.DataFrame, np.ndarray):
+    # load_event_log of the given parts, along with the position of every loaded event in the stored log (all
+    # parts one after the other, as iter_numbered_tables numbers them). Row groups whose statistics rule out the
+    # filters are not read.
+    if not os.path.exists(get_event_log_path(event_log.id)):
+        ingest_event_log(event_log)
+    columns = list(dict.fromkeys(columns))
+    expression = pq.filters_to_expression(filters) if filters else None
+    read_columns = list(dict.fromkeys(columns + get_filter_columns(filters or [])))
+    file_format = ds.ParquetFileFormat(read_options=ds.ParquetReadOptions(dictionary_columns=categorical_columns))
+    offsets = np.cumsum([0] + get_part_sizes(event_log))
+    tables, rows = [], []
+    for part in parts:
+        path = get_event_log_path(event_log.id, part=part)
+        metadata = pq.ParquetFile(path).metadata
+        row_group_offsets = np.cumsum([0] + [metadata.row_group(index).num_rows
+                                             for index in range(metadata.num_row_groups)])
+        fragment = next(ds.dataset(path, format=file_format).get_fragments())
+        for row_group in fragment.split_by_row_group(expression):
+            table = row_group.to_table(columns=read_columns)
+            table = table.append_column(ROW_COLUMN, pa.array(
+                offsets[part] + row_group_offsets[row_group.row_groups[0].id] + np.arange(table.num_rows)))
+            if expression is not None:
+                table = table.filter(expression)
+            tables.append(table.select(columns))
+            rows.append(table.column(ROW_COLUMN).to_numpy())
+    if not tables:
+        tables.append(pq.read_schema(get_event_log_path(event_log.id)).empty_table().select(columns))
+    event_log_df = pa.concat_tables(tables, promote=True).to_pandas()
+    return restore_categories(event_log_df, event_log, categorical_columns), \
+        np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+
+
+def has_enablement_times(event_log: EventLog, configuration_key: str) -> bool:
+    return all(os.path.exists(get_enablement_times_path(event_log.id, configuration_key, part))
+               for part in range((event_log.parts or 0) + 1))
+
+
+def load_enablement_times(event_log: EventLog, configuration_key: str):
+    # Of all parts, None unless every part has them. Logs appended to before they were stored per part are
+    # enriched again.
+    if not has_enablement_times(event_log, configuration_key):
+        return None
+    return pd.concat([pd.read_parquet(get_enablement_times_path(event_log.id, configuration_key, part)).iloc[:, 0]
+                      for part in range((event_log.parts or 0) + 1)], ignore_index=True)
+
+
+def load_enablement_time_rows(event_log: EventLog, configuration_key: str, rows: np.ndarray) -> pd.Series:
+    # Stored enablement times of the events at the given positions (see load_event_log_rows), only the row groups
+    # holding them are read
+    offsets = np.cumsum([0] + get_part_sizes(event_log))
+    parts = np.searchsorted(offsets, rows, side='right') - 1
+    enablement_times = np.full(len(rows), np.datetime64('NaT'), dtype='datetime64[ns]')
+    for part in np.unique(parts):
+        part_rows = rows[parts == part] - offsets[part]
+        file = pq.ParquetFile(get_enablement_times_path(event_log.id, configuration_key, part))
+        row_group_sizes = [file.metadata.row_group(index).num_rows for index in range(file.metadata.num_row_groups)]
+        row_group_offsets = np.cumsum([0] + row_group_sizes)
+        row_groups = np.searchsorted(row_group_offsets, part_rows, side='right') - 1
+        read = np.unique(row_groups)
+        # Offsets of the read row groups, once concatenated
+        read_offsets = np.cumsum([0] + [row_group_sizes[index] for index in read])
+        positions = part_rows - row_group_offsets[row_groups] + read_offsets[np.searchsorted(read, row_groups)]
+        values = file.read_row_groups(read.tolist()).column(0).take(pa.array(positions)).to_pandas()
+        enablement_times[parts == part] = values.dt.tz_convert(None).to_numpy()
+    return pd.Series(pd.to_datetime(enablement_times, utc=True))
+
+
+def store_enablement_times(event_log: EventLog, configuration_key: str, enablement_times: pd.Series,
+                           part: int = None):
+    # Enablement times of the given part, or of every part when there is none (the whole log, row aligned with it)
+    if part is None:
+        offsets = np.cumsum([0] + get_part_sizes(event_log))
+        for part in range((event_log.parts or 0) + 1):
+            store_enablement_times(event_log, configuration_key,
+                                   enablement_times.iloc[offsets[part]:offsets[part + 1]], part)
+        return
+    save_parquet(enablement_times.to_frame(), get_enablement_times_path(event_log.id, configuration_key, part),
+                 ENABLEMENT_ROW_GROUP_ROWS)
+
+
+def load_concurrency_counts(event_log: EventLog, parts: int = None):
+    # activities, df_counts and l2l_counts of the log, see count_concurrency_relations. None until stored.
+    if parts is None:
+        parts = event_log.parts or 0
+    path = get_concurrency_counts_path(event_log.id, parts)
+    if not os.path.exists(path):
+        return None
+    counts = pd.read_parquet(path)
+
+    def get_relation(relation: str) -> pd.Series:
+        relation_counts = counts[counts['relation'] == relation]
+        return pd.Series(relation_counts['count'].to_numpy(), index=pd.MultiIndex.from_arrays(
+            [relation_counts['activity'].to_numpy(), relation_counts['next_activity'].to_numpy()]))
+
+    return set(counts.loc[counts['relation'] == 'activity', 'activity']), get_relation('df'), get_relation('l2l')
+
+
+def store_concurrency_counts(event_log: EventLog, counts: tuple, parts: int = None):
+    # One row per activity (its own next activity) and per counted pair of each relation
+    if parts is None:
+        parts = event_log.parts or 0
+    activities, df_counts, l2l_counts = counts
+    activities = list(activities)
+    frames = [pd.DataFrame({'relation': 'activity', 'activity': activities, 'next_activity': activities,
+                            'count': np.zeros(len(activities), dtype=np.int64)})]
+    for relation, relation_counts in [('df', df_counts), ('l2l', l2l_counts)]:
+        frames.append(pd.DataFrame({
+            'relation': relation,
+            'activity': relation_counts.index.get_level_values(0),
+            'next_activity': relation_counts.index.get_level_values(1),
+            'count': relation_counts.to_numpy(dtype=np.int64),
+        }))
+    save_parquet(pd.concat(frames, ignore_index=True), get_concurrency_counts_path(event_log.id, parts))
+
+
+def load_case_variants(event_log: EventLog):
+    path = get_case_variants_path(event_log.id, event_log.parts or 0)
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+def store_case_variants(event_log: EventLog, case_variants: pd.DataFrame, parts: int = None):
+    if parts is None:
+        parts = event_log.parts or 0
+    save_parquet(case_variants, get_case_variants_path(event_log.id, parts))
+
+
+def store_cohort_cube(cohort_cube_id: int, cube: dict, parts: int = 0):
+    # parts: appended parts of the log the cube covers
+    for kind, frame in cube.items():
+        if kind == 'variants':
+            # Parquet stores sequences as lists
+            frame = frame.assign(activities=frame['activities'].map(list))
+        save_parquet(frame, get_cohort_cube_path(cohort_cube_id, kind, parts))
+
+
+def load_cohort_cube(cohort_cube_id: int, parts: int = 0) -> dict:
+    # Cubes stored before they were kept per number of parts have a single version, the current one
+    if not os.path.exists(get_cohort_cube_path(cohort_cube_id, COHORT_CUBE_KINDS[0], parts)):
+        parts = 0
+    cube = {kind: pd.read_parquet(get_cohort_cube_path(cohort_cube_id, kind, parts)) for kind in COHORT_CUBE_KINDS}
+    cube['variants']['activities'] = cube['variants']['activities'].map(tuple)
+    return cube
@@ -0,0 +1,210 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from apps.metrics.instrumentation import time_stage
+from apps.metrics.models import EventLog
+from apps.metrics.storage import get_event_log_path, get_enablement_times_path, ingest_event_log, restore_categories, \
+    get_part_sizes, PARQUET_VERSION, STORAGE_DIR
+
+STREAMING_BATCH_ROWS = 100_000  # events read from the stored log at a time
+STREAMING_CHUNK_ROWS = 500_000  # events per case-complete chunk, a chunk holds at least one whole case
+NAT = np.datetime64('NaT').view('i8')
+CONTEXT = 'context'  # set on the events a chunk only holds for the waiting time analysis of its own cases
+ROW = 'row'  # position of the event in the stored log, see iter_numbered_tables
+
+
+def get_event_log_size(event_log: EventLog) -> int:
+    # Number of events of all parts, from the Parquet footers
+    return sum(get_part_sizes(event_log))
+
+
+def iter_tables(paths: list, columns: list, batch_rows: int):
+    # Record batches of the files one after the other, regrouped into tables of exactly batch_rows rows (but the
+    # last one) so that the tables of row aligned files line up
+    buffered, size = [], 0
+    for path in paths:
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows, columns=columns):
+            buffered.append(pa.Table.from_batches([batch]))
+            size += batch.num_rows
+            if size >= batch_rows:
+                table = pa.concat_tables(buffered, promote=True)
+                for start in range(0, size - batch_rows + 1, batch_rows):
+                    yield table.slice(start, batch_rows)
+                buffered = [table.slice(size - size % batch_rows)]
+                size %= batch_rows
+    if size:
+        yield pa.concat_tables(buffered, promote=True)
+
+
+def iter_event_log_tables(event_log: EventLog, columns: list, batch_rows: int = STREAMING_BATCH_ROWS,
+                          configuration_key: str = None):
+    # The stored log, all parts, batch_rows events at a time. With a configuration key the stored enablement
+    # times of the log are added as a column.
+    if not os.path.exists(get_event_log_path(event_log.id)):
+        ingest_event_log(event_log)
+    tables = iter_tables([get_event_log_path(event_log.id, part=part) for part in range((event_log.parts or 0) + 1)],
+                         list(dict.fromkeys(columns)), batch_rows)
+    if configuration_key is None:
+        yield from tables
+        return
+    enablement_times = iter_tables([get_enablement_times_path(event_log.id, configuration_key, part)
+                                    for part in range((event_log.parts or 0) + 1)], None, batch_rows)
+    for table, enabled_times in zip(tables, enablement_times):
+        yield table.append_column(enabled_times.schema.field(0), enabled_times.column(0))
+
+
+def iter_numbered_tables(tables):
+    # The tables with the position of every event in the stored log as ROW column
+    offset = 0
+    for table in tables:
+        yield table.append_column(ROW, pa.array(np.arange(offset, offset + table.num_rows)))
+        offset += table.num_rows
+
+
+def to_nanoseconds(times: pd.Series) -> np.ndarray:
+    return times.values.astype('datetime64[ns]').view('i8')
+
+
+def get_case_chunks(tables, log_ids, chunk_rows: int) -> (pd.DataFrame, pd.DataFrame):
+    # One pass over the events for the size and the time span of every case and of every resource in it. Cases
+    # ordered by their start are then cut into chunks of about chunk_rows events, a case is never split.
+    # Returns the cases with their chunk and the time windows of every resource in every chunk: the spans of the
+    # resource in the chunk's cases, overlapping ones merged.
+    time_columns = [log_ids.start_time, log_ids.end_time]
+    partials = []
+    for table in tables:
+        if table.num_rows == 0:
+            continue
+        events = table.select([log_ids.case, log_ids.resource] + time_columns).to_pandas()
+        events = pd.DataFrame({
+            'case': np.asarray(events[log_ids.case]),
+            'resource': np.asarray(events[log_ids.resource]),
+            'start': to_nanoseconds(events[log_ids.start_time]),
+            'end': to_nanoseconds(events[log_ids.end_time]),
+        })
+        if log_ids.enabled_time in table.column_names:
+            # Waiting starts at the enablement, which may come before the start of a case's first event
+            enabled_times = to_nanoseconds(table.column(log_ids.enabled_time).to_pandas())
+            events['start'] = np.where(
+                enabled_times == NAT, events['start'], np.minimum(events['start'], enabled_times))
+        partials.append(events.groupby(['case', 'resource'], dropna=False).agg(
+            events=('start', 'size'), start=('start', 'min'), end=('end', 'max')))
+    if not partials:
+        return pd.DataFrame({'events': [], 'start': [], 'end': [], 'chunk': []}), \
+            pd.DataFrame({'chunk': [], 'resource': [], 'start': [], 'end': []})
+    case_resources = pd.concat(partials).groupby(level=[0, 1], dropna=False) \
+        .agg({'events': 'sum', 'start': 'min', 'end': 'max'})
+    cases = case_resources.groupby(level=0).agg({'events': 'sum', 'start': 'min', 'end': 'max'}) \
+        .sort_values('start', kind='mergesort')
+    cases['chunk'], _ = pd.factorize((cases['events'].cumsum() - cases['events']) // chunk_rows)
+    case_resources = case_resources.reset_index(level=1)
+    case_resources['chunk'] = cases['chunk'].reindex(case_resources.index).to_numpy()
+    return cases, merge_windows(case_resources.dropna(subset=['resource'])[['chunk', 'resource', 'start', 'end']])
+
+
+def merge_windows(windows: pd.DataFrame) -> pd.DataFrame:
+    # Overlapping windows of the same chunk and resource merged, sorted by chunk, resource and start
+    windows = windows.sort_values(['chunk', 'resource', 'start'], kind='mergesort', ignore_index=True)
+    keys = [windows['chunk'], windows['resource']]
+    previous_ends = windows.groupby(keys, sort=False)['end'].cummax().groupby(keys, sort=False).shift()
+    merged = (previous_ends.isna() | (windows['start'] > previous_ends)).cumsum()
+    return windows.groupby(merged).agg({'chunk': 'first', 'resource': 'first', 'start': 'min', 'end': 'max'}) \
+        .reset_index(drop=True)
+
+
+def overlaps_windows(window_keys: np.ndarray, window_ends: np.ndarray, window_axis: np.ndarray,
+                     resources: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    # Whether each event (resource code, start, end) overlaps a window of its resource. Windows are disjoint and
+    # sorted by (resource, start), window_keys rank them on window_axis: only the last window of the resource
+    # starting before the event ends can overlap it.
+    keys = resources * (len(window_axis) + 1) + np.searchsorted(window_axis, ends, side='right')
+    rows = np.searchsorted(window_keys, keys, side='right') - 1
+    candidates = np.maximum(rows, 0)
+    return (rows >= 0) & (window_keys[candidates] // (len(window_axis) + 1) == resources) & \
+        (window_ends[candidates] >= starts)
+
+
+def write_chunk(writers: dict, directory: str, chunk: int, table: pa.Table, context: bool):
+    table = table.append_column(CONTEXT, pa.array(np.full(table.num_rows, context)))
+    if chunk not in writers:
+        writers[chunk] = pq.ParquetWriter(
+            os.path.join(directory, f'chunk_{chunk}.parquet'), table.schema, version=PARQUET_VERSION)
+    writers[chunk].write_table(table.cast(writers[chunk].schema))
+
+
+def partition_event_log(tables, log_ids, cases: pd.DataFrame, resource_windows: pd.DataFrame, directory: str,
+                        with_context: bool):
+    # Second pass, every event is written to the chunk of its case. With context, it is also written to every
+    # other chunk where its resource works in the meantime: the waiting time of a case depends on what its
+    # resources did for other cases, and only while its events waited or ran.
+    chunk_starts = cases.groupby('chunk')['start'].min().to_numpy()
+    resources = pd.Index(resource_windows['resource'].unique())
+    # Windows of every chunk as searchable keys, see overlaps_windows
+    chunk_windows = {}
+    for chunk, windows in resource_windows.groupby('chunk'):
+        window_axis = np.sort(windows['start'].to_numpy())
+        window_keys = resources.get_indexer(windows['resource']) * (len(window_axis) + 1) + \
+            np.searchsorted(window_axis, windows['start'].to_numpy(), side='right')
+        order = np.argsort(window_keys, kind='stable')
+        chunk_windows[chunk] = window_keys[order], windows['end'].to_numpy()[order], window_axis
+    writers = {}
+    try:
+        for table in tables:
+            if table.num_rows == 0:
+                continue
+            events = table.select([log_ids.case, log_ids.resource, log_ids.start_time, log_ids.end_time]).to_pandas()
+            chunks = cases['chunk'].to_numpy()[cases.index.get_indexer(np.asarray(events[log_ids.case]))]
+            for chunk in np.unique(chunks):
+                write_chunk(writers, directory, chunk, table.filter(pa.array(chunks == chunk)), False)
+            if not with_context or len(resources) == 0:
+                continue
+            starts, ends = to_nanoseconds(events[log_ids.start_time]), to_nanoseconds(events[log_ids.end_time])
+            event_resources = resources.get_indexer(np.asarray(events[log_ids.resource]))
+            known = event_resources >= 0
+            # Chunks are ordered by start, the ones starting after the last event of the table are not overlapped
+            for chunk in range(np.searchsorted(chunk_starts, ends.max(), side='right')):
+                if chunk not in chunk_windows:
+                    continue
+                overlapping = known & (chunks != chunk) & overlaps_windows(
+                    *chunk_windows[chunk], np.maximum(event_resources, 0), starts, ends)
+                if overlapping.any():
+                    write_chunk(writers, directory, chunk, table.filter(pa.array(overlapping)), True)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return [os.path.join(directory, f'chunk_{chunk}.parquet') for chunk in sorted(writers)]
+
+
+@contextmanager
+def case_chunk_files(get_tables, event_log: EventLog, log_ids, chunk_rows: int = STREAMING_CHUNK_ROWS,
+                     with_context: bool = False):
+    # The chunk files of iter_case_chunks, for reading them more than once with read_case_chunk. Removed on exit.
+    os.makedirs(STORAGE_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=STORAGE_DIR, prefix=f'event_log_{event_log.id}_chunks_') as directory:
+        with time_stage('partition_event_log'):
+            cases, resource_windows = get_case_chunks(get_tables(), log_ids, chunk_rows)
+            yield partition_event_log(get_tables(), log_ids, cases, resource_windows, directory, with_context) \
+                if len(cases) else []
+
+
+def read_case_chunk(path: str, event_log: EventLog, categorical_columns: list = ()) -> pd.DataFrame:
+    return restore_categories(pq.read_table(path).to_pandas(), event_log, categorical_columns)
+
+
+def iter_case_chunks(get_tables, event_log: EventLog, log_ids, categorical_columns: list = (),
+                     chunk_rows: int = STREAMING_CHUNK_ROWS, with_context: bool = False):
+    # Out-of-core view of a log: case-complete chunks of about chunk_rows events, in order of case start and with
+    # events in stored order. get_tables returns a fresh iterator over the (selected) events as Arrow tables, the
+    # log is read twice and spilled to chunk files, so memory is bounded by the chunk and not by the log.
+    # Events held as context of other chunks' cases are flagged in the CONTEXT column.
+    with case_chunk_files(get_tables, event_log, log_ids, chunk_rows, with_context) as paths:
+        for path in paths:
+            chunk = read_case_chunk(path, event_log, categorical_columns)
+            os.remove(path)
+            yield chunk
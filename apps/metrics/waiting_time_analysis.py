@@ -0,0 +1,35 @@
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+WAITING_TIME_COLUMNS = ['wt_total', 'wt_contention', 'wt_batching', 'wt_prioritization', 'wt_unavailability',
+                        'wt_extraneous']
+
+
+@contextmanager
+def limit_cpus(workers: int):
+    # wta sizes its process pool by itself, bound the cores it (and its children) may use instead.
+    # Concurrent tasks start their window at different cores so they do not all pile onto the first ones.
+    affinity = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    if workers is None or workers <= 1 or workers >= len(affinity):
+        yield
+        return
+    offset = os.getpid() % len(affinity)
+    os.sched_setaffinity(0, (affinity[offset:] + affinity[:offset])[:workers])
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, affinity)
+
+
+def aggregate_waiting_times(wt_analysis: pd.DataFrame) -> pd.DataFrame:
+    # Per (source, destination) transition count and waiting time totals in seconds, sorted by transition
+    transitions = wt_analysis.groupby(['source_activity', 'destination_activity'], observed=True).agg(
+        count=('wt_total', 'size'),
+        **{column: (column, 'sum') for column in WAITING_TIME_COLUMNS}
+    ).sort_index()  # observed=True does not keep categorical keys sorted
+    for column in WAITING_TIME_COLUMNS:
+        transitions[column] = transitions[column] / np.timedelta64(1, 's')
+    return transitions.reset_index()
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+CASE_ID = 'case_id'
+ACTIVITY = 'activity'
+START_TIME = 'start_time'
+END_TIME = 'end_time'
+RESOURCE = 'resource'
+COHORT = 'cohort'
+
+
+def generate_event_log(cases: int = 1000, activities: int = 10, resources: int = 5, cohort_values: int = 2,
+                       seed: int = 0, variants: int = None, cohort_columns: int = 1) -> pd.DataFrame:
+    # Seeded synthetic log: every case walks a random sequence of activities, each event is executed by a
+    # random resource, and a case waits a random time between consecutive events.
+    # With variants, cases follow one of that many random activity sequences instead of their own.
+    rng = np.random.default_rng(seed)
+    if variants is None:
+        lengths = rng.integers(2, activities + 1, size=cases)
+    else:
+        variant_lengths = rng.integers(2, activities + 1, size=variants)
+        variant_activities = rng.integers(0, activities, size=int(variant_lengths.sum()))
+        case_variants = rng.integers(0, variants, size=cases)
+        lengths = variant_lengths[case_variants]
+    events = int(lengths.sum())
+
+    case_ids = np.repeat(np.arange(cases), lengths)
+    processing = rng.exponential(1800, size=events)
+    durations = rng.exponential(3600, size=events) + processing
+    # Time elapsed since the case started at the end of each event
+    first_events = np.cumsum(lengths) - lengths
+    elapsed = np.cumsum(durations)
+    elapsed -= np.repeat(elapsed[first_events] - durations[first_events], lengths)
+    case_starts = np.repeat(rng.uniform(0, 30 * 24 * 3600, size=cases), lengths)
+    end_times = pd.Timestamp('2023-01-01', tz='UTC') + pd.to_timedelta(case_starts + elapsed, unit='s')
+
+    if variants is None:
+        activity_codes = rng.integers(0, activities, size=events)
+    else:
+        variant_offsets = np.cumsum(variant_lengths) - variant_lengths
+        positions = np.arange(events) - np.repeat(first_events, lengths)
+        activity_codes = variant_activities[np.repeat(variant_offsets[case_variants], lengths) + positions]
+    resource_codes = rng.integers(0, resources, size=events)
+
+    event_log = pd.DataFrame({
+        CASE_ID: case_ids,
+        ACTIVITY: get_names('Activity', activities)[activity_codes],
+        START_TIME: end_times - pd.to_timedelta(processing, unit='s'),
+        END_TIME: end_times,
+        RESOURCE: get_names('Resource', resources)[resource_codes],
+        COHORT: np.repeat(rng.integers(0, cohort_values, size=cases), lengths),
+    })
+    for column in get_cohort_columns(cohort_columns)[1:]:
+        event_log[column] = np.repeat(rng.integers(0, cohort_values, size=cases), lengths)
+    return event_log
+
+
+def generate_event_log_of_size(events: int, activities: int = 10, **kwargs) -> pd.DataFrame:
+    # Case lengths are uniform in [2, activities], pick the number of cases that gives about that many events
+    return generate_event_log(max(1, round(events / ((activities + 2) / 2))), activities, **kwargs)
+
+
+def get_names(prefix: str, count: int) -> np.ndarray:
+    return np.array([f'{prefix} {index}' for index in range(count)], dtype=object)
+
+
+def get_cohort_columns(cohort_columns: int) -> list:
+    return [COHORT] + [f'{COHORT}_{index}' for index in range(1, cohort_columns)]
@@ -0,0 +1,294 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import cached_property
+
+import psutil
+import pyarrow as pa
+from flask import Flask
+from werkzeug.datastructures import FileStorage
+
+from apps.metrics import read_event_log, ingest_event_log, get_cohorts, cluster_traces, analysis_process_time, \
+    analysis_waiting_time, add_enablement_times, get_log_ids, get_process_time_stats, get_waiting_time_transitions, \
+    store_process_time_results, store_waiting_time_results, generate_transition_difference_table_rows, \
+    get_streamed_analysis_stats
+from apps.metrics.models import db, EventLog, AnalyzeResult
+from apps.metrics.storage import get_event_log_path, STORAGE_DIR
+from benchmarks.event_log_generator import generate_event_log_of_size, CASE_ID, ACTIVITY, START_TIME, END_TIME, \
+    RESOURCE, COHORT
+
+# Timings and peak memory of the analysis pipeline on synthetic logs of increasing size:
+#   python -m benchmarks.suite --sizes 10000 100000 1000000 --output results/$(git rev-parse --short HEAD).json
+#   python -m benchmarks.suite --sizes 10000 100000 --compare results/<older revision>.json
+# Sizes go up to 10M events, the waiting time benchmarks (wta) are by far the slowest, leave them out
+# of the larger sizes with --benchmarks.
+DEFAULT_SIZES = [10_000, 100_000]
+REGRESSION_THRESHOLD = 1.2  # slower (or larger) by this factor than the compared run
+MEMORY_SAMPLE_SECONDS = 0.001
+
+
+class BenchmarkLog:
+    # One synthetic log with everything the benchmarks need, built lazily so that a run selecting only a
+    # few benchmarks does not pay for the others' setup
+    def __init__(self, event_log_id: int, events: int, args):
+        self.events = events
+        self.args = args
+        self.meta = EventLog(CASE_ID, ACTIVITY, START_TIME, END_TIME, RESOURCE)
+        self.meta.id = event_log_id
+        self.log_ids = get_log_ids(self.meta)
+
+    @cached_property
+    def event_log(self):
+        return generate_event_log_of_size(
+            self.events, self.args.activities, resources=self.args.resources,
+            cohort_values=self.args.cohort_values, seed=self.args.seed, variants=self.args.variants,
+            cohort_columns=self.args.cohort_columns)
+
+    @cached_property
+    def csv_path(self):
+        os.makedirs(STORAGE_DIR, exist_ok=True)
+        path = get_event_log_path(self.meta.id, 'csv')
+        self.event_log.to_csv(path, index=False)
+        return path
+
+    @cached_property
+    def stored(self):
+        # Columnar copy read by get_cohorts and the Celery tasks
+        self.csv_path
+        ingest_event_log(self.meta)
+        return True
+
+    @cached_property
+    def enriched_event_log(self):
+        event_log = self.event_log.copy()
+        add_enablement_times(event_log, self.log_ids)
+        return event_log
+
+    @cached_property
+    def analyze_results(self):
+        # Stored results of the first two cohort values, as the Celery tasks leave them
+        analyze_results = []
+        for cohort_value in ['0', '1']:
+            analyze_result = AnalyzeResult(self.meta.id, COHORT, cohort_value)
+            db.session.add(analyze_result)
+            db.session.commit()
+            store_waiting_time_results(analyze_result.id, get_waiting_time_transitions(
+                self.enriched_event_log, self.meta, COHORT, cohort_value, self.args.workers))
+            store_process_time_results(analyze_result.id, *get_process_time_stats(
+                self.event_log, self.meta, COHORT, cohort_value))
+            analyze_result.waiting_time_done = True
+            analyze_result.process_time_done = True
+            db.session.commit()
+            analyze_result.summary = json.dumps(analyze_result.get_summary())
+            db.session.commit()
+            analyze_results.append(analyze_result)
+        return analyze_results
+
+
+def bench_read_event_log(log: BenchmarkLog):
+    csv_path = log.csv_path
+
+    def run():
+        with open(csv_path, 'rb') as file:
+            read_event_log(FileStorage(file), 'benchmark_upload.csv', log.log_ids)
+    return run
+
+
+def bench_ingest_event_log(log: BenchmarkLog):
+    log.csv_path
+    return lambda: ingest_event_log(log.meta)
+
+
+def bench_get_cohorts(log: BenchmarkLog):
+    log.stored
+    return lambda: get_cohorts(log.meta)
+
+
+def bench_cluster_traces(log: BenchmarkLog):
+    # cluster_traces adds its column to the log it is given, the other benchmarks share the generated one
+    event_log = log.event_log
+    return lambda: cluster_traces(event_log.copy(), log.meta)
+
+
+def bench_analysis_process_time(log: BenchmarkLog):
+    event_log = log.event_log
+    return lambda: analysis_process_time(event_log, log.meta, COHORT, '0')
+
+
+def bench_analysis_waiting_time(log: BenchmarkLog):
+    event_log = log.enriched_event_log
+    return lambda: analysis_waiting_time(event_log, log.meta, COHORT, '0', log.args.workers)
+
+
+def bench_streamed_process_time(log: BenchmarkLog):
+    # Out-of-core counterpart of analysis_process_time, chunks of a tenth of the log
+    log.stored
+    return lambda: get_streamed_analysis_stats(
+        log.meta, COHORT, '0', chunk_rows=max(log.events // 10, 1), waiting_times=False)
+
+
+def bench_get_summary(log: BenchmarkLog):
+    analyze_result = log.analyze_results[0]
+    return lambda: analyze_result.get_summary()
+
+
+def bench_to_dict(log: BenchmarkLog):
+    analyze_result = log.analyze_results[0]
+    return lambda: analyze_result.to_dict(details=True)
+
+
+def bench_transition_difference_table(log: BenchmarkLog):
+    result1, result2 = [analyze_result.to_dict() for analyze_result in log.analyze_results]
+    process_time = (result1['trace_results']['process_time'] + result2['trace_results']['process_time']) / 2
+    cycle_time = (result1['trace_results']['cycle_time'] + result2['trace_results']['cycle_time']) / 2
+    return lambda: generate_transition_difference_table_rows(
+        result1['waiting_time_results'], result2['waiting_time_results'], process_time, cycle_time)
+
+
+BENCHMARKS = {
+    'read_event_log': bench_read_event_log,
+    'ingest_event_log': bench_ingest_event_log,
+    'get_cohorts': bench_get_cohorts,
+    'cluster_traces': bench_cluster_traces,
+    'analysis_process_time': bench_analysis_process_time,
+    'analysis_waiting_time': bench_analysis_waiting_time,
+    'streamed_process_time': bench_streamed_process_time,
+    'get_summary': bench_get_summary,
+    'to_dict': bench_to_dict,
+    'transition_difference_table': bench_transition_difference_table,
+}
+
+
+class MemorySampler(threading.Thread):
+    # Peak resident memory and pyarrow allocations above their level when started. tracemalloc only sees the
+    # Python allocator, not the buffers of pyarrow (nor numpy's outside of it), so both are polled instead.
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.process = psutil.Process()
+        self.stopped = threading.Event()
+        self.rss = self.peak_rss = self.process.memory_info().rss
+        self.arrow = self.peak_arrow = pa.total_allocated_bytes()
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+        self.peak_arrow = max(self.peak_arrow, pa.total_allocated_bytes())
+
+    def run(self):
+        while not self.stopped.wait(MEMORY_SAMPLE_SECONDS):
+            self.sample()
+
+    def stop(self) -> dict:
+        self.stopped.set()
+        self.join()
+        self.sample()
+        return {'peak_mb': (self.peak_rss - self.rss) / 2 ** 20,
+                'arrow_peak_mb': (self.peak_arrow - self.arrow) / 2 ** 20}
+
+
+def measure(run, repeat: int) -> dict:
+    # Best of repeat runs for the time, one extra run for the peak memory. Memory freed by earlier runs is
+    # given back first, so that the run does not reuse it unseen.
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - started)
+    gc.collect()
+    pa.default_memory_pool().release_unused()
+    sampler = MemorySampler()
+    sampler.start()
+    try:
+        run()
+    finally:
+        memory = sampler.stop()
+    return {'seconds': min(seconds), 'mean_seconds': sum(seconds) / len(seconds), **memory}
+
+
+def get_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results: list, baseline_path: str, threshold: float) -> list:
+    with open(baseline_path) as file:
+        baseline = {(result['benchmark'], result['events']): result for result in json.load(file)['results']}
+    regressions = []
+    print(f'\n{"benchmark":<30} {"events":>10} {"time":>8} {"memory":>8}')
+    for result in results:
+        before = baseline.get((result['benchmark'], result['events']))
+        if before is None:
+            continue
+        time_ratio = result['seconds'] / before['seconds'] if before['seconds'] else 1
+        memory_ratio = result['peak_mb'] / before['peak_mb'] if before['peak_mb'] else 1
+        regressed = time_ratio > threshold or memory_ratio > threshold
+        print(f'{result["benchmark"]:<30} {result["events"]:>10} {time_ratio:>7.2f}x {memory_ratio:>7.2f}x'
+              f'{"  REGRESSION" if regressed else ""}')
+        if regressed:
+            regressions.append(result)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='approximate events per log')
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--activities', type=int, default=10)
+    parser.add_argument('--variants', type=int, default=None, help='distinct activity sequences, default: random')
+    parser.add_argument('--resources', type=int, default=20)
+    parser.add_argument('--cohort-columns', type=int, default=3)
+    parser.add_argument('--cohort-values', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=1, help='cores of the waiting time analysis')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='json file the results are written to')
+    parser.add_argument('--compare', help='json file of an earlier run, exits with 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        # The storage helpers write below the working directory, keep that out of the checkout
+        os.chdir(workdir)
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(workdir, "benchmark.db")}'
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+            print(f'{"benchmark":<30} {"events":>10} {"seconds":>10} {"peak MB":>10} {"arrow MB":>10}')
+            for event_log_id, events in enumerate(args.sizes, start=1):
+                log = BenchmarkLog(event_log_id, events, args)
+                for name in args.benchmarks:
+                    result = {'benchmark': name, 'events': len(log.event_log), 'size': events,
+                              **measure(BENCHMARKS[name](log), args.repeat)}
+                    results.append(result)
+                    print(f'{name:<30} {result["events"]:>10} {result["seconds"]:>10.3f} {result["peak_mb"]:>10.1f}'
+                          f' {result["arrow_peak_mb"]:>10.1f}')
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump({
+                'revision': get_revision(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'parameters': {key: value for key, value in vars(args).items()
+                               if key not in ('output', 'compare', 'threshold')},
+                'results': results,
+            }, file, indent=2)
+    if baseline and compare(results, baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
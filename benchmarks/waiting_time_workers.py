@@ -0,0 +1,39 @@
+import argparse
+import os
+import time
+
+from apps.metrics import add_enablement_times, analysis_waiting_time, get_log_ids
+from apps.metrics.models import EventLog
+from benchmarks.event_log_generator import generate_event_log, CASE_ID, ACTIVITY, START_TIME, END_TIME, RESOURCE, \
+    COHORT
+
+
+# Scaling of analysis_waiting_time with the number of workers on a synthetic log:
+#   python -m benchmarks.waiting_time_workers --cases 2000 --max-workers 8
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', type=int, default=1000)
+    parser.add_argument('--activities', type=int, default=10)
+    parser.add_argument('--resources', type=int, default=5)
+    parser.add_argument('--max-workers', type=int, default=len(os.sched_getaffinity(0)))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    event_log_meta = EventLog(CASE_ID, ACTIVITY, START_TIME, END_TIME, RESOURCE)
+    event_log = generate_event_log(args.cases, args.activities, args.resources, cohort_values=1, seed=args.seed)
+    # Enablement times are computed once per log in the application too, keep them out of the timings
+    add_enablement_times(event_log, get_log_ids(event_log_meta))
+
+    print(f'{len(event_log)} events, {args.cases} cases')
+    print(f'{"workers":>8} {"seconds":>10} {"speedup":>8}')
+    baseline = None
+    for workers in range(1, args.max_workers + 1):
+        started = time.perf_counter()
+        analysis_waiting_time(event_log.copy(), event_log_meta, COHORT, '0', workers)
+        elapsed = time.perf_counter() - started
+        baseline = baseline or elapsed
+        print(f'{workers:>8} {elapsed:>10.2f} {baseline / elapsed:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
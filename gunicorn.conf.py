@@ -0,0 +1,20 @@
+import os
+
+# Picked up by gunicorn from the working directory, every setting can be overridden from the environment.
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+# gevent: one greenlet per connection, so concurrent requests scale with connections and not with workers.
+# Network, Redis and PostgreSQL I/O yield to the other greenlets, disk writes, parsing and SQLite reads are handed
+# to a thread pool (apps/core/offload.py) and the analyses run on the Celery workers. Use 'sync' to go back to one
+# request per worker.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+# Long polling and event streams keep requests open for a while
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 waits on the database in C, make it yield like the patched sockets do
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,90 @@
+import os
+
+import pandas as pd
+import pytest
+from flask import Flask
+
+from apps.metrics import load_event_log, add_stored_enablement_times, get_event_log_delta, get_waiting_time_windows, \
+    get_enablement_configuration_key
+from apps.metrics.models import db, EventLog
+from apps.metrics.storage import get_event_log_path, ingest_event_log, store_enablement_times, \
+    store_concurrency_counts, INGEST_CHUNK_ROWS, STORAGE_DIR
+from benchmarks.event_log_generator import generate_event_log, CASE_ID, ACTIVITY, START_TIME, END_TIME, RESOURCE, \
+    COHORT
+
+# Run from the repository root: python -m pytest tests
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # The storage helpers write below the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def app(workdir):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{workdir / "test.db"}'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+
+
+@pytest.fixture
+def event_log() -> pd.DataFrame:
+    # Fixed log: cases of up to 8 events over 6 activities and 4 resources, overlapping in time
+    return generate_event_log(300, activities=6, resources=4, cohort_values=3, seed=7)
+
+
+@pytest.fixture
+def event_log_meta() -> EventLog:
+    event_log_meta = EventLog(CASE_ID, ACTIVITY, START_TIME, END_TIME, RESOURCE)
+    event_log_meta.id = 1
+    event_log_meta.parts = 0
+    return event_log_meta
+
+
+def store_event_log_part(event_log_meta: EventLog, event_log: pd.DataFrame, part: int = 0,
+                         chunk_rows: int = INGEST_CHUNK_ROWS):
+    # As /upload (part 0) and /append leave the log
+    os.makedirs(STORAGE_DIR, exist_ok=True)
+    event_log.to_csv(get_event_log_path(event_log_meta.id, 'csv', part), index=False)
+    ingest_event_log(event_log_meta, chunk_rows, part=part)
+
+
+def store_event_log_with_part(event_log_meta: EventLog, event_log: pd.DataFrame):
+    # The log as uploaded without its latest events, which are stored as part 1 to be appended. The part continues
+    # cases of the log as well as starting new ones.
+    start_times = pd.to_datetime(event_log[START_TIME], utc=True)
+    appended = start_times >= start_times.quantile(0.7)
+    store_event_log_part(event_log_meta, event_log[~appended])
+    store_event_log_part(event_log_meta, event_log[appended], part=1)
+
+
+def load_analysed_event_log(event_log_meta: EventLog, columns: list) -> pd.DataFrame:
+    # With the stored enablement times, the ones analyses read
+    event_log_df = load_event_log(event_log_meta, columns, categorical_columns=[COHORT])
+    add_stored_enablement_times(event_log_df, event_log_meta)
+    return event_log_df
+
+
+def append_part(event_log_meta: EventLog, columns: list):
+    # As do_append_event_log takes part 1 in, the log has it afterwards. Returns the events of the cases it
+    # touches before and after it, the enablement times of the part and the windows of the waiting times.
+    before, after, enablement_times, counts = get_event_log_delta(event_log_meta, 1, columns)
+    store_enablement_times(event_log_meta, get_enablement_configuration_key(), enablement_times, 1)
+    store_concurrency_counts(event_log_meta, counts, 1)
+    windows = get_waiting_time_windows(event_log_meta, 1, before, after, columns)
+    event_log_meta.parts = 1
+    return before, after, enablement_times, windows
+
+
+def assert_same_rows(folded: pd.DataFrame, fresh: pd.DataFrame, keys: list, columns: list):
+    # Folded rows keep the order keys first appeared in, the values have to match
+    folded = folded.astype({key: str for key in keys}).sort_values(keys, ignore_index=True)
+    fresh = fresh.astype({key: str for key in keys}).sort_values(keys, ignore_index=True)
+    assert folded[keys].values.tolist() == fresh[keys].values.tolist()
+    for column in columns:
+        assert folded[column].astype(float).to_numpy() == pytest.approx(fresh[column].astype(float).to_numpy()), column
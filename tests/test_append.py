@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from apps.core.celery import release_stale_append, holds_append_claim, set_job_state
+from apps.metrics import load_event_log, add_enablement_times, get_log_ids, get_analysis_stats, \
+    fold_analysis_results, load_analysis_stats, store_waiting_time_results, store_process_time_results
+from apps.metrics.models import db, AnalyzeResult, AnalyzeJob
+from apps.metrics.waiting_time_analysis import WAITING_TIME_COLUMNS
+from benchmarks.event_log_generator import COHORT
+from conftest import store_event_log_with_part, load_analysed_event_log, append_part, assert_same_rows
+
+
+@pytest.mark.parametrize('filter_value', ['0', '1,2'])
+def test_fold_matches_fresh_analysis(app, event_log_meta, event_log, filter_value):
+    store_event_log_with_part(event_log_meta, event_log)
+    log_ids = get_log_ids(event_log_meta)
+    columns = event_log_meta.get_columns() + [COHORT]
+    analyze_result = AnalyzeResult(event_log_meta.id, COHORT, filter_value)
+    db.session.add(analyze_result)
+    db.session.commit()
+    transitions, activity_stats, variant_stats = get_analysis_stats(
+        load_analysed_event_log(event_log_meta, columns), event_log_meta, COHORT, filter_value)
+    store_waiting_time_results(analyze_result.id, transitions)
+    store_process_time_results(analyze_result.id, activity_stats, variant_stats)
+
+    before, after, enablement_times, windows = append_part(event_log_meta, columns)
+    fold_analysis_results(analyze_result.id, *[
+        get_analysis_stats(event_log_df, event_log_meta, COHORT, filter_value, context=window)
+        for event_log_df, window in zip((before, after), windows)])
+
+    # The appended events are enabled by the oracle of the whole log, the earlier ones keep their times
+    whole = load_event_log(event_log_meta, event_log_meta.get_columns())
+    add_enablement_times(whole, log_ids)
+    pd.testing.assert_series_equal(enablement_times, whole[log_ids.enabled_time].iloc[-len(enablement_times):]
+                                   .reset_index(drop=True), check_names=False)
+
+    fresh_transitions, fresh_activities, fresh_variants = get_analysis_stats(
+        load_analysed_event_log(event_log_meta, columns), event_log_meta, COHORT, filter_value)
+    folded_transitions, folded_activities, folded_variants = load_analysis_stats(analyze_result.id)
+    assert_same_rows(folded_transitions, fresh_transitions, ['source_activity', 'destination_activity'],
+                     ['count'] + WAITING_TIME_COLUMNS)
+    assert_same_rows(folded_activities.reset_index(), fresh_activities.reset_index(), ['activity'],
+                     ['count', 'pt_total'])
+    assert_same_rows(folded_variants, fresh_variants, ['activities'], ['count', 'ct_total', 'pt_total'])
+
+
+@pytest.mark.parametrize('claimed_minutes_ago, released', [(120, True), (1, False)])
+def test_stale_append_claim_is_released(app, event_log_meta, claimed_minutes_ago, released):
+    # As an append whose worker died leaves the log
+    app.config['APPEND_TIMEOUT'] = 3600
+    claimed_since = datetime.utcnow() - timedelta(minutes=claimed_minutes_ago)
+    event_log_meta.pending_part, event_log_meta.pending_since = 1, claimed_since
+    analyze_result = AnalyzeResult(event_log_meta.id, COHORT, '0')
+    analyze_result.job = AnalyzeJob()
+    db.session.add_all([event_log_meta, analyze_result])
+    db.session.commit()
+    set_job_state([analyze_result.id], AnalyzeJob.QUEUED, 'append')
+
+    release_stale_append(event_log_meta)
+    assert (event_log_meta.pending_part is None) == released
+    assert (analyze_result.job.status == AnalyzeJob.DONE) == released
+    # A worker still running does not commit the part once its claim is released
+    assert holds_append_claim(event_log_meta.id, 1, claimed_since) != released
@@ -0,0 +1,28 @@
+import pytest
+
+from apps.metrics import cluster_traces
+from benchmarks.event_log_generator import generate_event_log, CASE_ID, ACTIVITY, START_TIME, END_TIME
+
+
+def test_hash_clustering_matches_printable(event_log, event_log_meta):
+    by_hash, by_characters = event_log.copy(), event_log.copy()
+    cluster_traces(by_hash, event_log_meta, method='hash')
+    cluster_traces(by_characters, event_log_meta, method='printable')
+    assert by_hash['cluster_id'].tolist() == by_characters['cluster_id'].tolist()
+
+
+def test_hash_clustering_beyond_printable_alphabet(event_log_meta):
+    event_log = generate_event_log(500, activities=150, seed=3)
+    with pytest.raises(RuntimeError):
+        cluster_traces(event_log.copy(), event_log_meta, method='printable')
+    cluster_traces(event_log, event_log_meta, method='hash')
+    sequences = event_log.sort_values([CASE_ID, END_TIME, START_TIME]).groupby(CASE_ID)[ACTIVITY].agg(tuple)
+    clusters = event_log.groupby(CASE_ID)['cluster_id'].first()
+    # One cluster per distinct activity sequence
+    assert clusters.groupby(sequences).nunique().eq(1).all()
+    assert clusters.nunique() == sequences.nunique()
+
+
+def test_unknown_clustering_method(event_log, event_log_meta):
+    with pytest.raises(ValueError):
+        cluster_traces(event_log, event_log_meta, method='sorted')
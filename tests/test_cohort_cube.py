@@ -0,0 +1,61 @@
+import pytest
+
+from apps.core.celery import analyze_from_cohort_cube
+from apps.metrics import load_event_log, add_enablement_times, get_log_ids, get_analysis_stats, build_cohort_cube, \
+    store_cohort_cube, load_analysis_stats, get_analysis_cache_key
+from apps.metrics.models import db, AnalyzeResult, AnalyzeJob, CohortCube
+from benchmarks.event_log_generator import COHORT
+from conftest import store_event_log_part, assert_same_rows
+
+
+@pytest.fixture
+def cohort_cube(app, event_log_meta, event_log):
+    store_event_log_part(event_log_meta, event_log)
+    cohort_cube = CohortCube(event_log_meta.id, COHORT)
+    db.session.add_all([event_log_meta, cohort_cube])
+    db.session.commit()
+    event_log_df = load_event_log(event_log_meta, event_log_meta.get_columns() + [COHORT],
+                                  categorical_columns=[COHORT])
+    store_cohort_cube(cohort_cube.id, build_cohort_cube(event_log_df, event_log_meta, COHORT))
+    return cohort_cube
+
+
+def analyze(event_log_meta, filter_value):
+    # Enablement times of the whole log, as the analyses read them from storage
+    event_log_df = load_event_log(event_log_meta, event_log_meta.get_columns() + [COHORT],
+                                  categorical_columns=[COHORT])
+    add_enablement_times(event_log_df, get_log_ids(event_log_meta))
+    return get_analysis_stats(event_log_df, event_log_meta, COHORT, filter_value)
+
+
+def merge(cohort_cube, event_log_meta, filter_value):
+    analyze_result = AnalyzeResult(event_log_meta.id, COHORT, filter_value, from_cohort_cube=True)
+    analyze_result.job = AnalyzeJob()
+    db.session.add(analyze_result)
+    db.session.commit()
+    analyze_from_cohort_cube(analyze_result.id, cohort_cube)
+    assert analyze_result.get_status()['status'] == AnalyzeJob.DONE
+    assert analyze_result.to_dict()['from_cohort_cube']
+    return load_analysis_stats(analyze_result.id)
+
+
+def test_single_value_merged_from_cube_matches_analysis(cohort_cube, event_log_meta):
+    transitions, activity_stats, variant_stats = merge(cohort_cube, event_log_meta, '1')
+    fresh_transitions, fresh_activities, fresh_variants = analyze(event_log_meta, '1')
+    assert_same_rows(transitions, fresh_transitions, ['source_activity', 'destination_activity'],
+                     [column for column in fresh_transitions.columns
+                      if column not in ('source_activity', 'destination_activity')])
+    assert_same_rows(activity_stats.reset_index(), fresh_activities.reset_index(), ['activity'],
+                     ['count', 'pt_total'])
+    assert_same_rows(variant_stats, fresh_variants, ['activities'], ['count', 'ct_total', 'pt_total'])
+
+
+def test_value_set_merged_from_cube_has_its_own_key(cohort_cube, event_log_meta):
+    # Waiting times of a value set come from each value's own analysis, only the counts match
+    transitions, activity_stats, _ = merge(cohort_cube, event_log_meta, '0,2')
+    fresh_transitions, fresh_activities, _ = analyze(event_log_meta, '0,2')
+    assert_same_rows(transitions, fresh_transitions, ['source_activity', 'destination_activity'], ['count'])
+    assert_same_rows(activity_stats.reset_index(), fresh_activities.reset_index(), ['activity'],
+                     ['count', 'pt_total'])
+    assert get_analysis_cache_key(event_log_meta, COHORT, '0,2', from_cohort_cube=True) != \
+        get_analysis_cache_key(event_log_meta, COHORT, '0,2')
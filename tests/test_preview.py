@@ -0,0 +1,29 @@
+import math
+
+import pytest
+
+from apps.metrics import load_event_log, add_enablement_times, get_log_ids, get_preview_stats, get_case_metrics, \
+    get_filtered_event_log
+from benchmarks.event_log_generator import COHORT
+from conftest import store_event_log_part
+
+
+@pytest.mark.parametrize('filter_value', ['0', '1,2'])
+def test_preview_of_cases_with_mixed_cohort_values(workdir, event_log_meta, event_log, filter_value):
+    # The first event of every third case has the next cohort value
+    first_events = event_log.index[~event_log.duplicated(event_log_meta.case_id)][::3]
+    event_log.loc[first_events, COHORT] = (event_log.loc[first_events, COHORT] + 1) % 3
+    store_event_log_part(event_log_meta, event_log)
+    log_ids = get_log_ids(event_log_meta)
+    event_log_df = load_event_log(event_log_meta, event_log_meta.get_columns() + [COHORT],
+                                  categorical_columns=[COHORT])
+    add_enablement_times(event_log_df, log_ids)
+    event_cases = load_event_log(event_log_meta, [event_log_meta.case_id, COHORT], categorical_columns=[COHORT])
+
+    # Sampled whole, the estimates are the totals of the value set's events
+    preview = get_preview_stats(event_cases, event_log_df[log_ids.enabled_time], None, event_log_meta, COHORT,
+                                filter_value, math.inf, sample_cases=len(event_log))
+    totals = get_case_metrics(get_filtered_event_log(event_log_df, COHORT, filter_value), log_ids).sum()
+    assert preview['sampled_cases'] == preview['cases']
+    for column, total in totals.items():
+        assert preview['metrics'][column]['total'] == pytest.approx(total), column
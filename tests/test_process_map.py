@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+import pytest
+
+from apps.metrics.models import get_process_map, prune_process_map
+
+
+@pytest.fixture
+def process_map():
+    # A -> B frequent and short, B -> C rare and long, A -> C in between
+    waiting_time_results = [
+        SimpleNamespace(source_activity=source, target_activity=target, count=count, wt_total=wt_total)
+        for source, target, count, wt_total in [('A', 'B', 10, 10), ('B', 'C', 1, 100), ('A', 'C', 5, 5)]]
+    activity_results = [SimpleNamespace(activity=SimpleNamespace(name=name), count=count, pt_total=count * 2)
+                        for name, count in [('A', 15), ('B', 10), ('C', 6)]]
+    return get_process_map(waiting_time_results, 16, activity_results, 31)
+
+
+def get_edges(process_map):
+    return {(node['name'], transition['target']) for node in process_map for transition in node['transitions']}
+
+
+def test_process_map_nodes_and_edges(process_map):
+    assert [node['name'] for node in process_map] == ['start', 'end', 'A', 'B', 'C']
+    assert get_edges(process_map) == {('start', 'A'), ('A', 'B'), ('A', 'C'), ('B', 'C'), ('C', 'end')}
+    a_to_b = process_map[2]['transitions'][0]['value']
+    assert a_to_b == {'average_duration': 1, 'total_duration': 10, 'total_frequency': 10, 'relative_frequency': 10 / 16}
+    assert process_map[4]['value']['total_frequency'] == 6
+
+
+@pytest.mark.parametrize('max_edges, prune_by, edges', [
+    (1, 'frequency', {('start', 'A'), ('A', 'B'), ('B', 'end')}),
+    (1, 'duration', {('start', 'B'), ('B', 'C'), ('C', 'end')}),
+    (2, 'frequency', {('start', 'A'), ('A', 'B'), ('A', 'C'), ('B', 'end'), ('C', 'end')}),
+    (3, 'frequency', {('start', 'A'), ('A', 'B'), ('A', 'C'), ('B', 'C'), ('C', 'end')}),
+])
+def test_pruned_process_map_keeps_top_transitions(process_map, max_edges, prune_by, edges):
+    pruned = prune_process_map(process_map, max_edges, prune_by)
+    assert [node['name'] for node in pruned[:2]] == ['start', 'end']
+    assert get_edges(pruned) == edges
+    # Activities keep their values
+    values = {node['name']: node['value'] for node in process_map[2:]}
+    assert all(node['value'] == values[node['name']] for node in pruned[2:])
@@ -0,0 +1,50 @@
+import pytest
+
+from apps.metrics import analysis_process_time, cluster_traces_by_characters, get_filtered_event_log
+from benchmarks.event_log_generator import COHORT
+
+
+def reference_process_times(event_log, event_log_meta, filter_cohort, filter_value):
+    # The row by row analysis the columnar one replaced: activities (name -> [count, pt_total]) and variants
+    # ([activities, count, ct_total, pt_total]) in the order it created them
+    filtered_event_log = get_filtered_event_log(event_log, filter_cohort, filter_value)
+    cluster_traces_by_characters(filtered_event_log, event_log_meta)
+    activities, traces = {}, []
+    for _, cluster_events in filtered_event_log.groupby('cluster_id'):
+        for _, cohort_events in cluster_events.groupby(filter_cohort):
+            for _, case_events in cohort_events.groupby(event_log_meta.case_id):
+                trace, process_time = [], 0
+                for _, row in case_events.iterrows():
+                    duration = (row[event_log_meta.end_time] - row[event_log_meta.start_time]).total_seconds()
+                    process_time += duration
+                    activity = activities.setdefault(row[event_log_meta.activity], [0, 0])
+                    activity[0] += 1
+                    activity[1] += duration
+                    trace.append(row[event_log_meta.activity])
+                cycle_time = (case_events[event_log_meta.end_time].iloc[-1] -
+                              case_events[event_log_meta.start_time].iloc[0]).total_seconds()
+                variant = next((variant for variant in traces if variant[0] == trace), None)
+                if variant is None:
+                    traces.append([trace, 1, cycle_time, process_time])
+                else:
+                    variant[1] += 1
+                    variant[2] += cycle_time
+                    variant[3] += process_time
+    return activities, traces
+
+
+@pytest.mark.parametrize('filter_value', ['0', '1,2'])
+def test_process_times_match_reference(event_log, event_log_meta, filter_value):
+    activities, traces = reference_process_times(event_log.copy(), event_log_meta, COHORT, filter_value)
+    activity_results, trace_results = analysis_process_time(event_log.copy(), event_log_meta, COHORT, filter_value)
+
+    assert [activity_result.activity.name for activity_result in activity_results] == list(activities)
+    for activity_result, (count, pt_total) in zip(activity_results, activities.values()):
+        assert activity_result.count == count
+        assert activity_result.pt_total == pytest.approx(pt_total)
+    assert [trace_result.activities for trace_result in trace_results] == [','.join(trace) for trace, _, _, _ in traces]
+    for trace_result, (_, count, ct_total, pt_total) in zip(trace_results, traces):
+        assert trace_result.count == count
+        assert trace_result.ct_total == pytest.approx(ct_total)
+        assert trace_result.pt_total == pytest.approx(pt_total)
+
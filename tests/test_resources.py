@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from apps.metrics import get_log_ids, get_resource_stats, get_resource_windows, fold_resource_results, \
+    load_resource_results, store_resource_results
+from apps.metrics.models import db, AnalyzeResult
+from apps.metrics.resource_analysis import aggregate_resources
+from benchmarks.event_log_generator import COHORT, CASE_ID, ACTIVITY, START_TIME, END_TIME, RESOURCE
+from conftest import store_event_log_with_part, load_analysed_event_log, append_part, assert_same_rows
+
+
+def test_overlapping_events_and_handoffs(event_log_meta):
+    # Two overlapping events of R1, then case a is handed off to R2 after 10 seconds
+    start = pd.Timestamp('2023-01-01', tz='UTC')
+    event_log = pd.DataFrame({
+        CASE_ID: ['a', 'b', 'a'],
+        ACTIVITY: ['A', 'A', 'B'],
+        START_TIME: start + pd.to_timedelta([0, 5, 20], unit='s'),
+        END_TIME: start + pd.to_timedelta([10, 15, 30], unit='s'),
+        RESOURCE: ['R1', 'R1', 'R2'],
+    })
+    resource_stats, resource_load, handoffs = aggregate_resources(event_log, get_log_ids(event_log_meta), buckets=3)
+
+    resource_stats = resource_stats.set_index('resource')
+    assert resource_stats['count'].to_dict() == {'R1': 2, 'R2': 1}
+    assert resource_stats['work_time'].to_dict() == {'R1': 20, 'R2': 10}
+    assert resource_stats['busy_time'].to_dict() == {'R1': 15, 'R2': 10}
+    assert resource_stats['max_load'].to_dict() == {'R1': 2, 'R2': 1}
+    assert resource_stats['utilization'].to_dict() == {'R1': 0.5, 'R2': pytest.approx(1 / 3)}
+    # Buckets of 10 seconds: R1 works 15 seconds in the first one and 5 in the second
+    r1_load = resource_load[resource_load['resource'] == 'R1']
+    assert r1_load['mean_load'].tolist() == [1.5, 0.5, 0]
+    assert r1_load['busy_time'].tolist() == [10, 5, 0]
+    assert handoffs.to_dict('records') == [
+        {'source_resource': 'R1', 'target_resource': 'R2', 'count': 1, 'delay_total': 10}]
+
+
+@pytest.mark.parametrize('filter_value', ['0', '1,2'])
+def test_fold_matches_fresh_analysis(app, event_log_meta, event_log, filter_value):
+    store_event_log_with_part(event_log_meta, event_log)
+    columns = event_log_meta.get_columns() + [COHORT]
+    analyze_result = AnalyzeResult(event_log_meta.id, COHORT, filter_value)
+    db.session.add(analyze_result)
+    db.session.commit()
+    store_resource_results(analyze_result.id, *get_resource_stats(
+        load_analysed_event_log(event_log_meta, columns), event_log_meta, COHORT, filter_value))
+
+    before, after, _, _ = append_part(event_log_meta, columns)
+    windows = get_resource_windows(event_log_meta, 1, before, after, columns)
+    fold_resource_results(analyze_result.id, event_log_meta, windows, before, after, COHORT, filter_value)
+
+    fresh_resources, fresh_load, fresh_handoffs = get_resource_stats(
+        load_analysed_event_log(event_log_meta, columns), event_log_meta, COHORT, filter_value)
+    folded_resources, folded_load, folded_handoffs = load_resource_results(analyze_result.id)
+    assert_same_rows(folded_resources, fresh_resources, ['resource'],
+                     ['count', 'work_time', 'busy_time', 'max_load', 'utilization'])
+    assert_same_rows(folded_handoffs, fresh_handoffs, ['source_resource', 'target_resource'],
+                     ['count', 'delay_total'])
+    # Same total load, spread over the stored buckets and the ones added for the part
+    folded_work = (folded_load['mean_load'] * folded_load['duration']).groupby(folded_load['resource']).sum()
+    fresh_work = (fresh_load['mean_load'] * fresh_load['duration']).groupby(fresh_load['resource']).sum()
+    assert folded_work.sort_index().to_numpy() == pytest.approx(fresh_work.sort_index().to_numpy())
+    assert np.all(folded_load['busy_time'] <= folded_load['duration'] + 1e-6)
@@ -0,0 +1,89 @@
+from functools import partial
+
+import pandas as pd
+import pytest
+
+from apps import metrics
+from apps.metrics import load_event_log, add_enablement_times, get_log_ids, get_analysis_stats, get_resource_stats, \
+    store_waiting_time_results, store_process_time_results, store_resource_results, load_analysis_stats, \
+    load_resource_results, delete_analysis_results
+from apps.metrics.models import db, AnalyzeResult
+from apps.metrics.waiting_time_analysis import WAITING_TIME_COLUMNS
+from benchmarks.event_log_generator import COHORT
+from conftest import store_event_log_part, assert_same_rows
+
+FILTER_VALUES = ['0', '1,2']
+
+
+@pytest.fixture
+def analysed_event_log(app, event_log_meta, event_log):
+    store_event_log_part(event_log_meta, event_log)
+    event_log_df = load_event_log(event_log_meta, event_log_meta.get_columns() + [COHORT],
+                                  categorical_columns=[COHORT])
+    add_enablement_times(event_log_df, get_log_ids(event_log_meta))
+    return event_log_df
+
+
+def test_stored_results_round_trip(monkeypatch, analysed_event_log, event_log_meta):
+    # Batches much smaller than the rows of a result, and two results stored one after the other
+    monkeypatch.setattr(metrics, 'bulk_insert', partial(metrics.bulk_insert, batch_size=3))
+    analyses = {}
+    for filter_value in FILTER_VALUES:
+        analyze_result = AnalyzeResult(event_log_meta.id, COHORT, filter_value)
+        db.session.add(analyze_result)
+        db.session.commit()
+        transitions, activity_stats, variant_stats = get_analysis_stats(
+            analysed_event_log, event_log_meta, COHORT, filter_value)
+        resource_stats, resource_load, handoffs = get_resource_stats(
+            analysed_event_log, event_log_meta, COHORT, filter_value)
+        store_waiting_time_results(analyze_result.id, transitions)
+        store_process_time_results(analyze_result.id, activity_stats, variant_stats)
+        store_resource_results(analyze_result.id, resource_stats, resource_load, handoffs)
+        analyses[analyze_result.id] = transitions, activity_stats, variant_stats, resource_stats, resource_load, \
+            handoffs
+
+    for analyze_result_id, (transitions, activity_stats, variant_stats, resource_stats, resource_load, handoffs) \
+            in analyses.items():
+        stored_transitions, stored_activities, stored_variants = load_analysis_stats(analyze_result_id)
+        assert len(stored_transitions) == len(transitions)
+        assert_same_rows(stored_transitions, transitions, ['source_activity', 'destination_activity'],
+                         ['count'] + WAITING_TIME_COLUMNS)
+        # Every activity keeps the counts of its own row
+        assert stored_activities.index.tolist() == activity_stats.index.astype(str).tolist()
+        assert_same_rows(stored_activities.reset_index(), activity_stats.reset_index(), ['activity'],
+                         ['count', 'pt_total'])
+        assert stored_variants['activities'].tolist() == \
+            [tuple(map(str, activities)) for activities in variant_stats['activities']]
+        assert_same_rows(stored_variants, variant_stats.assign(activities=stored_variants['activities']),
+                         ['activities'], ['count', 'ct_total', 'pt_total'])
+
+        stored_resources, stored_load, stored_handoffs = load_resource_results(analyze_result_id)
+        assert_same_rows(stored_resources, resource_stats, ['resource'],
+                         ['count', 'work_time', 'busy_time', 'max_load', 'utilization'])
+        # Bucket starts are stored to the microsecond
+        resource_load = resource_load.assign(start=pd.to_datetime(resource_load['start'], utc=True).dt.floor('us'))
+        pd.testing.assert_series_equal(stored_load['start'], resource_load['start'], check_names=False)
+        assert_same_rows(stored_load, resource_load, ['resource', 'start'], ['duration', 'busy_time', 'mean_load'])
+        assert_same_rows(stored_handoffs, handoffs, ['source_resource', 'target_resource'], ['count', 'delay_total'])
+
+
+def test_deleted_results_leave_other_results(analysed_event_log, event_log_meta):
+    analyze_result_ids = []
+    for filter_value in FILTER_VALUES:
+        analyze_result = AnalyzeResult(event_log_meta.id, COHORT, filter_value)
+        db.session.add(analyze_result)
+        db.session.commit()
+        store_process_time_results(analyze_result.id, *get_analysis_stats(
+            analysed_event_log, event_log_meta, COHORT, filter_value)[1:])
+        store_resource_results(analyze_result.id, *get_resource_stats(
+            analysed_event_log, event_log_meta, COHORT, filter_value))
+        analyze_result_ids.append(analyze_result.id)
+
+    kept = load_analysis_stats(analyze_result_ids[1]), load_resource_results(analyze_result_ids[1])
+    delete_analysis_results(analyze_result_ids[0])
+    assert all(len(stats) == 0 for stats in load_analysis_stats(analyze_result_ids[0]))
+    assert all(len(stats) == 0 for stats in load_resource_results(analyze_result_ids[0]))
+    for stored, stats in zip((load_analysis_stats(analyze_result_ids[1]), load_resource_results(analyze_result_ids[1])),
+                             kept):
+        for stored_stats, kept_stats in zip(stored, stats):
+            pd.testing.assert_frame_equal(stored_stats, kept_stats)
@@ -0,0 +1,18 @@
+from apps.metrics.models import db, AnalyzeResult, AnalyzeJob, WaitingTimeResult
+
+
+def test_results_without_job(app):
+    # As results computed before jobs were tracked are left: no job, no summary
+    empty = AnalyzeResult(1, 'cohort', '0')
+    stored = AnalyzeResult(1, 'cohort', '1')
+    db.session.add_all([empty, stored])
+    db.session.commit()
+    waiting_time_result = WaitingTimeResult('a', 'b', 1, 0, 0, 0, 0, 0, 0)
+    waiting_time_result.analyze_result_id = stored.id
+    db.session.add(waiting_time_result)
+    db.session.commit()
+
+    assert empty.get_status()['status'] == AnalyzeJob.QUEUED
+    status = stored.get_status()
+    assert status['status'] == AnalyzeJob.DONE
+    assert status['waiting_time_done'] and not status['process_time_done']
@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+
+from apps.metrics import load_event_log, add_enablement_times, add_stored_enablement_times, get_log_ids, \
+    get_streamed_enablement_times, get_streamed_analysis_stats, get_waiting_time_transitions, get_process_time_stats
+from benchmarks.event_log_generator import COHORT
+from conftest import store_event_log_part, assert_same_rows
+
+# Small chunks, so that cases and the context of their chunks span several of them
+CHUNK_ROWS = 200
+
+
+@pytest.fixture
+def stored_event_log_meta(workdir, event_log_meta, event_log):
+    # Stored out of case order in several row groups, as a log appended to over time is
+    store_event_log_part(event_log_meta, event_log.sample(frac=1, random_state=1), chunk_rows=CHUNK_ROWS)
+    return event_log_meta
+
+
+def test_streamed_enablement_times_match_in_memory(stored_event_log_meta):
+    log_ids = get_log_ids(stored_event_log_meta)
+    event_log_df = load_event_log(stored_event_log_meta, stored_event_log_meta.get_columns())
+    add_enablement_times(event_log_df, log_ids)
+    streamed = get_streamed_enablement_times(stored_event_log_meta, chunk_rows=CHUNK_ROWS)
+    pd.testing.assert_series_equal(streamed, event_log_df[log_ids.enabled_time], check_names=False)
+
+
+@pytest.mark.parametrize('filter_value', ['1', '0,2'])
+def test_streamed_analysis_matches_in_memory(stored_event_log_meta, filter_value):
+    event_log_df = load_event_log(stored_event_log_meta, stored_event_log_meta.get_columns() + [COHORT],
+                                  categorical_columns=[COHORT])
+    add_stored_enablement_times(event_log_df, stored_event_log_meta)
+    transitions = get_waiting_time_transitions(event_log_df, stored_event_log_meta, COHORT, filter_value)
+    activity_stats, variant_stats = get_process_time_stats(
+        event_log_df.drop(columns=get_log_ids(stored_event_log_meta).enabled_time), stored_event_log_meta, COHORT,
+        filter_value)
+
+    streamed_transitions, streamed_activities, streamed_variants = get_streamed_analysis_stats(
+        stored_event_log_meta, COHORT, filter_value, CHUNK_ROWS)
+    # Rows may come in another order
+    assert_same_rows(streamed_transitions, transitions, ['source_activity', 'destination_activity'],
+                     [column for column in transitions.columns
+                      if column not in ('source_activity', 'destination_activity')])
+    assert_same_rows(streamed_activities.reset_index(), activity_stats.reset_index(), ['activity'],
+                     ['count', 'pt_total'])
+    assert_same_rows(streamed_variants.assign(activities=streamed_variants['activities'].map(tuple)),
+                     variant_stats.assign(activities=variant_stats['activities'].map(tuple)), ['activities'],
+                     ['count', 'ct_total', 'pt_total'])
@@ -0,0 +1,78 @@
+from collections import OrderedDict
+
+import pytest
+
+from apps.core import routes
+from apps.metrics import generate_transition_difference_table_rows, sort_transition_difference_table_rows
+
+
+def get_waiting_time_results(*waiting_times):
+    return {
+        'total_count': sum(count for _, _, count, _ in waiting_times),
+        'waiting_times': [{'source_activity': source, 'target_activity': target, 'count': count, 'wt_total': wt_total}
+                          for source, target, count, wt_total in waiting_times],
+    }
+
+
+def get_analyze_result(*waiting_times):
+    return {'complete': True, 'waiting_time_results': get_waiting_time_results(*waiting_times)}
+
+
+def test_rows_join_transitions_of_either_result():
+    rows = generate_transition_difference_table_rows(
+        get_waiting_time_results(('A', 'B', 2, 20), ('B', 'C', 2, 4)),
+        get_waiting_time_results(('B', 'C', 1, 6), ('A', 'C', 3, 30)), process_time=10, cycle_time=20)
+    assert [(row['source_activity'], row['target_activity'], row['present_in']) for row in rows] == [
+        ('A', 'B', 'first'), ('B', 'C', 'both'), ('A', 'C', 'second')]
+    assert [row['number'] for row in rows] == [1, 2, 3]
+    a_to_b, b_to_c, a_to_c = rows
+    assert (a_to_b['average_duration_first'], a_to_b['average_duration_second']) == (10, 0)
+    assert a_to_b['relative_frequency_difference'] == 0.5
+    assert b_to_c['average_duration_difference'] == 2 - 6
+    assert b_to_c['cte_impact'] == 0.5  # mean waiting time of 5 over a process time of 10
+    assert a_to_c['relative_frequency_second'] == 0.75
+
+
+def test_rows_without_process_time_sort_last():
+    rows = generate_transition_difference_table_rows(
+        get_waiting_time_results(('A', 'B', 1, 5), ('B', 'C', 1, 1)), get_waiting_time_results(('B', 'C', 1, 9)),
+        process_time=0, cycle_time=0)
+    assert all(row['cte_impact'] is None for row in rows)
+    for row, cte_impact in zip(rows, [1, 3]):
+        row['cte_impact'] = cte_impact
+    rows.append({**rows[0], 'number': 3, 'cte_impact': None})
+
+    assert [row['number'] for row in sort_transition_difference_table_rows(rows, 'cte_impact')] == [2, 1, 3]
+    assert [row['number'] for row in sort_transition_difference_table_rows(rows, 'cte_impact', False)] == [1, 2, 3]
+    # A limit alone keeps the highest cte_impact
+    assert [row['number'] for row in sort_transition_difference_table_rows(rows, limit=1)] == [2]
+    assert sort_transition_difference_table_rows(rows) == rows
+
+
+def test_cache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(routes, 'TRANSITION_DIFFERENCE_TABLE_CACHE_SIZE', 2)
+    monkeypatch.setattr(routes, 'transition_difference_table_cache', OrderedDict())
+    analyze_result = get_analyze_result(('A', 'B', 1, 1))
+    rows = {result_ids: routes.get_transition_difference_table_rows(result_ids, analyze_result, analyze_result, 1, 1)
+            for result_ids in [(1, 0, 2, 0), (1, 0, 3, 0)]}
+    # A hit makes the table the most recently used, the other one is evicted by the next table
+    assert routes.get_transition_difference_table_rows((1, 0, 2, 0), None, None, 1, 1) is rows[(1, 0, 2, 0)]
+    routes.get_transition_difference_table_rows((1, 0, 4, 0), analyze_result, analyze_result, 1, 1)
+    assert list(routes.transition_difference_table_cache) == [(1, 0, 2, 0), (1, 0, 4, 0)]
+
+    # Incomplete results are not cached
+    routes.get_transition_difference_table_rows((1, 0, 5, 0), {**analyze_result, 'complete': False}, analyze_result,
+                                                1, 1)
+    assert (1, 0, 5, 0) not in routes.transition_difference_table_cache
+
+
+@pytest.mark.parametrize('url', [
+    '/api/v1/core/results/1?prune_by=size',
+    '/api/v1/core/results?result_id1=1&result_id2=2&prune_by=size',
+    '/api/v1/core/results?result_id1=1&result_id2=2&sort_by=name',
+])
+def test_unknown_option_is_rejected(app, url):
+    app.register_blueprint(routes.blue_print)
+    response = app.test_client().get(url)
+    assert response.status_code == 400
+    assert response.get_json()['status'] == 'error'
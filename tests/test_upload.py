@@ -0,0 +1,47 @@
+import gzip
+import hashlib
+import io
+
+import pandas as pd
+import pytest
+
+from apps.metrics import load_event_log
+from apps.metrics.storage import store_event_log_stream, get_event_log_path, get_event_log_content_hash, \
+    ingest_event_log
+from conftest import store_event_log_part
+
+
+@pytest.fixture
+def csv(event_log) -> bytes:
+    return event_log.to_csv(index=False).encode()
+
+
+@pytest.mark.parametrize('compress', [
+    lambda content: content,
+    gzip.compress,
+    # Several members one after the other, as cat a.gz b.gz, bgzip and pigz write them
+    lambda content: b''.join(gzip.compress(content[start:start + 1000]) for start in range(0, len(content), 1000)),
+])
+def test_stored_upload_is_the_decompressed_csv(workdir, csv, compress):
+    # Chunks smaller than a gzip header, so members start and end within them
+    content_hash = store_event_log_stream(io.BytesIO(compress(csv)), 1, chunk_size=7)
+    with open(get_event_log_path(1, 'csv'), 'rb') as file:
+        assert file.read() == csv
+    assert content_hash == hashlib.sha256(csv).hexdigest() == get_event_log_content_hash(1)
+
+
+@pytest.mark.parametrize('body', [
+    lambda content: gzip.compress(content)[:-10],
+    lambda content: gzip.compress(content) + b'not gzip',
+])
+def test_damaged_gzip_upload_is_rejected(workdir, csv, body):
+    with pytest.raises(ValueError):
+        store_event_log_stream(io.BytesIO(body(csv)), 1)
+
+
+def test_ingest_in_chunks_matches_single_chunk(workdir, event_log_meta, event_log):
+    # Chunks see only some of the categories of the log, the stored dictionaries still hold every one
+    store_event_log_part(event_log_meta, event_log)
+    whole = load_event_log(event_log_meta)
+    ingest_event_log(event_log_meta, chunk_rows=50)
+    pd.testing.assert_frame_equal(load_event_log(event_log_meta), whole, check_categorical=False)